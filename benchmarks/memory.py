@@ -0,0 +1,46 @@
+"""
+Memory footprint of the model objects and of a whole TNBus graph, with and without raw payload retention.
+
+    python memory.py [stops] [routes]
+"""
+import gc
+import sys
+import tracemalloc
+
+from tnbus import TNBus
+
+from network import network, trips
+
+
+def footprint(obj):
+    # the instance plus its attribute dict, if any (contents excluded)
+    return sys.getsizeof(obj) + (sys.getsizeof(obj.__dict__) if hasattr(obj, "__dict__") else 0)
+
+
+def graph(make, **kwargs):
+    gc.collect()
+    tracemalloc.start()
+    net = make()
+    t = TNBus(None, preload=net, **kwargs)
+    peak = tracemalloc.get_traced_memory()[1]
+    del net
+    gc.collect()
+    current = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return t, current, peak
+
+
+def main(stops=3000, routes=250):
+    print(f"network: {stops} stops, {routes} routes")
+    for keep_raw in (True, False):
+        # the payload is built inside graph's trace, so that its memory is accounted only as long as it's retained
+        t, current, peak = graph(lambda: network(stops, routes), keep_raw=keep_raw)
+        print(f"keep_raw={keep_raw!s:5}  retained: {current / 2 ** 20:7.2f} MiB  peak: {peak / 2 ** 20:7.2f} MiB")
+
+    trip = t.build_trips(trips(network(stops, routes), 1, 1))[0]
+    for obj in (t.areas[0], t.routes[0], t.stops[0], trip, trip.times[0], trip.bus):
+        print(f"{type(obj).__name__:>12}: {footprint(obj):5d} B")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
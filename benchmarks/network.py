@@ -0,0 +1,153 @@
+"""
+Synthetic payloads shaped like the ones returned by API.areas, API.routes, API.stops and API.trips_new,
+plus an API stand-in serving them, so that benchmarks don't depend on the live service.
+Recorded payloads (see record.py) can be loaded with load and scaled up with scale.
+"""
+import json
+import os
+import random
+from datetime import datetime, timedelta
+
+NAMES = ["Piazza Dante", "Povo Valoni", "Salè", "Portaquila", "Sommarive", "Mattarello", "Gardolo Spini", "Città",
+         "Lavis", "Pergine Valsugana", "Rovereto Stazione", "Trento Nord", "Cognola", "Villazzano",
+         "Mesiano Università", "Oltrecastello", "Centochiavi", "Gocciadoro", "Interporto", "Ravina Belvedere"]
+
+
+def network(stops=3000, routes=250, seed=1):
+    rnd = random.Random(seed)
+    areas = [{"areaId": i, "areaDesc": f"{rnd.choice(NAMES)} {i}", "type": "U" if i < 4 else "E"} for i in range(1, 8)]
+    routes_ = []
+    for i in range(routes):
+        a = rnd.choice(areas)
+        routes_.append({
+            "routeId": 400 + i,
+            "areaId": a["areaId"],
+            "news": None if rnd.random() < .7 else [{
+                "idFeed": rnd.randint(1, 1000), "agencyId": "12", "serviceType": "BUS",
+                "startDate": "2023-01-01T00:00:00Z", "endDate": "2023-02-01T00:00:00Z", "header": "Lavori",
+                "details": "Deviazione", "stopId": rnd.randint(1, stops), "url": ""
+            }],
+            "routeColor": "c52720",
+            "routeLongName": " ".join(rnd.sample(NAMES, 3)),
+            "routeShortName": str(rnd.randint(1, 20)) + rnd.choice(["", "/", "A"]),
+            "type": rnd.choice([2, 3, 3, 3, 5]),
+            "routeType": a["type"]
+        })
+    stops_ = []
+    for i in range(stops):
+        stops_.append({
+            "stopCode": f"{21000 + i * 5}{rnd.choice('xz-')}",
+            "stopDesc": "",
+            "stopId": i + 1,
+            "stopLevel": 0,
+            "stopName": f"{rnd.choice(NAMES)} {rnd.choice(NAMES)}",
+            "street": "Via Sommarive",
+            "town": "Trento",
+            "type": rnd.choice("UE"),
+            "wheelchairBoarding": 0,
+            "stopLat": 45.8 + rnd.random() * .5,
+            "stopLon": 10.8 + rnd.random() * .8,
+            "routes": [{"routeId": r["routeId"], "type": r["type"]} for r in rnd.sample(routes_, rnd.randint(1, 4))]
+        })
+    return {"areas": areas, "routes": routes_, "stops": stops_, "trips": [],
+            "age": datetime(2023, 1, 10).timestamp()}
+
+
+def load(path):
+    # payloads recorded by record.py; trips_new is the list of recorded trips_new responses, if any
+    out = {}
+    for call in ("areas", "routes", "stops", "trips_new"):
+        try:
+            with open(os.path.join(path, f"{call}.json")) as f:
+                out[call] = json.load(f)
+        except FileNotFoundError:
+            if call != "trips_new":
+                raise
+    out["trips"] = []
+    out["age"] = os.path.getmtime(os.path.join(path, "stops.json"))
+    return out
+
+
+def scale(net, factor, seed=3):
+    # grows the network factor times by adding jittered copies of its stops under fresh ids
+    rnd = random.Random(seed)
+    stops_ = list(net["stops"])
+    top = max(s["stopId"] for s in stops_)
+    for k in range(1, int(factor)):
+        for s in net["stops"]:
+            stops_.append({
+                **s,
+                "stopCode": f"{s['stopCode']}{k}",
+                "stopId": s["stopId"] + k * top,
+                "stopLat": s["stopLat"] + (rnd.random() - .5) * .02,
+                "stopLon": s["stopLon"] + (rnd.random() - .5) * .02
+            })
+    return {**net, "stops": stops_}
+
+
+def trips(net, stop_id, limit=30, length=30, seed=2):
+    rnd = random.Random(seed * 100003 + stop_id)
+    stop = net["stops"][stop_id - 1]
+    same = [s for s in net["stops"] if s["type"] == stop["type"]]
+    out = []
+    for k in range(limit):
+        route = rnd.choice(net["routes"])
+        seq = rnd.sample(same, length - 1)
+        seq.insert(rnd.randrange(length), stop)
+        start = datetime(2023, 1, 10, 7) + timedelta(minutes=rnd.randint(0, 600))
+        times = []
+        for j, s in enumerate(seq):
+            t_ = (start + timedelta(minutes=2 * j)).time().isoformat()
+            times.append({"arrivalTime": t_, "departureTime": t_, "stopId": s["stopId"], "stopSequence": j + 1,
+                          "tripId": f"{k}", "type": s["type"]})
+        at = start + timedelta(minutes=2 * seq.index(stop))
+        out.append({
+            "tripId": f"0{stop_id:05d}{k:03d}-{route['routeId']}",
+            "cableway": None,
+            "corsaPiuVicinaADataRiferimento": k == 0,
+            "delay": rnd.randint(-1, 8),
+            "directionId": rnd.randint(0, 1),
+            "indiceCorsaInLista": k,
+            "lastEventRecivedAt": f"{start.isoformat()}Z",
+            "lastSequenceDetection": rnd.randint(0, length),
+            "matricolaBus": rnd.randint(100, 999),
+            "oraArrivoEffettivaAFermataSelezionata": f"{at.isoformat()}Z",
+            "oraArrivoProgrammataAFermataSelezionata": f"{at.isoformat()}Z",
+            "routeId": route["routeId"],
+            "stopTimes": times,
+            "stopLast": seq[2]["stopId"],
+            "stopNext": seq[3]["stopId"],
+            "totaleCorseInLista": limit,
+            "tripFlag": rnd.choice(["TRIP_FLAG__MID", "", "TRIP_FLAG__START"]),
+            "tripHeadsign": route["routeLongName"],
+            "type": stop["type"],
+            "wheelchairAccessible": 1
+        })
+    return out
+
+
+class FixtureAPI:
+    # serves fixture payloads with the same interface as tnbus.API
+    def __init__(self, net, trips_new=None):
+        self.net = net
+        self._trips_new = trips_new
+
+    def areas(self):
+        return self.net["areas"]
+
+    def routes(self, areas=None):
+        if areas is None:
+            return self.net["routes"]
+        return [r for r in self.net["routes"] if str(r["areaId"]) in areas]
+
+    def stops(self, areas=None):
+        # like the service, the stops served by at least a route of areas
+        if areas is None:
+            return self.net["stops"]
+        routes = {(r["routeId"], r["type"]) for r in self.routes(areas)}
+        return [s for s in self.net["stops"] if any((r["routeId"], r["type"]) in routes for r in s["routes"])]
+
+    def trips_new(self, search, time=None, limit=30):
+        if self._trips_new is not None:
+            return self._trips_new[:limit]
+        return trips(self.net, getattr(search, "id_numeric", 1), limit)
@@ -0,0 +1,31 @@
+"""
+Records the payloads of the live service into a fixture directory for the benchmarks, see network.load.
+
+    python record.py <auth file> <out dir> [stops]
+
+trips_new is recorded for the given number of stops served by the most routes.
+"""
+import json
+import os
+import sys
+
+from tnbus import TNBus, API
+
+
+def main(auth, out, stops=10):
+    with open(auth) as f:
+        api = API(f.read().strip())
+    os.makedirs(out, exist_ok=True)
+    t = TNBus(api)
+    for call in ("areas", "routes", "stops"):
+        with open(os.path.join(out, f"{call}.json"), "w") as f:
+            json.dump(t.raw[call], f)
+    busiest = sorted(t.stops, key=lambda s: len(s.routes), reverse=True)[:int(stops)]
+    with open(os.path.join(out, "trips_new.json"), "w") as f:
+        json.dump([api.trips_new(s, None, 30) for s in busiest], f)
+    print(f"recorded {len(t.areas)} areas, {len(t.routes)} routes, {len(t.stops)} stops and "
+          f"{len(busiest)} trips_new responses into {out}")
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,46 @@
+"""
+Compares a cold start through TNBus(preload=<json dump>) with one through tnbus.snapshot.load.
+
+    python snapshot.py [stops] [routes]
+"""
+import json
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+from tnbus import TNBus
+from tnbus import snapshot
+
+from network import network
+
+
+def best(f, n=5):
+    out = []
+    for _ in range(n):
+        s = perf_counter()
+        f()
+        out.append(perf_counter() - s)
+    return min(out)
+
+
+def main(stops=3000, routes=250):
+    net = network(stops, routes)
+    t = TNBus(None, preload=net)
+    with tempfile.TemporaryDirectory() as d:
+        js, bs = os.path.join(d, "net.json"), os.path.join(d, "net.snapshot")
+        with open(js, "w") as f:
+            t.dump(f)
+        snapshot.save(t, bs)
+
+        def from_json():
+            with open(js) as f_:
+                TNBus(None, preload=json.load(f_))
+
+        print(f"network: {stops} stops, {routes} routes")
+        print(f"json preload: {best(from_json) * 1000:8.1f} ms ({os.path.getsize(js) / 1024:.0f} KiB)")
+        print(f"snapshot:     {best(lambda: snapshot.load(bs)) * 1000:8.1f} ms ({os.path.getsize(bs) / 1024:.0f} KiB)")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,170 @@
+"""
+Benchmarks of the hot paths of TNBus against fixture payloads, reporting the best time of a few runs and the peak
+memory allocated by one run. Results can be saved and compared with a baseline of a previous version.
+
+    python suite.py [--fixture DIR] [--stops N] [--scale F] [--repeat N] [--filter SUBSTR]
+                    [--baseline FILE] [--save FILE] [--tolerance T]
+
+Without --fixture a synthetic network of --stops stops is used (see network.py); with --fixture the payloads
+recorded by record.py are loaded, and grown --scale times. No recorded fixture is shipped, since recording needs an
+API key: baseline.json was measured on the synthetic network, and a baseline of recorded payloads has to be saved
+with --save on the same machine first.
+Compared with --baseline, the cases slower or allocating more than baseline * (1 + tolerance) are reported as
+regressions and the exit status is 1. Times only compare across runs on the same machine.
+"""
+import argparse
+import gc
+import io
+import json
+import sys
+import tracemalloc
+from time import perf_counter
+
+from tnbus import TNBus, By, Cond
+from tnbus.shm import SharedNetwork
+from tnbus.version import version as VERSION
+
+from network import network, load, scale, trips, FixtureAPI
+
+
+def measure(run, setup=None, repeat=5):
+    # best time of repeat runs, then the peak of one run under tracemalloc
+    times = []
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        gc.collect()
+        s = perf_counter()
+        run(arg)
+        times.append(perf_counter() - s)
+    arg = setup() if setup else None
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    run(arg)
+    peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return {"time": min(times), "peak": peak}
+
+
+def cases(net, trips_new):
+    t = TNBus(None, preload=net)
+    shared = SharedNetwork.publish(t)
+    try:
+        yield from _cases(t, net, trips_new, shared)
+    finally:
+        shared.close()
+        shared.unlink()
+
+
+def _cases(t, net, trips_new, shared):
+    stops, routes, areas = t.stops[::max(len(t.stops) // 200, 1)], t.routes[:50], t.areas
+    api = FixtureAPI(net, trips_new[0])
+    long_ = max(trips_new, key=lambda r: sum(len(i["stopTimes"]) for i in r))
+
+    def fresh():
+        # compiled queries are cached by TNBus.query: every get case starts without them
+        t._queries.clear()
+
+    def get(t_, needles, cond_mode=None, override_unique=False):
+        def run(_):
+            for n_ in needles:
+                t.get(t_, *n_, cond_mode=cond_mode, override_unique=override_unique)
+        return run
+
+    def load_trips(times):
+        def run(_):
+            t.api = FixtureAPI(net, long_)
+            for i in t.load_trips(t.stops[0], None, len(long_)):
+                if times:
+                    for s_ in i.times:
+                        s_.stop
+        return run
+
+    def nearest(_):
+        for s_ in stops[:50]:
+            t.update_location(s_.location)
+            list(t.nearest_stops(10))
+
+    yield "init.fresh", lambda _: TNBus(api), None
+    yield "init.preload", lambda _: TNBus(None, preload=net), None
+    yield "init.shared", lambda _: TNBus(None, shared=shared), None
+    yield "get.stop.id", get(TNBus.Stop, [((By.ID, s.id),) for s in stops]), fresh
+    yield "get.stop.id_num", get(TNBus.Stop, [((By.ID_NUM, s.id_numeric),) for s in stops]), fresh
+    yield "get.stop.name", get(TNBus.Stop, [((By.NAME, s.name[:6]),) for s in stops]), fresh
+    yield "get.stop.name_match", get(TNBus.Stop, [((By.NAME_MATCH, s.name[-5:]),) for s in stops]), fresh
+    yield "get.stop.type", get(TNBus.Stop, [((By.TYPE, s.type),) for s in stops[:20]]), fresh
+    yield "get.stop.route", get(TNBus.Stop, [((By.ROUTE, r),) for r in routes]), fresh
+    yield "get.stop.area", get(TNBus.Stop, [((By.AREA, a),) for a in areas]), fresh
+    yield "get.route.area", get(TNBus.Route, [((By.AREA, a),) for a in areas]), fresh
+    yield "get.route.name", get(TNBus.Route, [((By.NAME, r.short_name),) for r in routes]), fresh
+    yield "get.area.id", get(TNBus.Area, [((By.ID, a.id),) for a in areas]), fresh
+    yield "get.cond.or", get(TNBus.Stop, [tuple((By.ID, s.id) for s in stops[i:i + 4]) for i in range(0, 200, 4)],
+                             Cond.OR, True), fresh
+    yield "get.cond.and", get(TNBus.Stop, [((By.NAME, s.name[:4]), (By.TYPE, s.type)) for s in stops],
+                              Cond.AND), fresh
+    yield "location.nearest", nearest, None
+    yield "trips.load", load_trips(False), None
+    yield "trips.load_times", load_trips(True), None
+    yield "dump", lambda _: t.dump(io.StringIO()), None
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, r_ in results.items():
+        b_ = baseline.get(name)
+        if b_ is None:
+            continue
+        for k in ("time", "peak"):
+            if b_[k] and r_[k] > b_[k] * (1 + tolerance):
+                regressions.append(f"{name} {k}: {r_[k] / b_[k]:.2f}x baseline")
+    return regressions
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="TNBus benchmark suite")
+    p.add_argument("--fixture", help="directory of payloads recorded by record.py")
+    p.add_argument("--stops", type=int, default=3000, help="stops of the synthetic network")
+    p.add_argument("--scale", type=float, default=1, help="growth factor of the fixture network")
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--filter", default="", help="only runs the cases whose name contains this")
+    p.add_argument("--baseline", help="results file to compare with")
+    p.add_argument("--save", help="file to save the results to")
+    p.add_argument("--tolerance", type=float, default=.25)
+    args = p.parse_args(argv)
+
+    if args.fixture:
+        net = scale(load(args.fixture), args.scale)
+        trips_new = net.pop("trips_new", None)
+        source = f"{args.fixture} x{args.scale:g}"
+    else:
+        net, trips_new = network(args.stops), None
+        source = "synthetic"
+    if not trips_new:
+        trips_new = [trips(net, net["stops"][0]["stopId"], 30, 60)]
+    print(f"tnbus {VERSION}, {source} network: {len(net['stops'])} stops, {len(net['routes'])} routes")
+
+    results = {}
+    for name, run, setup in cases(net, trips_new):
+        if args.filter in name:
+            results[name] = measure(run, setup, args.repeat)
+            print(f"{name:22} {results[name]['time'] * 1000:10.2f} ms {results[name]['peak'] / 2 ** 20:10.2f} MiB")
+
+    out = {"version": VERSION, "source": source, "stops": len(net["stops"]), "results": results}
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(out, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("stops") != out["stops"]:
+            print(f"warning: baseline network has {baseline.get('stops')} stops, this one {out['stops']}")
+        regressions = compare(results, baseline["results"], args.tolerance)
+        for r_ in regressions:
+            print(f"REGRESSION {r_}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,45 @@
+"""
+Cost of building the Trip objects of a trips_new response, e.g. load_trips(limit=30) on a long route.
+
+    python trips.py [stops] [limit] [length]
+"""
+import sys
+from time import perf_counter
+
+from tnbus import TNBus
+
+from network import network, trips, FixtureAPI
+
+
+def best(f, n=5):
+    out = []
+    for _ in range(n):
+        s = perf_counter()
+        f()
+        out.append(perf_counter() - s)
+    return min(out)
+
+
+def main(stops=3000, limit=30, length=60):
+    net = network(stops)
+    data = trips(net, 1, limit, length)
+    t = TNBus(FixtureAPI(net, data), preload=net)
+    stop = t.stops[0]
+
+    def selected():
+        # what most callers look at: the selected stop's arrival and delay
+        for i in t.load_trips(stop, None, limit):
+            i.actual_arrive_time, i.delay
+
+    def full():
+        for i in t.load_trips(stop, None, limit):
+            for s_ in i.times:
+                s_.stop
+
+    print(f"network: {stops} stops, {limit} trips of {length} stops")
+    print(f"load_trips:            {best(selected) * 1000:8.2f} ms")
+    print(f"load_trips + times:    {best(full) * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
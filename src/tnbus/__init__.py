@@ -1 +1 @@
-from .tnbus import TNBus, API, By, Cond
+from .tnbus import TNBus, API, By, Cond, Query
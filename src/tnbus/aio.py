@@ -0,0 +1,234 @@
+import asyncio
+from datetime import datetime
+from time import perf_counter
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from . import metrics
+from .tnbus import TNBus, API
+
+
+class AsyncAPI:
+    # asyncio counterpart of API, backed by a pooled aiohttp session (aiohttp is needed only by this module)
+    URL = API.URL
+    RETRY_STATUS = API.RETRY_STATUS
+    MAX_WAIT = API.MAX_WAIT
+
+    def __init__(self, key, url=None, pool_size=10, timeout=(3.05, 15), retries=3, backoff=.5, cache=None):
+        if aiohttp is None:
+            raise ImportError("AsyncAPI requires aiohttp, install it with `pip install aiohttp`")
+        self.auth = {"Authorization": f"Basic {key}"}
+        self.url = url or self.URL
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.cache = cache
+        self._session = None
+
+    @property
+    def session(self):
+        # the session must be created inside the running loop
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                headers={**self.auth, "Accept-Encoding": "gzip, deflate"},
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(connect=self.timeout[0], sock_read=self.timeout[1])
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
+
+    _delay = API._delay
+
+    async def _wait(self, attempt, headers=None):
+        await asyncio.sleep(self._delay(attempt, headers))
+
+    async def request(self, call, para=None):
+        """
+        GET call, retrying like API.request; returns a tuple (status, body bytes)
+        """
+        # aiohttp doesn't drop None parameters like requests does
+        para = {k: str(v) for k, v in (para or {}).items() if v is not None}
+        endpoint = call.split("/")[0]
+        for attempt in range(self.retries + 1):
+            start = perf_counter() if metrics.sinks else None
+            try:
+                async with self.session.get(f"{self.url}/{call}", params=para) as res:
+                    body = await res.read()
+                    status, headers = res.status, res.headers
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if metrics.sinks:
+                    metrics.inc("api_errors_total", endpoint=endpoint, kind=type(e).__name__)
+                if attempt == self.retries:
+                    raise
+                if metrics.sinks:
+                    metrics.inc("api_retries_total", endpoint=endpoint)
+                await self._wait(attempt)
+                continue
+            if start is not None and metrics.sinks:
+                API._measure(endpoint, status, start, len(body))
+            if status not in self.RETRY_STATUS or attempt == self.retries:
+                return status, body
+            if metrics.sinks:
+                metrics.inc("api_retries_total", endpoint=endpoint)
+            await self._wait(attempt, headers)
+
+    async def query(self, call, para=None):
+        return (await self.request(call, para))[1].decode()
+
+    async def query_json(self, call, para=None):
+        async def fetch():
+            return API._decode(call, (await self.request(call, para))[1])
+
+        if self.cache is not None:
+            return await self.cache.aget_or_fetch(call, para, fetch)
+        return await fetch()
+
+    async def routes(self, areas=None):
+        if areas is not None:
+            areas = ",".join(areas)
+        return await self.query_json("routes", {"areas": areas})
+
+    async def stops(self, areas=None):
+        if areas is not None:
+            areas = ",".join(areas)
+        return await self.query_json("stops", {"areas": areas})
+
+    async def areas(self):
+        return await self.query_json("areas")
+
+    async def trip(self, t, trip_id: str, ro=None):
+        res = await self.query_json(f"trips/{trip_id}")
+        return TNBus.Trip(t, res, ro)
+
+    async def trips_new(self, search: (TNBus.Stop, TNBus.Route), time=None, limit=30):
+        return await self.query_json("trips_new", API.trips_new_args(search, time, limit))
+
+
+class _SyncAPI:
+    # the blocking API of the TNBus under an AsyncTNBus (refresh, load_areas, lazy loads): the calls of the AsyncAPI
+    # run on the loop, waited for from another thread. From the loop's own thread they'd block it: they're refused
+    def __init__(self, api: AsyncAPI, loop):
+        self.api = api
+        self.loop = loop
+
+    def _run(self, name, coro):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            coro.close()
+            raise RuntimeError(f"{name} would block the event loop: await the AsyncTNBus counterpart, or call it "
+                               f"from an executor")
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def areas(self):
+        return self._run("areas", self.api.areas())
+
+    def routes(self, areas=None):
+        return self._run("routes", self.api.routes(areas))
+
+    def stops(self, areas=None):
+        return self._run("stops", self.api.stops(areas))
+
+    def trips_new(self, search, time=None, limit=30):
+        return self._run("trips_new", self.api.trips_new(search, time, limit))
+
+
+class AsyncTNBus:
+    # asyncio counterpart of the trip-loading paths of TNBus, over the static network of a regular TNBus
+    def __init__(self, api: AsyncAPI, t: TNBus):
+        self.api = api
+        self.t = t
+
+    @classmethod
+    async def create(cls, api: AsyncAPI, **kwargs):
+        """
+        fetches areas, routes and stops concurrently (only the ones of areas, if given, or none when lazy, like
+        TNBus) and builds the underlying TNBus in an executor; kwargs are passed to TNBus.
+        The TNBus calls the api through the loop: its own refresh and load_areas, and the lazy loads of its get,
+        must be run from an executor (see AsyncTNBus.refresh and AsyncTNBus.load_areas)
+        """
+        if kwargs.get("stream") or kwargs.get("shared") is not None:
+            raise TypeError("AsyncTNBus builds the network from the fetched payloads: stream and shared can't be used")
+        areas, lazy = kwargs.get("areas"), kwargs.get("lazy")
+        scope = [getattr(a, "id", a) for a in areas or ()] if areas is not None or lazy else None
+        para = None if scope is None else [str(i) for i in scope]
+
+        async def nothing():
+            return []
+
+        areas, routes, stops = await asyncio.gather(
+            api.areas(), api.routes(para) if para != [] else nothing(), api.stops(para) if para != [] else nothing())
+        raw = {"areas": areas, "routes": routes, "stops": stops, "trips": [], "age": datetime.now().timestamp()}
+        if scope is not None:
+            raw["loaded"] = scope
+        loop = asyncio.get_running_loop()
+        return cls(api, await loop.run_in_executor(None, lambda: TNBus(_SyncAPI(api, loop), preload=raw, **kwargs)))
+
+    async def refresh(self):
+        # see TNBus.refresh
+        return await asyncio.get_running_loop().run_in_executor(None, self.t.refresh)
+
+    async def load_areas(self, areas=None):
+        # see TNBus.load_areas
+        return await asyncio.get_running_loop().run_in_executor(None, self.t.load_areas, areas)
+
+    async def load_area(self, area):
+        return await self.load_areas((area,))
+
+    def __getattr__(self, item):
+        # everything not related to the network is served by the underlying TNBus
+        if item == "t":
+            raise AttributeError(item)
+        return getattr(self.t, item)
+
+    async def load_trips(self, search, since=None, limit=1):
+        if not isinstance(search, (TNBus.Stop, TNBus.Route)):
+            raise TypeError(search)
+        data = await self.api.trips_new(search, since, limit)
+        # off the loop: storing waits for copies of a tnbus.live.Live version, and lazy loads of areas call the api
+        return await asyncio.get_running_loop().run_in_executor(None, self.t._store_trips, data, search)
+
+    async def load_best_trip(self, search, since=None):
+        res = await self.load_trips(search=search, since=since, limit=1)
+        for i in res:
+            if i.best:
+                return i
+        raise TypeError(res)
+
+    async def next_departures(self, stop, after=None, n=1, route=None, max_age=None):
+        # see TNBus.next_departures
+        max_age = self.t.DEPARTURES_MAX_AGE if max_age is None else max_age
+        if not self.t.departures.fresh(stop, max_age):
+            await self.load_trips(stop, after, max(n, 3))
+        return self.t.departures.next_departures(stop, after, n, route)
+
+    async def load_trips_many(self, searches, since=None, limit=1, concurrency=8, return_exceptions=False):
+        """
+        loads the trips of every stop or route in searches concurrently, at most concurrency requests at a time.
+        returns a list of results in the same order as searches
+        """
+        sem = asyncio.Semaphore(concurrency)
+
+        async def one(search):
+            async with sem:
+                return await self.load_trips(search, since, limit)
+
+        return await asyncio.gather(*(one(s_) for s_ in searches), return_exceptions=return_exceptions)
+
+    async def trip(self, trip_id: str, ro=None):
+        return await self.api.trip(self.t, trip_id, ro)
@@ -0,0 +1,186 @@
+import asyncio
+import threading
+from collections import OrderedDict, Counter
+from time import monotonic
+
+from . import metrics
+
+
+class ResponseCache:
+    """
+    Bounded LRU cache of decoded API responses with per-endpoint TTLs.
+    Concurrent identical misses are coalesced: a single upstream call is made and every waiter gets its result.
+    Cached responses are shared between callers, so they must not be mutated.
+    """
+    # seconds, by endpoint (the first segment of the call, so "trips/<id>" is "trips")
+    TTL = {
+        "areas": 24 * 3600,
+        "routes": 6 * 3600,
+        "stops": 6 * 3600,
+        "trips": 15,
+        "trips_new": 15
+    }
+    DEFAULT_TTL = 60
+    # time parameters are rounded down to QUANTUM seconds in the cache key, otherwise every trips_new call
+    # referring to "now" would be unique
+    TIME_PARAMS = ("refDateTime",)
+    QUANTUM = 15
+
+    class _Flight:
+        def __init__(self):
+            self.event = threading.Event()
+            self.value = None
+            self.error = None
+
+    def __init__(self, size=1024, ttl=None):
+        self.size = size
+        self.ttl = {**self.TTL, **(ttl or {})}
+        self.hits = Counter()
+        self.misses = Counter()
+        self.coalesced = Counter()
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._ainflight = {}
+
+    @staticmethod
+    def endpoint(call):
+        return call.split("/", 1)[0]
+
+    def _quantize(self, value):
+        try:
+            t_ = value[:19]
+            seconds = int(t_[17:19])
+            return f"{t_[:17]}{seconds - seconds % self.QUANTUM:02d}"
+        except (TypeError, ValueError):
+            return value
+
+    def key(self, call, para):
+        para = para or {}
+        return call, tuple(sorted(
+            (k, self._quantize(v) if k in self.TIME_PARAMS else v) for k, v in para.items() if v is not None
+        ))
+
+    def _lookup(self, key, now):
+        # to be called holding the lock
+        entry = self._data.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                self._data.move_to_end(key)
+                return True, entry[1]
+            del self._data[key]
+        return False, None
+
+    def _store(self, key, value, now):
+        # to be called holding the lock
+        self._data[key] = (now + self.ttl.get(self.endpoint(key[0]), self.DEFAULT_TTL), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.size:
+            self._data.popitem(last=False)
+
+    @staticmethod
+    def _count(counter, endpoint, result):
+        counter[endpoint] += 1
+        if metrics.sinks:
+            metrics.inc("cache_requests_total", endpoint=endpoint, result=result)
+
+    def get_or_fetch(self, call, para, fetch):
+        """
+        returns the cached response of call with para, calling fetch() on a miss
+        """
+        key = self.key(call, para)
+        endpoint = self.endpoint(call)
+        with self._lock:
+            hit, value = self._lookup(key, monotonic())
+            if hit:
+                self._count(self.hits, endpoint, "hit")
+                return value
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = self._Flight()
+                self._count(self.misses, endpoint, "miss")
+            else:
+                self._count(self.coalesced, endpoint, "coalesced")
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = fetch()
+            with self._lock:
+                self._store(key, flight.value, monotonic())
+            return flight.value
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            flight.event.set()
+
+    async def aget_or_fetch(self, call, para, fetch):
+        """
+        asyncio flavour of get_or_fetch, fetch being a coroutine function
+        """
+        key = self.key(call, para)
+        endpoint = self.endpoint(call)
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            hit, value = self._lookup(key, monotonic())
+            if hit:
+                self._count(self.hits, endpoint, "hit")
+                return value
+            fut = self._ainflight.get(key)
+            leader = fut is None or fut.get_loop() is not loop
+            if leader:
+                fut = self._ainflight[key] = loop.create_future()
+                self._count(self.misses, endpoint, "miss")
+            else:
+                self._count(self.coalesced, endpoint, "coalesced")
+
+        if not leader:
+            return await asyncio.shield(fut)
+
+        try:
+            value = await fetch()
+            with self._lock:
+                self._store(key, value, monotonic())
+            fut.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except Exception as e:
+            fut.set_exception(e)
+            # marks the exception as retrieved when nobody is waiting
+            fut.exception()
+            raise
+        finally:
+            with self._lock:
+                if self._ainflight.get(key) is fut:
+                    del self._ainflight[key]
+
+    def invalidate(self, call=None):
+        # drops the cached responses of an endpoint, or every response if call is None
+        with self._lock:
+            if call is None:
+                self._data.clear()
+            else:
+                endpoint = self.endpoint(call)
+                for k in [k for k in self._data if self.endpoint(k[0]) == endpoint]:
+                    del self._data[k]
+
+    def stats(self):
+        # hit/miss/coalesced counters by endpoint
+        with self._lock:
+            return {
+                e: {"hits": self.hits[e], "misses": self.misses[e], "coalesced": self.coalesced[e]}
+                for e in set(self.hits) | set(self.misses) | set(self.coalesced)
+            }
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,195 @@
+import threading
+from bisect import bisect_left
+from datetime import datetime, timezone
+from time import time as now_
+
+DAY = 86400
+
+
+class DepartureIndex:
+    """
+    Departures by stop, kept sorted by expected time (scheduled time + delay) and fed with every trip TNBus loads,
+    so that the next departures from a stop are found by bisection without asking the service.
+    A trip loaded again replaces its previous departures; departures in the past are evicted as time goes on.
+    Pickling keeps only the settings, since the trips belong to the session that loaded them.
+    """
+    # seconds a departure is kept after its expected time
+    GRACE = 120
+    # seconds between evictions
+    EVICT_EVERY = 30
+
+    def __init__(self, grace=None, clock=now_):
+        """
+        :param clock: returns the current timestamp
+        """
+        self.grace = self.GRACE if grace is None else grace
+        self.clock = clock
+        # (stop id_numeric, stop type) -> (sorted [expected timestamp], [trip id] in the same order)
+        self._stops = {}
+        # trip id -> [latest Trip, signature, [(stop key, expected timestamp)] of its current departures]
+        self._trips = {}
+        # stop key -> when the trips of the stop itself were last loaded
+        self._fed = {}
+        self._evicted = 0
+        # bumped by every change, so that connections knows when to sort them again
+        self._version = 0
+        self._connections = (None, [])
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {"grace": self.grace, "clock": self.clock}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __len__(self):
+        return sum(len(v_[0]) for v_ in self._stops.values())
+
+    @staticmethod
+    def key(stop):
+        return stop.id_numeric, stop.type
+
+    @staticmethod
+    def _departures(trip):
+        # (stop key, expected timestamp) of every stop of trip.
+        # stop times are bare UTC times of day: each one is placed on the day that puts it closest to the
+        # selected stop's scheduled arrival
+        anchor = trip.scheduled_arrive_time or trip.actual_arrive_time
+        if anchor is None:
+            return []
+        anchor = anchor.timestamp()
+        midnight = anchor - anchor % DAY
+        delay = (trip.delay or 0) * 60
+        out = []
+        for stop_id, type_, t_ in trip.stop_times():
+            ts = midnight + t_.hour * 3600 + t_.minute * 60 + t_.second
+            if ts - anchor > DAY / 2:
+                ts -= DAY
+            elif anchor - ts > DAY / 2:
+                ts += DAY
+            out.append(((stop_id, type_), ts + delay))
+        return out
+
+    @staticmethod
+    def _signature(trip):
+        # what the departures of a trip are computed from: polling the same trip again mostly yields the same one
+        return trip.scheduled_arrive_time, trip.actual_arrive_time, trip.delay, trip.start
+
+    def _discard(self, trip_id):
+        # to be called holding the lock
+        for key, ts in self._trips.pop(trip_id, (None, None, ()))[2]:
+            times, items = self._stops[key]
+            i_ = bisect_left(times, ts)
+            while items[i_] != trip_id:
+                i_ += 1
+            del times[i_], items[i_]
+            if not times:
+                del self._stops[key]
+
+    def add(self, trips, search=None, at=None):
+        """
+        indexes the departures of trips, loaded for search (a TNBus.Stop or TNBus.Route) at time at (a timestamp)
+        """
+        at = self.clock() if at is None else at
+        with self._lock:
+            for i in trips:
+                signature = self._signature(i)
+                entry = self._trips.get(i.id)
+                if entry is not None and entry[1] == signature:
+                    entry[0] = i
+                    continue
+                self._discard(i.id)
+                departures = self._departures(i)
+                for key, ts in departures:
+                    times, items = self._stops.setdefault(key, ([], []))
+                    n = bisect_left(times, ts)
+                    # among equal times, the trip added last goes last
+                    while n < len(times) and times[n] == ts:
+                        n += 1
+                    times.insert(n, ts)
+                    items.insert(n, i.id)
+                self._trips[i.id] = [i, signature, departures]
+                self._version += 1
+            if search is not None and hasattr(search, "id_numeric"):
+                self._fed[self.key(search)] = at
+            self._evict(at)
+
+    def _evict(self, now):
+        # to be called holding the lock
+        if now - self._evicted < self.EVICT_EVERY:
+            return
+        self._evicted = now
+        self._version += 1
+        before = now - self.grace
+        for key in list(self._stops):
+            times, items = self._stops[key]
+            n = bisect_left(times, before)
+            # a looping trip calls at the same stop more than once: its entry is filtered once for all of them
+            for trip_id in dict.fromkeys(items[:n]):
+                entry = self._trips.get(trip_id)
+                if entry is None:
+                    continue
+                entry[2] = [d_ for d_ in entry[2] if d_[0] != key or d_[1] >= before]
+                if not entry[2]:
+                    del self._trips[trip_id]
+            del times[:n], items[:n]
+            if not times:
+                del self._stops[key]
+
+    def evict(self, now=None):
+        """
+        drops the departures expected more than grace seconds before now
+        """
+        with self._lock:
+            self._evicted = 0
+            self._evict(self.clock() if now is None else now)
+
+    def connections(self):
+        """
+        the legs between consecutive stops of every trip, as a list of
+        (departure timestamp, arrival timestamp, from stop key, to stop key, trip id) sorted by departure
+        """
+        with self._lock:
+            version, out = self._connections
+            if version != self._version:
+                out = []
+                for trip_id, (_, _, departures) in self._trips.items():
+                    for (from_, dep), (to, arr) in zip(departures, departures[1:]):
+                        out.append((dep, arr, from_, to, trip_id))
+                out.sort(key=lambda c_: c_[0])
+                self._connections = (self._version, out)
+            return out
+
+    def trip(self, trip_id):
+        entry = self._trips.get(trip_id)
+        return entry[0] if entry is not None else None
+
+    def fresh(self, stop, max_age, now=None):
+        """
+        whether the trips of stop were loaded in the last max_age seconds
+        """
+        fed = self._fed.get(self.key(stop))
+        return fed is not None and (self.clock() if now is None else now) - fed <= max_age
+
+    def next_departures(self, stop, after=None, n=1, route=None):
+        """
+        the first n departures from stop expected at or after after (a datetime, now by default), optionally only
+        of route (a TNBus.Route, or its id, which matches the routes of every type with that id), as a list of
+        (expected datetime, trip) pairs
+        """
+        after = after.timestamp() if after is not None else self.clock()
+        route_type = getattr(route, "type", None)
+        route = getattr(route, "id", route)
+        out = []
+        with self._lock:
+            self._evict(self.clock())
+            times, items = self._stops.get(self.key(stop), ((), ()))
+            for i_ in range(bisect_left(times, after), len(times)):
+                trip = self._trips[items[i_]][0]
+                if route is not None and (trip.route.id != route or route_type is not None and
+                                          trip.route.type != route_type):
+                    continue
+                out.append((datetime.fromtimestamp(times[i_], timezone.utc), trip))
+                if len(out) == n:
+                    break
+        return out
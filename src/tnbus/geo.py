@@ -0,0 +1,147 @@
+from math import radians, sin, cos, asin, sqrt
+from geopy.distance import geodesic
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+EARTH_RADIUS = 6371.0088
+# haversine on the mean radius differs from the WGS-84 geodesic by less than 0.6%
+HAVERSINE_ERROR = 0.006
+
+
+def haversine(location, lats, lons):
+    """
+    distances in kilometers between location and every (lats[i], lons[i]), vectorized with numpy when available
+    """
+    lat0, lon0 = radians(location[0]), radians(location[1])
+    if np is not None:
+        lats = np.radians(np.asarray(lats, dtype=float))
+        lons = np.radians(np.asarray(lons, dtype=float))
+        a = np.sin((lats - lat0) / 2) ** 2 + cos(lat0) * np.cos(lats) * np.sin((lons - lon0) / 2) ** 2
+        return (2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1)))).tolist()
+
+    out = []
+    for lat, lon in zip(lats, lons):
+        lat, lon = radians(lat), radians(lon)
+        a = sin((lat - lat0) / 2) ** 2 + cos(lat0) * cos(lat) * sin((lon - lon0) / 2) ** 2
+        out.append(2 * EARTH_RADIUS * asin(sqrt(min(a, 1))))
+    return out
+
+
+class SpatialIndex:
+    # uniform lat/lon grid over objects exposing a (lat, lon) `location`.
+    # candidates are ranked by haversine, then the ones that could be reordered by the ellipsoid are refined
+    # with geopy's geodesic, so results and distances are the same as sorting by geodesic.
+    # queries keep all their state in locals, so they can run concurrently as long as nobody adds or removes objects
+    def __init__(self, cell=0.01):
+        self.cell = cell
+        self.cells = {}
+        # insertion order of every object, which breaks ties between equal distances
+        self.position = {}
+        self._added = 0
+        self.bounds = None
+
+    def __len__(self):
+        return len(self.position)
+
+    def _cell(self, location):
+        return int(location[0] // self.cell), int(location[1] // self.cell)
+
+    def add(self, obj):
+        c_ = self._cell(obj.location)
+        self.position[obj] = self._added
+        self._added += 1
+        self.cells.setdefault(c_, []).append(obj)
+        if self.bounds is None:
+            self.bounds = [c_[0], c_[0], c_[1], c_[1]]
+        else:
+            self.bounds = [min(self.bounds[0], c_[0]), max(self.bounds[1], c_[0]),
+                           min(self.bounds[2], c_[1]), max(self.bounds[3], c_[1])]
+
+    def remove(self, obj):
+        c_ = self._cell(obj.location)
+        self.cells[c_].remove(obj)
+        if not self.cells[c_]:
+            del self.cells[c_]
+        del self.position[obj]
+
+    def _ring(self, center, r):
+        ci, cj = center
+        if r == 0:
+            yield center
+            return
+        for j in range(cj - r, cj + r + 1):
+            yield ci - r, j
+            yield ci + r, j
+        for i in range(ci - r + 1, ci + r):
+            yield i, cj - r
+            yield i, cj + r
+
+    def _reach(self, location, r):
+        # lower bound of the distance between location and any point outside the first r rings
+        if r == 0:
+            return 0.
+        lat = min(abs(location[0]) + (r + 1) * self.cell, 89.)
+        return radians(r * self.cell) * EARTH_RADIUS * cos(radians(lat)) * (1 - HAVERSINE_ERROR)
+
+    def _covered(self, center, r):
+        b_ = self.bounds
+        return center[0] - r <= b_[0] and center[0] + r >= b_[1] and center[1] - r <= b_[2] and center[1] + r >= b_[3]
+
+    def _scan(self, location, done):
+        # expands rings around location until done(candidates, reach) is satisfied or the whole grid is covered
+        center = self._cell(location)
+        cand, dist = [], []
+        r = 0
+        while self.bounds is not None:
+            new = []
+            for c_ in self._ring(center, r):
+                if c_ in self.cells:
+                    new += self.cells[c_]
+            if new:
+                cand += new
+                dist += haversine(location, [o_.location[0] for o_ in new], [o_.location[1] for o_ in new])
+            if self._covered(center, r) or done(dist, self._reach(location, r)):
+                break
+            r += 1
+        return cand, dist
+
+    @staticmethod
+    def _refine(location, cand, dist, limit):
+        # geodesic distances for every candidate that, given the haversine error, could fall within limit
+        out = []
+        for o_, d_ in zip(cand, dist):
+            if d_ * (1 - HAVERSINE_ERROR) <= limit:
+                out.append((o_, geodesic(o_.location, location).kilometers))
+        return out
+
+    def nearest(self, location, num=10):
+        """
+        returns up to num (obj, km) pairs nearest to location, sorted by distance
+        """
+        if num <= 0:
+            return []
+
+        def kth(dist):
+            return sorted(dist)[num - 1] * (1 + HAVERSINE_ERROR)
+
+        cand, dist = self._scan(location, lambda d_, reach: len(d_) >= num and kth(d_) < reach)
+        if len(cand) > num:
+            limit = kth(dist)
+        else:
+            limit = float("inf")
+        out = self._refine(location, cand, dist, limit)
+        out.sort(key=lambda l: (l[1], self.position[l[0]]))
+        return out[:num]
+
+    def within(self, location, radius):
+        """
+        returns every (obj, km) pair within radius kilometers from location, sorted by distance
+        """
+        cand, dist = self._scan(location, lambda d_, reach: reach > radius)
+        out = [i_ for i_ in self._refine(location, cand, dist, radius) if i_[1] <= radius]
+        out.sort(key=lambda l: (l[1], self.position[l[0]]))
+        return out
@@ -0,0 +1,331 @@
+import json
+import os
+import struct
+import sys
+import threading
+from array import array
+from collections import Counter
+from datetime import datetime
+from math import isnan, nan
+from time import time as now_
+from pytz import timezone
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+MAGIC = b"TNBH"
+FORMAT = 1
+# magic, format, rows, new trip ids json length
+HEADER = struct.Struct("<4sHII")
+
+
+class HistoryError(Exception):
+    pass
+
+
+class History:
+    """
+    Append-only columnar store of trip observations, one row per Trip every time it's polled.
+    Rows are buffered in array-backed columns and written, SEGMENT_SIZE at a time, to append-only segment files
+    under path (kept in memory when path is None).
+    Delay distributions by route and by stop are maintained incrementally, by local hour of the scheduled arrival and
+    by day, as sparse histograms: delays are whole minutes, so quantiles computed from them are exact and queries
+    never go back to the rows. A trip counts once in them, with its latest delay (at each stop for the distributions by
+    stop), however often it's polled.
+    """
+    # name, array typecode; times are epoch seconds and nan when unknown, ints are -1 when unknown
+    COLUMNS = (
+        ("observed", "d"),
+        ("trip", "q"),  # position in trip_ids
+        ("route", "q"),
+        ("stop", "q"),  # numeric id of the stop the trips were loaded for, -1 when loaded for a route
+        ("scheduled", "d"),
+        ("actual", "d"),
+        ("delay", "d"),
+        ("sequence", "q"),
+        ("state", "b"),
+    )
+    SEGMENT_SIZE = 65536
+
+    def __init__(self, path=None, tz="Europe/Rome", window=28, segment_size=None):
+        """
+        :param path: directory of the segment files, created if missing; existing segments are loaded
+        :param tz: timezone of the hours and days aggregates are bucketed by
+        :param window: days of aggregates kept in memory
+        """
+        self.path = path
+        self.tz = timezone(tz)
+        self.window = window
+        self.segment_size = segment_size or self.SEGMENT_SIZE
+        self.trip_ids = []
+        self._trip_codes = {}
+        self._flushed_ids = 0
+        self._segments = []
+        self._rows = 0
+        self._head = self._columns()
+        # (kind, id, hour) -> {day ordinal: Counter(delay -> count)}
+        self._aggregates = {}
+        # (trip code, kind, id) -> (aggregate key, day, delay) the trip is currently counted under
+        self._counted = {}
+        self._last_day = None
+        self._lock = threading.RLock()
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            self._open()
+
+    def _columns(self):
+        return {n_: array(c_) for n_, c_ in self.COLUMNS}
+
+    def __len__(self):
+        return self._rows + len(self._head["observed"])
+
+    # segments
+
+    def _segment_path(self, n):
+        return os.path.join(self.path, f"{n:08d}.seg")
+
+    def _write(self, n, columns, ids):
+        ids = json.dumps(ids).encode()
+        tmp = f"{self._segment_path(n)}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(HEADER.pack(MAGIC, FORMAT, len(columns["observed"]), len(ids)))
+            for n_, _ in self.COLUMNS:
+                a_ = columns[n_]
+                if sys.byteorder != "little":
+                    a_ = array(a_.typecode, a_)
+                    a_.byteswap()
+                f.write(a_.tobytes())
+            f.write(ids)
+        os.replace(tmp, self._segment_path(n))
+
+    def _read(self, segment):
+        # columns of a segment, either kept in memory or read from its file
+        if not isinstance(segment, str):
+            return segment, []
+        with open(segment, "rb") as f:
+            data = f.read()
+        if len(data) < HEADER.size:
+            raise HistoryError(f"{segment}: truncated segment")
+        magic, fmt, rows, ids = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise HistoryError(f"{segment}: not a history segment")
+        if fmt != FORMAT:
+            raise HistoryError(f"{segment}: unsupported format {fmt}")
+        out = self._columns()
+        offset = HEADER.size
+        for n_, _ in self.COLUMNS:
+            size = rows * out[n_].itemsize
+            out[n_].frombytes(data[offset:offset + size])
+            if sys.byteorder != "little":
+                out[n_].byteswap()
+            offset += size
+        if len(data) != offset + ids:
+            raise HistoryError(f"{segment}: truncated segment")
+        return out, json.loads(data[offset:])
+
+    def _open(self):
+        names = sorted(n_ for n_ in os.listdir(self.path) if n_.endswith(".seg"))
+        for name in names:
+            segment = os.path.join(self.path, name)
+            columns, ids = self._read(segment)
+            for i_ in ids:
+                self._trip_codes[i_] = len(self.trip_ids)
+                self.trip_ids.append(i_)
+            self._segments.append(segment)
+            self._rows += len(columns["observed"])
+            self._aggregate(columns)
+        self._flushed_ids = len(self.trip_ids)
+
+    def flush(self):
+        """
+        writes the buffered rows as a new segment
+        """
+        with self._lock:
+            if not len(self._head["observed"]):
+                return
+            if self.path is None:
+                self._segments.append(self._head)
+            else:
+                n = len(self._segments)
+                self._write(n, self._head, self.trip_ids[self._flushed_ids:])
+                self._segments.append(self._segment_path(n))
+            self._flushed_ids = len(self.trip_ids)
+            self._rows += len(self._head["observed"])
+            self._head = self._columns()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    # recording
+
+    @staticmethod
+    def _ts(dt):
+        return dt.timestamp() if dt is not None else nan
+
+    def record(self, trips, stop=None, observed=None):
+        """
+        appends an observation of every trip in trips, as loaded for stop (a TNBus.Stop, or None for a route)
+        """
+        observed = now_() if observed is None else observed
+        stop = stop.id_numeric if stop is not None else -1
+        with self._lock:
+            h_ = self._head
+            start = len(h_["observed"])
+            for i in trips:
+                code = self._trip_codes.get(i.id)
+                if code is None:
+                    code = self._trip_codes[i.id] = len(self.trip_ids)
+                    self.trip_ids.append(i.id)
+                h_["observed"].append(observed)
+                h_["trip"].append(code)
+                h_["route"].append(i.route.id)
+                h_["stop"].append(stop)
+                h_["scheduled"].append(self._ts(i.scheduled_arrive_time))
+                h_["actual"].append(self._ts(i.actual_arrive_time))
+                h_["delay"].append(i.delay if i.delay is not None else nan)
+                h_["sequence"].append(i.last_sequence_detection if i.last_sequence_detection is not None else -1)
+                h_["state"].append(i.state)
+            self._aggregate(h_, start)
+            if len(h_["observed"]) >= self.segment_size:
+                self.flush()
+
+    # aggregates
+
+    def _bucket(self, ts):
+        dt = datetime.fromtimestamp(ts, self.tz)
+        return dt.hour, dt.toordinal()
+
+    def _aggregate(self, columns, start=0):
+        for r_ in range(start, len(columns["observed"])):
+            delay = columns["delay"][r_]
+            if isnan(delay):
+                continue
+            ts = columns["scheduled"][r_]
+            hour, day = self._bucket(columns["observed"][r_] if isnan(ts) else ts)
+            trip = columns["trip"][r_]
+            for key in (("route", columns["route"][r_], hour), ("stop", columns["stop"][r_], hour)):
+                if key[1] == -1:
+                    continue
+                # the previous observation of the trip is replaced
+                old = self._counted.get((trip, key[0], key[1]))
+                if old is not None:
+                    self._uncount(*old)
+                self._aggregates.setdefault(key, {}).setdefault(day, Counter())[int(delay)] += 1
+                self._counted[(trip, key[0], key[1])] = (key, day, int(delay))
+            if self._last_day is None or day > self._last_day:
+                self._last_day = day
+                self._evict(day - self.window)
+
+    def _uncount(self, key, day, delay):
+        days = self._aggregates.get(key)
+        if days is None or day not in days:
+            return
+        c_ = days[day]
+        c_[delay] -= 1
+        if c_[delay] <= 0:
+            del c_[delay]
+            if not c_:
+                del days[day]
+                if not days:
+                    del self._aggregates[key]
+
+    def _evict(self, before):
+        for key in list(self._aggregates):
+            days = self._aggregates[key]
+            for d_ in [d_ for d_ in days if d_ <= before]:
+                del days[d_]
+            if not days:
+                del self._aggregates[key]
+        self._counted = {k: v_ for k, v_ in self._counted.items() if v_[1] > before}
+
+    @staticmethod
+    def _quantiles(values, counts, quantiles):
+        # nearest-rank quantiles of the distribution described by the (values, counts) histogram
+        if np is not None:
+            values, counts = np.asarray(values), np.asarray(counts)
+            order = np.argsort(values)
+            values, cum = values[order], np.cumsum(counts[order])
+            n = int(cum[-1])
+            total = float(np.dot(values, counts[order]))
+            ranks = np.maximum(np.ceil(np.asarray(quantiles, dtype=float) * n), 1)
+            return n, total / n, values[np.searchsorted(cum, ranks)].tolist()
+
+        pairs = sorted(zip(values, counts))
+        n = sum(counts)
+        total = sum(v_ * c_ for v_, c_ in pairs)
+        out = []
+        for q_ in quantiles:
+            rank, cum = max(-(-q_ * n // 1), 1), 0
+            for v_, c_ in pairs:
+                cum += c_
+                if cum >= rank:
+                    out.append(v_)
+                    break
+        return n, total / n, out
+
+    def delays(self, route=None, stop=None, hour=None, days=7, day=None, quantiles=(.5, .9)):
+        """
+        delay distribution, in minutes, of the trips of route (or at stop) over the last days days up to day
+        (a date, today by default), optionally only for those scheduled within a local hour of the day.
+        returns {"count": n, "mean": mean, "quantiles": {q: value}}, n being a number of trips, or None without
+        observations
+        """
+        if (route is None) == (stop is None):
+            raise TypeError("exactly one of route and stop must be given")
+        if route is not None:
+            key = ("route", getattr(route, "id", route))
+        else:
+            key = ("stop", getattr(stop, "id_numeric", stop))
+        last = (day or datetime.now(self.tz)).toordinal()
+        hours = range(24) if hour is None else (hour,)
+        hist = Counter()
+        with self._lock:
+            for h_ in hours:
+                for d_, c_ in self._aggregates.get(key + (h_,), {}).items():
+                    if last - days < d_ <= last:
+                        hist.update(c_)
+        if not hist:
+            return None
+        n, mean, values = self._quantiles(list(hist.keys()), list(hist.values()), quantiles)
+        return {"count": n, "mean": mean, "quantiles": dict(zip(quantiles, values))}
+
+    # rows
+
+    def rows(self, since=None, until=None):
+        """
+        every recorded row observed between since and until (datetimes or epoch seconds), as a dict of columns:
+        numpy arrays when numpy is available, array.array otherwise
+        """
+        since = since.timestamp() if isinstance(since, datetime) else since
+        until = until.timestamp() if isinstance(until, datetime) else until
+        with self._lock:
+            # the head keeps growing once the lock is released: its columns are copied
+            parts = [self._read(s_)[0] for s_ in self._segments] + \
+                [{n_: array(c_.typecode, c_) for n_, c_ in self._head.items()}]
+        if np is not None:
+            out = {n_: np.concatenate([np.frombuffer(p_[n_], dtype=p_[n_].typecode) for p_ in parts])
+                   for n_, _ in self.COLUMNS}
+            mask = np.ones(len(out["observed"]), dtype=bool)
+            if since is not None:
+                mask &= out["observed"] >= since
+            if until is not None:
+                mask &= out["observed"] < until
+            return {n_: a_[mask] for n_, a_ in out.items()}
+
+        out = self._columns()
+        for p_ in parts:
+            for r_ in range(len(p_["observed"])):
+                o_ = p_["observed"][r_]
+                if (since is None or o_ >= since) and (until is None or o_ < until):
+                    for n_, _ in self.COLUMNS:
+                        out[n_].append(p_[n_][r_])
+        return out
@@ -0,0 +1,239 @@
+import threading
+from bisect import bisect_left
+from heapq import heappush, heapreplace
+from time import time as now_
+
+INF = float("inf")
+
+
+class JourneyIndex:
+    """
+    Stop patterns of the routes, learned from the trips TNBus loads: the ordered (stop id_numeric, stop type) keys a
+    trip of the route visits, plus the inverted index key -> (pattern, position). Routes with several directions or
+    variants get a pattern each. Routes are told by (route id, route type), since ids are only unique within a type.
+    A trip loaded again with other stop times moves to its new pattern; trips not loaded for keep seconds are
+    forgotten, and so are the patterns no trip follows anymore.
+    Direct and one-transfer lines between two stops are looked up on the patterns; earliest arrivals are computed by a
+    connection scan over the departures of the loaded trips (see DepartureIndex.connections).
+    """
+    # seconds a trip is kept after it was last loaded
+    KEEP = 86400
+    # seconds between evictions
+    EVICT_EVERY = 60
+
+    def __init__(self, keep=None, clock=now_):
+        """
+        :param clock: returns the current timestamp
+        """
+        self.keep = self.KEEP if keep is None else keep
+        self.clock = clock
+        # pattern (tuple of stop keys) -> pattern id
+        self._ids = {}
+        self._patterns = []
+        # (route id, route type) of every pattern, by pattern id
+        self._routes = []
+        # stop key -> [(pattern id, position)]
+        self._stops = {}
+        # trip id -> [pattern id, when it was last loaded]
+        self._trips = {}
+        # trips following every pattern, by pattern id
+        self._counts = []
+        self._evicted = 0
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._patterns)
+
+    def add(self, trips, at=None):
+        """
+        learns the patterns of trips, loaded at time at (a timestamp)
+        """
+        at = self.clock() if at is None else at
+        with self._lock:
+            orphaned = False
+            for i in trips:
+                pattern = tuple((stop_id, type_) for stop_id, type_, _ in i.stop_times())
+                route = (i.route.id, i.route.type)
+                pid = self._ids.get((route, pattern))
+                if pid is None:
+                    pid = self._ids[(route, pattern)] = len(self._patterns)
+                    self._patterns.append(pattern)
+                    self._routes.append(route)
+                    self._counts.append(0)
+                    for n, key in enumerate(pattern):
+                        self._stops.setdefault(key, []).append((pid, n))
+                entry = self._trips.get(i.id)
+                if entry is None:
+                    self._trips[i.id] = [pid, at]
+                    self._counts[pid] += 1
+                    continue
+                entry[1] = at
+                if entry[0] != pid:
+                    # its stop times changed
+                    self._counts[entry[0]] -= 1
+                    orphaned = orphaned or not self._counts[entry[0]]
+                    self._counts[pid] += 1
+                    entry[0] = pid
+            if not self._evict(at) and orphaned:
+                self._compact()
+
+    def _evict(self, now):
+        # to be called holding the lock; whether it compacted the patterns
+        if now - self._evicted < self.EVICT_EVERY:
+            return False
+        self._evicted = now
+        before = now - self.keep
+        for trip_id in [k for k, v_ in self._trips.items() if v_[1] < before]:
+            self._counts[self._trips.pop(trip_id)[0]] -= 1
+        if all(self._counts):
+            return False
+        self._compact()
+        return True
+
+    def evict(self, now=None):
+        """
+        forgets the trips loaded more than keep seconds before now, and the patterns left without trips
+        """
+        with self._lock:
+            self._evicted = 0
+            self._evict(self.clock() if now is None else now)
+
+    def _compact(self):
+        # drops the patterns without trips, renumbering the others; to be called holding the lock
+        renumber = {}
+        patterns, routes, counts = [], [], []
+        for pid, (p_, r_, c_) in enumerate(zip(self._patterns, self._routes, self._counts)):
+            if c_:
+                renumber[pid] = len(patterns)
+                patterns.append(p_)
+                routes.append(r_)
+                counts.append(c_)
+        self._patterns, self._routes, self._counts = patterns, routes, counts
+        self._ids = {(r_, p_): pid for pid, (p_, r_) in enumerate(zip(patterns, routes))}
+        self._stops = {}
+        for pid, p_ in enumerate(patterns):
+            for n, key in enumerate(p_):
+                self._stops.setdefault(key, []).append((pid, n))
+        for entry in self._trips.values():
+            entry[0] = renumber[entry[0]]
+
+    def patterns(self, route):
+        """
+        the stop patterns (lists of stop keys) of route: a TNBus.Route, its (id, type) or its id, which matches the
+        routes of every type with that id
+        """
+        if hasattr(route, "id"):
+            route = (route.id, route.type)
+        return [list(p_) for p_, r_ in zip(self._patterns, self._routes) if r_ == route or r_[0] == route]
+
+    def direct(self, a, b):
+        """
+        the routes going from stop key a to stop key b, as a list of ((route id, route type), stops travelled) pairs,
+        fewest first
+        """
+        after_b = {}
+        for pid, j in self._stops.get(b, ()):
+            after_b.setdefault(pid, []).append(j)
+        best = {}
+        for pid, i in self._stops.get(a, ()):
+            for j in after_b.get(pid, ()):
+                r_ = self._routes[pid]
+                if j > i and j - i < best.get(r_, INF):
+                    best[r_] = j - i
+        return sorted(best.items(), key=lambda i_: i_[1])
+
+    def one_transfer(self, a, b, n=10):
+        """
+        the first n ways of going from stop key a to stop key b changing line once, as a list of
+        (first (route id, route type), transfer stop key, second (route id, route type), stops travelled), fewest
+        stops first
+        """
+        # stop key -> {(route id, route type): fewest stops travelled} from a without changing, and to b without
+        # changing
+        reach, back = self._reach(a, b, 1), self._reach(b, a, -1)
+        if n <= 0:
+            return []
+        # the n best so far, as a heap of (-stops travelled, -order found, way): the worst one is the first
+        best, found = [], 0
+        for key, firsts in reach.items():
+            seconds = back.get(key)
+            if seconds is None:
+                continue
+            seconds = sorted(seconds.items(), key=lambda i_: i_[1])
+            for first, h1 in sorted(firsts.items(), key=lambda i_: i_[1]):
+                if len(best) == n and h1 + seconds[0][1] >= -best[0][0]:
+                    break
+                for second, h2 in seconds:
+                    if len(best) == n and h1 + h2 >= -best[0][0]:
+                        break
+                    if first != second:
+                        way = (-h1 - h2, -found, (first, key, second, h1 + h2))
+                        found += 1
+                        if len(best) < n:
+                            heappush(best, way)
+                        else:
+                            heapreplace(best, way)
+        return [i_[2] for i_ in sorted(best, reverse=True)]
+
+    def _reach(self, a, skip, step):
+        # the stops after (step 1) or before (step -1) a on its patterns, but a and skip
+        out = {}
+        for pid, i in self._stops.get(a, ()):
+            p_, r_ = self._patterns[pid], self._routes[pid]
+            for k in range(i + step, len(p_) if step > 0 else -1, step):
+                key = p_[k]
+                if key == a or key == skip:
+                    continue
+                hops = (k - i) * step
+                d_ = out.setdefault(key, {})
+                if hops < d_.get(r_, INF):
+                    d_[r_] = hops
+        return out
+
+    @staticmethod
+    def earliest_arrival(connections, a, b, after, transfer=0):
+        """
+        connection scan over connections (see DepartureIndex.connections) for the earliest arrival at stop key b
+        leaving stop key a at or after timestamp after, changing trips in at least transfer seconds.
+        returns the legs of the journey as (trip id, from key, departure timestamp, to key, arrival timestamp), or
+        None if b can't be reached
+        """
+        # when a stop is reached, and when a trip can be boarded there
+        arrival = {a: after}
+        ready = {a: after}
+        # trip id -> index of the connection the trip was boarded at
+        boarded = {}
+        # stop key -> (boarding connection, alighting connection) of the leg that reaches it first
+        legs = {}
+        # (after,) sorts before the connections leaving at after and after the ones leaving earlier
+        for n_ in range(bisect_left(connections, (after,)), len(connections)):
+            dep, arr, from_, to, trip_id = connections[n_]
+            if dep >= arrival.get(b, INF):
+                break
+            if trip_id not in boarded:
+                if ready.get(from_, INF) > dep:
+                    continue
+                boarded[trip_id] = n_
+            if arr < arrival.get(to, INF):
+                arrival[to] = arr
+                ready[to] = arr + transfer
+                legs[to] = (boarded[trip_id], n_)
+        if b not in legs:
+            return
+        out = []
+        key = b
+        while key != a:
+            i_, j_ = legs[key]
+            out.append((connections[i_][4], connections[i_][2], connections[i_][0], key, connections[j_][1]))
+            key = connections[i_][2]
+        return out[::-1]
+
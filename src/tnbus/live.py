@@ -0,0 +1,120 @@
+import threading
+
+from . import metrics
+from .snapshot import _dumps, _loads
+from .tnbus import TNBus
+
+
+class Live:
+    """
+    Versions of a TNBus for concurrent readers: the published version is frozen (see TNBus.frozen) and never changes
+    again, every change is made to a copy of it, which is then published by swapping a single reference.
+    Readers take current once per request and keep using it, without locks: a reload never makes them wait nor
+    shows them a half-linked network. Writers are serialized.
+
+    Frozen only covers the network: trips keep being loaded into the version that loads them, through
+    TNBus.load_trips, under the lock copies are taken with; that lock, the departure and journey indexes and the
+    history are shared by every version.
+    """
+    def __init__(self, t: TNBus):
+        if t.shared is not None:
+            raise TypeError("a TNBus attached to a shared network can't be copied")
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._version = (0, None)
+        self._publish(t)
+
+    @property
+    def current(self):
+        return self._version[1]
+
+    @property
+    def version(self):
+        return self._version[0]
+
+    def snapshot(self):
+        # the (version number, TNBus) pair currently published
+        return self._version
+
+    def _publish(self, t):
+        t.frozen = True
+        self._version = (self._version[0] + 1, t)
+
+    def copy(self):
+        """
+        a writable copy of the current version, with the same api, history, departure and journey indexes
+        """
+        cur = self.current
+        with metrics.timer("build_seconds", phase="copy"):
+            # readers keep loading trips into cur
+            with cur._loading:
+                payload = _dumps(cur)
+            out = _loads(payload)
+        out.api = cur.api
+        out.history = cur.history
+        out.departures = cur.departures
+        out.journeys = cur.journeys
+        # the shared indexes are fed by every version: so is the lock
+        out._loading = cur._loading
+        return out
+
+    def update(self, apply):
+        """
+        calls apply(t) on a copy of the current version, then publishes the copy; returns it
+        """
+        with self._lock:
+            new = self.copy()
+            apply(new)
+            self._publish(new)
+            return new
+
+    def replace(self, t: TNBus):
+        # publishes t, built elsewhere (say from scratch), in place of the current version
+        with self._lock:
+            cur = self.current
+            t.departures = cur.departures
+            t.journeys = cur.journeys
+            t._loading = cur._loading
+            if t.history is None:
+                t.history = cur.history
+            self._publish(t)
+
+    def refresh(self):
+        """
+        like TNBus.refresh, applied to a copy that is then published. Nothing is copied nor published when no payload
+        changed
+        """
+        with self._lock:
+            payloads = self.current._fetch_changes()
+            if all(p_ is None for p_ in payloads.values()):
+                return {call: (0, 0, 0) for call in payloads}
+            new = self.copy()
+            out = new._apply_changes(payloads)
+            self._publish(new)
+            return out
+
+    def run(self, interval, on_error=None):
+        """
+        refreshes every interval seconds until stop() is called; on_error(exception) is called when a refresh fails
+        """
+        while not self._stop.wait(interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                if on_error is None:
+                    raise
+                on_error(e)
+
+    def start(self, interval, on_error=None):
+        # runs the refreshes in a daemon thread
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, args=(interval, on_error), name="tnbus-live", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
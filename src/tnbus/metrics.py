@@ -0,0 +1,190 @@
+"""
+Instrumentation of the library: counters and histograms reported to the attached sinks.
+
+Nothing is measured until a sink is attached, every instrumented path checks `metrics.sinks` first:
+
+    from tnbus import metrics
+    m = metrics.attach(metrics.Metrics())
+    ...
+    print(m.prometheus())
+
+A sink is any object with inc(name, value, labels) and observe(name, value, labels) methods, labels being a dict.
+Metrics is the bundled one: it aggregates in memory and exports the Prometheus text format.
+"""
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+
+PREFIX = "tnbus_"
+
+sinks = []
+
+
+def attach(sink):
+    if sink not in sinks:
+        sinks.append(sink)
+    return sink
+
+
+def detach(sink):
+    if sink in sinks:
+        sinks.remove(sink)
+
+
+def inc(name, value=1, **labels):
+    for s_ in sinks:
+        s_.inc(name, value, labels)
+
+
+def observe(name, value, **labels):
+    for s_ in sinks:
+        s_.observe(name, value, labels)
+
+
+def _number(v):
+    # exact: rounding to a few digits would freeze large counters and break rate()
+    if isinstance(v, int) or float(v).is_integer() and abs(v) < 2 ** 53:
+        return str(int(v))
+    return repr(float(v))
+
+
+class timer:
+    """
+    context manager observing the seconds spent in its block as name (a histogram), when there are sinks
+    """
+    __slots__ = ("name", "labels", "start")
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        if sinks:
+            self.start = perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        if self.start is not None and sinks:
+            observe(self.name, perf_counter() - self.start, **self.labels)
+
+
+class Metrics:
+    """
+    In-memory sink: sums counters and buckets observations, by name and labels
+    """
+    SECONDS_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+    BYTES_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+    def __init__(self, buckets=None):
+        """
+        :param buckets: {name: upper bounds} overriding the default buckets, which depend on the name's unit suffix
+        """
+        self.buckets = buckets or {}
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def _bounds(self, name):
+        if name in self.buckets:
+            return self.buckets[name]
+        return self.BYTES_BUCKETS if name.endswith("_bytes") else self.SECONDS_BUCKETS
+
+    def inc(self, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            h_ = self.histograms.get(key)
+            if h_ is None:
+                bounds = self._bounds(name)
+                h_ = self.histograms[key] = [bounds, [0] * (len(bounds) + 1), 0., 0]
+            h_[1][bisect_left(h_[0], value)] += 1
+            h_[2] += value
+            h_[3] += 1
+
+    def counter(self, name, **labels):
+        # the value of a counter, summed over the labels not given
+        with self._lock:
+            return sum(v_ for (n_, l_), v_ in self.counters.items()
+                       if n_ == name and all(dict(l_).get(k) == v for k, v in labels.items()))
+
+    def histogram(self, name, **labels):
+        # (count, sum) of a histogram, summed over the labels not given
+        count, total = 0, 0.
+        with self._lock:
+            for (n_, l_), h_ in self.histograms.items():
+                if n_ == name and all(dict(l_).get(k) == v for k, v in labels.items()):
+                    count += h_[3]
+                    total += h_[2]
+        return count, total
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return ""
+        out = []
+        for k, v in labels:
+            v = str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+            out.append(f"{k}=\"{v}\"")
+        return "{" + ",".join(out) + "}"
+
+    def prometheus(self):
+        """
+        the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda i: i[0])
+        name = None
+        for (n_, l_), v_ in counters:
+            if n_ != name:
+                name = n_
+                lines.append(f"# TYPE {PREFIX}{n_} counter")
+            lines.append(f"{PREFIX}{n_}{self._labels(l_)} {_number(v_)}")
+        name = None
+        for (n_, l_), (bounds, counts, total, count) in histograms:
+            if n_ != name:
+                name = n_
+                lines.append(f"# TYPE {PREFIX}{n_} histogram")
+            cum = 0
+            for b_, c_ in zip(bounds, counts):
+                cum += c_
+                lines.append(f"{PREFIX}{n_}_bucket{self._labels(l_, (('le', _number(b_)),))} {cum}")
+            lines.append(f"{PREFIX}{n_}_bucket{self._labels(l_, (('le', '+Inf'),))} {count}")
+            lines.append(f"{PREFIX}{n_}_sum{self._labels(l_)} {_number(total)}")
+            lines.append(f"{PREFIX}{n_}_count{self._labels(l_)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, address=""):
+        """
+        serves prometheus() over http from a daemon thread; returns the server, to be shutdown()
+        """
+        metrics_ = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics_.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *_):
+                pass
+
+        server = ThreadingHTTPServer((address, port), Handler)
+        threading.Thread(target=server.serve_forever, name="tnbus-metrics", daemon=True).start()
+        return server
@@ -0,0 +1,191 @@
+import heapq
+import threading
+from datetime import datetime
+from itertools import count
+from random import uniform
+from time import monotonic
+
+from .tnbus import TNBus, UTC
+
+
+class Monitor:
+    """
+    Polls the trips of a set of stops or routes, each on its own schedule: the next poll of a search is due after a
+    fraction of the time left to its first arrival, so imminent buses are refreshed often and far ones rarely.
+    Subscribers get the trips of every poll. All the polls share a request budget.
+    """
+    # fraction of the time left to an arrival a search is polled again after, by trip state: once a bus has departed
+    # its delay keeps changing, before that the schedule is all there is
+    FRACTION = {TNBus.Trip.DEPARTED: .25, TNBus.Trip.NOT_DEPARTED: .5}
+
+    def __init__(self, t, searches=(), limit=3, min_interval=10, max_interval=300, jitter=.1, budget=None, period=60,
+                 on_error=None, clock=monotonic):
+        """
+        :param t: the TNBus (or AsyncTNBus's underlying TNBus) trips are loaded with
+        :param limit: trips loaded per poll
+        :param jitter: relative random spread of every interval, so that polls don't line up
+        :param budget: at most budget requests every period seconds, polls are postponed when it's used up
+        :param on_error: called with (search, exception) when a poll fails, the search is then retried with backoff
+        """
+        self.t = t
+        self.limit = limit
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.budget = budget
+        self.period = period
+        self.on_error = on_error
+        self.clock = clock
+        self.requests = 0
+        self.errors = 0
+        self._tokens = budget
+        self._refill = clock()
+        self._heap = []
+        # search -> sequence number of its live heap entry; removed searches leave stale entries, skipped when popped
+        self._entries = {}
+        self._failures = {}
+        self._subscribers = []
+        self._seq = count()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        for s_ in searches:
+            self.add(s_)
+
+    def add(self, search, delay=0):
+        if not isinstance(search, (TNBus.Stop, TNBus.Route)):
+            raise TypeError(search)
+        with self._lock:
+            self._schedule(search, self.clock() + delay)
+        self._wake.set()
+
+    def remove(self, search):
+        with self._lock:
+            self._entries.pop(search, None)
+            self._failures.pop(search, None)
+
+    def __contains__(self, search):
+        return search in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def subscribe(self, callback, search=None):
+        """
+        callback(search, trips) is called after every poll of search, or of any search if search is None
+        """
+        with self._lock:
+            self._subscribers.append((callback, search))
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._subscribers = [i_ for i_ in self._subscribers if i_[0] is not callback]
+
+    def _schedule(self, search, due):
+        # to be called holding the lock
+        seq = next(self._seq)
+        self._entries[search] = seq
+        heapq.heappush(self._heap, (due, seq, search))
+
+    def interval(self, trips, now=None):
+        """
+        seconds until the next poll of a search whose last poll returned trips
+        """
+        now = now or datetime.now(UTC)
+        out = self.max_interval
+        for i in trips:
+            fraction = self.FRACTION.get(i.state)
+            arrival = i.actual_arrive_time or i.scheduled_arrive_time
+            if fraction is None or arrival is None:
+                continue
+            out = min(out, (arrival - now).total_seconds() * fraction)
+        out = min(max(out, self.min_interval), self.max_interval)
+        return out * uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _take(self, now):
+        # to be called holding the lock: spends a request of the budget, or returns when the next one is available
+        if self.budget is None:
+            return 0
+        self._tokens = min(self.budget, self._tokens + (now - self._refill) * self.budget / self.period)
+        self._refill = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) * self.period / self.budget
+
+    def next_due(self):
+        # time of the next poll on the monitor's clock, None if there's nothing to poll
+        with self._lock:
+            while self._heap and self._entries.get(self._heap[0][2]) != self._heap[0][1]:
+                heapq.heappop(self._heap)
+            return self._heap[0][0] if self._heap else None
+
+    def step(self):
+        """
+        runs the poll that is due, if any; returns the search polled, or None
+        """
+        with self._lock:
+            now = self.clock()
+            while self._heap and self._entries.get(self._heap[0][2]) != self._heap[0][1]:
+                heapq.heappop(self._heap)
+            if not self._heap or self._heap[0][0] > now:
+                return
+            wait = self._take(now)
+            if wait:
+                due, seq, search = heapq.heappop(self._heap)
+                self._schedule(search, now + wait)
+                return
+            _, _, search = heapq.heappop(self._heap)
+            # the search stays in _entries, so removing it while it's polled drops the result
+            seq = self._entries[search]
+            self.requests += 1
+
+        try:
+            trips = self.t.load_trips(search, None, self.limit)
+        except Exception as e:
+            with self._lock:
+                self.errors += 1
+                if self._entries.get(search) == seq:
+                    failures = self._failures[search] = self._failures.get(search, 0) + 1
+                    self._schedule(search, self.clock() + min(self.min_interval * 2 ** failures, self.max_interval))
+            if self.on_error is not None:
+                self.on_error(search, e)
+            return search
+
+        with self._lock:
+            if self._entries.get(search) != seq:
+                return search
+            self._failures.pop(search, None)
+            self._schedule(search, self.clock() + self.interval(trips))
+            subscribers = [c_ for c_, s_ in self._subscribers if s_ is None or s_ is search]
+        for c_ in subscribers:
+            c_(search, trips)
+        return search
+
+    def run(self):
+        """
+        polls until stop() is called
+        """
+        while not self._stop.is_set():
+            self._wake.clear()
+            due = self.next_due()
+            wait = None if due is None else due - self.clock()
+            if wait is None or wait > 0:
+                self._wake.wait(wait)
+                continue
+            self.step()
+
+    def start(self):
+        # runs the monitor in a daemon thread
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="tnbus-monitor", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
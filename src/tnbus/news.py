@@ -0,0 +1,124 @@
+INF = float("inf")
+
+
+class IntervalTree:
+    """
+    Static centered interval tree over half-open [start, end) intervals of numbers: the items whose interval contains
+    a point are found in O(log n + matches). None as start or end is an open bound.
+    """
+    __slots__ = ("center", "by_start", "by_end", "left", "right")
+
+    def __init__(self, intervals):
+        """
+        :param intervals: (start, end, item) triples
+        """
+        intervals = [(-INF if s_ is None else s_, INF if e_ is None else e_, i_) for s_, e_, i_ in intervals]
+        # empty intervals contain no point
+        self._build([i_ for i_ in intervals if i_[0] < i_[1]])
+
+    def _build(self, intervals):
+        # the intervals containing the lower median endpoint stay here, the ones before and after it go left and
+        # right: the lower median is contained by at least an interval or splits them, so every level makes progress
+        points = sorted(p_ for s_, e_, _ in intervals for p_ in (s_, e_))
+        self.center = points[(len(points) - 1) // 2] if points else 0
+        here, left, right = [], [], []
+        for i_ in intervals:
+            if i_[1] <= self.center:
+                left.append(i_)
+            elif i_[0] > self.center:
+                right.append(i_)
+            else:
+                here.append(i_)
+        self.by_start = sorted(here, key=lambda i_: i_[0])
+        self.by_end = sorted(here, key=lambda i_: i_[1], reverse=True)
+        self.left = self._child(left)
+        self.right = self._child(right)
+
+    @classmethod
+    def _child(cls, intervals):
+        if not intervals:
+            return
+        out = cls.__new__(cls)
+        out._build(intervals)
+        return out
+
+    def at(self, point):
+        """
+        the items whose interval contains point
+        """
+        out = []
+        node = self
+        while node is not None:
+            if point < node.center:
+                for s_, _, i_ in node.by_start:
+                    if s_ > point:
+                        break
+                    out.append(i_)
+                node = node.left
+            else:
+                for _, e_, i_ in node.by_end:
+                    if e_ <= point:
+                        break
+                    out.append(i_)
+                node = node.right
+        return out
+
+
+class NewsIndex:
+    """
+    The news of a TNBus by route (id, type), route id, stop id_numeric and area id, each set of them in an
+    IntervalTree over the [start, end) window the news is active in. Route ids are only unique within a type: a bare
+    id matches the routes of every type. Trees are built on first use: TNBus builds a new index whenever the news of
+    its routes may have changed
+    """
+    ALL = ("all", None)
+
+    def __init__(self, news):
+        self._by = {self.ALL: list(news)}
+        for n_ in news:
+            for key in (("route", (n_.route.id, n_.route.type)), ("route", n_.route.id), ("stop", n_.stop_id),
+                        ("area", n_.area.id)):
+                if key[1] is not None:
+                    self._by.setdefault(key, []).append(n_)
+        self._trees = {}
+
+    def __len__(self):
+        return len(self._by[self.ALL])
+
+    def news(self, route=None, stop=None, area=None):
+        # the news of route (id, type) or id, stop id_numeric and area id when given, in the order of TNBus.news
+        return self._filter(self._by.get(self._key(route, stop, area), []), route, stop, area)
+
+    def _key(self, route, stop, area):
+        if route is not None:
+            return "route", route
+        if stop is not None:
+            return "stop", stop
+        if area is not None:
+            return "area", area
+        return self.ALL
+
+    def active(self, at, route=None, stop=None, area=None):
+        """
+        the news active at timestamp at, of route (id, type) or id, stop id_numeric and area id when given, in the
+        order of TNBus.news
+        """
+        key = self._key(route, stop, area)
+        tree = self._trees.get(key)
+        if tree is None:
+            news = self._by.get(key)
+            if news is None:
+                return []
+            tree = self._trees[key] = IntervalTree(
+                (n_.start and n_.start.timestamp(), n_.end and n_.end.timestamp(), (k, n_))
+                for k, n_ in enumerate(news))
+        return self._filter([n_ for _, n_ in sorted(tree.at(at), key=lambda i_: i_[0])], route, stop, area)
+
+    @staticmethod
+    def _filter(news, route, stop, area):
+        # the filters not answered by the key the news were looked up by
+        if route is not None and stop is not None:
+            news = [n_ for n_ in news if n_.stop_id == stop]
+        if (route is not None or stop is not None) and area is not None:
+            news = [n_ for n_ in news if n_.area.id == area]
+        return list(news)
@@ -0,0 +1,373 @@
+"""
+Departure-board service: the in-memory state of a TNBus (or of the published version of a tnbus.live.Live) served as
+JSON over HTTP, so that many kiosks and phones share the same upstream polls.
+
+    python -m tnbus.server --key-file auth --port 8080 --refresh 3600
+
+or, embedded, from a daemon thread:
+
+    server = tnbus.server.serve(Live(TNBus(api)), 8080)
+    ...
+    server.shutdown()
+
+Endpoints (GET and HEAD):
+
+    /stops?lat=&lon=[&n=10][&radius=km]     the nearest stops to (lat, lon), or the ones within radius
+    /stops?q=name[&n=20]                    the stops whose name matches q
+    /stops/<id>                             a stop
+    /stops/<id>/departures[?n=5][&route=]   the next departures from a stop
+    /routes?q=name[&n=20]                   the routes whose short name matches q
+    /routes/<id>                            the routes with that id (one per type)
+    /news[?stop=id_numeric][&route=id]      the news active now
+
+A response is rendered once and shared by every client asking for the same url until it expires: departures and news
+after Board.ttl seconds, everything else when the network changes (a new Live version, a refresh). Clients asking
+while it's being rendered wait for that render, and the trips of a stop are loaded from upstream at most once every
+max_age seconds (see TNBus.next_departures), however many clients ask. Responses are kept both plain and gzipped, with
+a weak ETag: If-None-Match is answered with 304.
+"""
+import argparse
+import gzip
+import json
+import threading
+from contextlib import nullcontext
+from hashlib import sha1
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic
+from urllib.parse import urlsplit, parse_qs, unquote
+
+from . import metrics
+from .live import Live
+from .tnbus import TNBus, API, By
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Response:
+    __slots__ = ("status", "body", "gzip", "etag", "version", "expires")
+
+    def __init__(self, status, data, version, expires, compress_min):
+        self.status = status
+        self.body = json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode()
+        # compressed once here instead of once per client
+        self.gzip = gzip.compress(self.body, mtime=0) if len(self.body) >= compress_min else None
+        self.etag = f"W/\"{sha1(self.body).hexdigest()[:20]}\""
+        self.version = version
+        # monotonic time the response expires at, None if it lasts as long as its network version
+        self.expires = expires
+
+
+def _stop(s, km=None):
+    out = {
+        "id": s.id, "id_numeric": s.id_numeric, "name": s.name, "street": s.street, "town": s.town, "type": s.type,
+        "location": list(s.location), "wheelchair_boarding": s.wheelchair_boarding,
+        "routes": [r.id for r in s.routes]
+    }
+    if km is not None:
+        out["km"] = round(km, 4)
+    return out
+
+
+def _route(r):
+    return {
+        "id": r.id, "short_name": r.short_name, "long_name": r.long_name, "type": r.type, "color": r.color,
+        "urban": r.urban, "area": r.area.id
+    }
+
+
+def _departure(at, trip):
+    return {
+        "time": at.isoformat(), "trip": trip.id, "route": trip.route.id, "route_name": trip.route.short_name,
+        "headsign": trip.trip_headsign, "delay": trip.delay, "state": trip.state,
+        "bus": trip.bus.id if trip.bus is not None else None
+    }
+
+
+def _new(n_):
+    return {
+        "header": n_.header, "details": n_.details, "url": n_.url, "route": n_.route.id, "stop_id": n_.stop_id,
+        "start": n_.start.isoformat() if n_.start is not None else None,
+        "end": n_.end.isoformat() if n_.end is not None else None
+    }
+
+
+class Board:
+    """
+    Renders and caches the responses of the endpoints, see the module docstring. Thread safe: the server calls get
+    from a thread per connection
+    """
+    # seconds departures and news are shared for
+    TTL = 15
+    # seconds an error from upstream is shared for
+    ERROR_TTL = 1
+    # bodies shorter than this are not worth compressing
+    COMPRESS_MIN = 512
+    # responses kept at most, the oldest are dropped first
+    MAX_ENTRIES = 4096
+    # results per page at most
+    MAX_RESULTS = 100
+
+    def __init__(self, source, ttl=None, max_age=None):
+        """
+        :param source: a TNBus or a tnbus.live.Live, whose current version answers every request
+        :param max_age: max_age of TNBus.next_departures
+        """
+        self.source = source
+        self.ttl = self.TTL if ttl is None else ttl
+        self.max_age = max_age
+        self._cache = {}
+        # url -> Event set when the render in progress is done
+        self._rendering = {}
+        self._lock = threading.Lock()
+
+    def current(self):
+        # the TNBus to answer from, and the version of its network
+        if isinstance(self.source, Live):
+            version, t = self.source.snapshot()
+            return t, version
+        return self.source, self.source.age
+
+    def get(self, url):
+        """
+        the Response to url (path and query string)
+        """
+        parts = urlsplit(url)
+        query = parse_qs(parts.query)
+        key = (parts.path, tuple(sorted((k, tuple(v)) for k, v in query.items())))
+        t, version = self.current()
+        while True:
+            with self._lock:
+                res = self._cache.get(key)
+                if res is not None and res.version == version and (res.expires is None or res.expires > monotonic()):
+                    if metrics.sinks:
+                        metrics.inc("server_cache_total", result="hit")
+                    return res
+                done = self._rendering.get(key)
+                if done is None:
+                    done = self._rendering[key] = threading.Event()
+                    break
+            done.wait()
+        if metrics.sinks:
+            metrics.inc("server_cache_total", result="miss")
+        try:
+            res = self._render(t, version, parts.path, query)
+            with self._lock:
+                self._cache.pop(key, None)
+                while len(self._cache) >= self.MAX_ENTRIES:
+                    del self._cache[next(iter(self._cache))]
+                self._cache[key] = res
+            return res
+        finally:
+            with self._lock:
+                self._rendering.pop(key).set()
+
+    def _render(self, t, version, path, query):
+        with metrics.timer("server_render_seconds"):
+            try:
+                data, ttl = self._route(t, [unquote(p_) for p_ in path.split("/") if p_], query)
+                status = 200
+            except HTTPError as e:
+                data, ttl, status = {"error": str(e)}, (self.ERROR_TTL if e.status >= 500 else None), e.status
+        return Response(status, data, version, None if ttl is None else monotonic() + ttl, self.COMPRESS_MIN)
+
+    def _loads(self, t):
+        # answering from t may load areas into it, unless it's frozen: the lock its own loads of areas and trips take
+        return t._loading if not t.frozen else nullcontext()
+
+    @staticmethod
+    def _param(query, name, type_=str, default=None):
+        values = query.get(name)
+        if not values:
+            return default
+        try:
+            return type_(values[0])
+        except ValueError:
+            raise HTTPError(400, f"invalid {name}: {values[0]}")
+
+    def _count(self, query, default):
+        return max(1, min(self._param(query, "n", int, default), self.MAX_RESULTS))
+
+    def _route(self, t, parts, query):
+        # (data, seconds it's valid for or None for the network version) of the endpoint at parts
+        if parts == ["stops"]:
+            return self._stops(t, query), None
+        if len(parts) == 2 and parts[0] == "stops":
+            return _stop(self._stop(t, parts[1])), None
+        if len(parts) == 3 and parts[0] == "stops" and parts[2] == "departures":
+            return self._departures(t, self._stop(t, parts[1]), query), self.ttl
+        if parts == ["routes"]:
+            q_ = self._param(query, "q")
+            if q_ is None:
+                raise HTTPError(400, "q is required")
+            with self._loads(t):
+                return [_route(r) for r in t.get(TNBus.Route, (By.NAME_MATCH, q_))[:self._count(query, 20)]], None
+        if len(parts) == 2 and parts[0] == "routes":
+            try:
+                route = int(parts[1])
+            except ValueError:
+                raise HTTPError(404, f"no route {parts[1]}")
+            # ids are only unique within a type
+            with self._loads(t):
+                res = t.get(TNBus.Route, (By.ID, route), override_unique=True)
+            if not res:
+                raise HTTPError(404, f"no route {parts[1]}")
+            return [_route(r) for r in res], None
+        if parts == ["news"]:
+            news = t.active_news(route=self._param(query, "route", int), stop=self._param(query, "stop", int))
+            return [_new(n_) for n_ in news], self.ttl
+        raise HTTPError(404, "no such endpoint")
+
+    def _stops(self, t, query):
+        q_ = self._param(query, "q")
+        if q_ is not None:
+            with self._loads(t):
+                return [_stop(s) for s in t.get(TNBus.Stop, (By.NAME_MATCH, q_))[:self._count(query, 20)]]
+        lat, lon = self._param(query, "lat", float), self._param(query, "lon", float)
+        if lat is None or lon is None:
+            raise HTTPError(400, "either q or lat and lon are required")
+        radius = self._param(query, "radius", float)
+        n = self._count(query, 10 if radius is None else self.MAX_RESULTS)
+        with self._loads(t):
+            return [_stop(s, km) for s, km in t.nearby_stops((lat, lon), n, radius)]
+
+    def _stop(self, t, stop_id):
+        # By.ID matches substrings of string ids: /stops/2 isn't stop 21000z
+        with self._loads(t):
+            res = next((s for s in t.get(TNBus.Stop, (By.ID, stop_id), override_unique=True) if s.id == stop_id), None)
+        if res is None:
+            raise HTTPError(404, f"no stop {stop_id}")
+        return res
+
+    def _departures(self, t, stop, query):
+        n = self._count(query, 5)
+        route = self._param(query, "route", int)
+        max_age = t.DEPARTURES_MAX_AGE if self.max_age is None else self.max_age
+        # trips are loaded under the lock Live copies are taken with, once for every client asking meanwhile
+        try:
+            res = t.next_departures(stop, None, n, route, max_age)
+        except Exception as e:
+            raise HTTPError(502, f"upstream: {e}")
+        return {"stop": _stop(stop), "departures": [_departure(at, trip) for at, trip in res]}
+
+
+def _accepts_gzip(header):
+    for i_ in (header or "").split(","):
+        coding, _, params = i_.strip().partition(";")
+        if coding.strip().lower() in ("gzip", "*"):
+            return params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
+
+
+def _matches(header, etag):
+    # weak comparison, as If-None-Match requires
+    tags = [i_.strip() for i_ in header.split(",")]
+    return "*" in tags or etag[2:] in (i_[2:] if i_.startswith("W/") else i_ for i_ in tags)
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # the default backlog of 5 drops the connections of a burst of clients, which then retry after seconds
+    request_queue_size = 128
+
+
+def make_server(source, port, address="", **kwargs):
+    """
+    a ThreadingHTTPServer answering from source (a TNBus or a tnbus.live.Live), its Board as the board attribute.
+    kwargs go to Board
+    """
+    board = Board(source, **kwargs)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _respond(self, body):
+            res = board.get(self.path)
+            if metrics.sinks:
+                metrics.inc("server_requests_total", status=res.status)
+            if res.expires is None:
+                cache = "no-cache"
+            else:
+                cache = f"max-age={max(0, int(res.expires - monotonic()))}"
+            inm = self.headers.get("If-None-Match")
+            if res.status == 200 and inm is not None and _matches(inm, res.etag):
+                self.send_response(304)
+                self.send_header("ETag", res.etag)
+                self.send_header("Cache-Control", cache)
+                self.send_header("Vary", "Accept-Encoding")
+                self.end_headers()
+                return
+            payload = res.body
+            self.send_response(res.status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            if res.gzip is not None:
+                self.send_header("Vary", "Accept-Encoding")
+                if _accepts_gzip(self.headers.get("Accept-Encoding")):
+                    payload = res.gzip
+                    self.send_header("Content-Encoding", "gzip")
+            if res.status == 200:
+                self.send_header("ETag", res.etag)
+            self.send_header("Cache-Control", cache)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            if body:
+                self.wfile.write(payload)
+
+        def do_GET(self):
+            self._respond(True)
+
+        def do_HEAD(self):
+            self._respond(False)
+
+        def log_message(self, *_):
+            pass
+
+    server = _Server((address, port), Handler)
+    server.board = board
+    return server
+
+
+def serve(source, port, address="", **kwargs):
+    """
+    serves source from a daemon thread; returns the server, to be shutdown()
+    """
+    server = make_server(source, port, address, **kwargs)
+    threading.Thread(target=server.serve_forever, name="tnbus-server", daemon=True).start()
+    return server
+
+
+def main():
+    p = argparse.ArgumentParser(description="TNBus departure-board service")
+    key = p.add_mutually_exclusive_group(required=True)
+    key.add_argument("--key", help="API key")
+    key.add_argument("--key-file", help="file holding the API key")
+    p.add_argument("--port", type=int, default=8080)
+    p.add_argument("--address", default="")
+    p.add_argument("--areas", type=int, nargs="*", help="ids of the areas to load, every area by default")
+    p.add_argument("--ttl", type=float, default=Board.TTL, help="seconds departures are shared for")
+    p.add_argument("--max-age", type=float, help="seconds the trips of a stop are reused before loading them again")
+    p.add_argument("--refresh", type=float, default=3600, help="seconds between network refreshes, 0 to never")
+    args = p.parse_args()
+
+    if args.key_file:
+        with open(args.key_file) as f:
+            args.key = f.read().strip()
+    live = Live(TNBus(API(args.key), keep_raw=False, areas=args.areas))
+    if args.refresh:
+        live.start(args.refresh, on_error=lambda e: print(f"refresh failed: {e!r}"))
+    server = make_server(live, args.port, args.address, ttl=args.ttl, max_age=args.max_age)
+    print(f"serving on {args.address or '*'}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        live.stop()
+
+
+if __name__ == "__main__":
+    main()
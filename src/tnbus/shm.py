@@ -0,0 +1,311 @@
+"""
+Read-only copy of the static network (areas, routes, stops and their links) in a shared memory segment, so that the
+processes of a pre-fork server hold it once instead of once per worker, and only the publisher fetches it.
+
+    # publisher, before forking the workers
+    net = shm.SharedNetwork.publish(TNBus(api))
+    # every worker
+    t = TNBus(api, shared=shm.SharedNetwork(net.name))
+
+The TNBus of a worker holds views of the segment, subclasses of TNBus.Area, TNBus.Route and TNBus.Stop reading their
+attributes from it on access: get, the proximity searches and trips work as usual, while the views can't be changed
+nor refreshed. The segment outlives the views: publish again and attach new TNBus instances to pick up a new network.
+
+Values are stored once each in a table of (tag, bytes) entries, the model attributes as indexes in it; coordinates
+are doubles and links compressed rows of indexes.
+"""
+import json
+import struct
+import sys
+from datetime import datetime
+from multiprocessing import shared_memory, resource_tracker
+
+from .tnbus import TNBus
+from .stream import loads as json_loads
+
+MAGIC = b"TNBM"
+FORMAT = 1
+# magic, format, age, areas, routes, stops, links, values, funivie area, values length
+HEADER = struct.Struct("<4sHdIIIIIIQ")
+
+AREA_FIELDS = ("id", "desc", "type")
+ROUTE_FIELDS = ("id", "color", "long_name", "short_name", "type", "urban", "area", "news")
+STOP_FIELDS = ("id", "desc", "id_numeric", "level", "name", "street", "town", "type", "wheelchair_boarding")
+
+STR = ord("s")
+
+
+def _align(n):
+    return (n + 7) & ~7
+
+
+def _encode(value):
+    if isinstance(value, str):
+        return b"s" + value.encode()
+    return b"j" + json.dumps(value, separators=(",", ":")).encode()
+
+
+class SharedNetwork:
+    def __init__(self, name, track=True):
+        """
+        attaches to the segment published as name
+        :param track: whether the resource tracker of this process may unlink the segment at exit, like the track
+        parameter of SharedMemory in python 3.13. Workers forked by the publisher share its tracker and can keep the
+        default, unrelated processes must pass False or their exit would destroy the segment
+        """
+        if track or sys.version_info >= (3, 13):
+            self._shm = shared_memory.SharedMemory(name, **({} if track else {"track": False}))
+        else:
+            self._shm = shared_memory.SharedMemory(name)
+            resource_tracker.unregister(self._shm._name, "shared_memory")
+        self._map()
+
+    @classmethod
+    def publish(cls, t: TNBus, name=None):
+        """
+        copies the static network of t into a new segment; the returned SharedNetwork owns it and should unlink() it
+        once no worker needs it anymore
+        """
+        values, table = [], {}
+
+        def value(v_):
+            b_ = _encode(v_)
+            n_ = table.get(b_)
+            if n_ is None:
+                n_ = table[b_] = len(values)
+                values.append(b_)
+            return n_
+
+        areas_pos = {a: n for n, a in enumerate(t.areas)}
+        routes_pos = {r: n for n, r in enumerate(t.routes)}
+        areas = [value(getattr(a, f)) for a in t.areas for f in AREA_FIELDS]
+        routes = []
+        for r in t.routes:
+            routes += [value(getattr(r, f)) for f in ROUTE_FIELDS[:-2]]
+            routes += [areas_pos[r.area], value([i.raw for i in r.news] if r.news is not None else None)]
+        stops, locations, stop_offsets, stop_links = [], [], [0], []
+        by_route = [[] for _ in t.routes]
+        for n, s in enumerate(t.stops):
+            stops += [value(getattr(s, f)) for f in STOP_FIELDS]
+            locations += s.location
+            for r in s.routes:
+                stop_links.append(routes_pos[r])
+                by_route[routes_pos[r]].append(n)
+            stop_offsets.append(len(stop_links))
+        route_offsets, route_links = [0], []
+        for l_ in by_route:
+            route_links += l_
+            route_offsets.append(len(route_links))
+        offsets = [0]
+        for b_ in values:
+            offsets.append(offsets[-1] + len(b_))
+
+        arrays = (areas, routes, stops, stop_offsets, stop_links, route_offsets, route_links, offsets)
+        links = len(stop_links)
+        head = HEADER.pack(MAGIC, FORMAT, t.age.timestamp(), len(t.areas), len(t.routes), len(t.stops), links,
+                           len(values), areas_pos[t._funivie], offsets[-1])
+        size = _align(HEADER.size) + 8 * len(locations) + 4 * sum(len(a_) for a_ in arrays) + offsets[-1]
+
+        shm = shared_memory.SharedMemory(name, create=True, size=size)
+        try:
+            buf = shm.buf
+            buf[:HEADER.size] = head
+            pos = _align(HEADER.size)
+            for fmt, data in (("d", locations),) + tuple(("I", a_) for a_ in arrays):
+                end = pos + struct.calcsize(fmt) * len(data)
+                with buf[pos:end].cast(fmt) as view:
+                    for n, v_ in enumerate(data):
+                        view[n] = v_
+                pos = end
+            buf[pos:pos + offsets[-1]] = b"".join(values)
+            del buf
+        except BaseException:
+            shm.close()
+            shm.unlink()
+            raise
+        out = cls.__new__(cls)
+        out._shm = shm
+        out._map()
+        return out
+
+    def _map(self):
+        buf = self._shm.buf
+        magic, fmt, age, areas, routes, stops, links, values, funivie, length = HEADER.unpack_from(buf)
+        if magic != MAGIC:
+            raise ValueError(f"{self._shm.name} is not a shared TNBus network")
+        if fmt != FORMAT:
+            raise ValueError(f"shared network format {fmt} is not supported (expected {FORMAT})")
+        self.age = datetime.fromtimestamp(age)
+        self.funivie = funivie
+        self.counts = (areas, routes, stops)
+        self._views = []
+        pos = _align(HEADER.size)
+
+        def take(fmt_, n_):
+            nonlocal pos
+            end = pos + struct.calcsize(fmt_) * n_
+            view = buf[pos:end].cast(fmt_)
+            self._views.append(view)
+            pos = end
+            return view
+
+        self.locations = take("d", 2 * stops)
+        self.areas = take("I", len(AREA_FIELDS) * areas)
+        self.routes = take("I", len(ROUTE_FIELDS) * routes)
+        self.stops = take("I", len(STOP_FIELDS) * stops)
+        self.stop_offsets = take("I", stops + 1)
+        self.stop_links = take("I", links)
+        self.route_offsets = take("I", routes + 1)
+        self.route_links = take("I", links)
+        self.offsets = take("I", values + 1)
+        self.values = take("B", length)
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    def value(self, n):
+        a_, b_ = self.offsets[n], self.offsets[n + 1]
+        if self.values[a_] == STR:
+            return str(self.values[a_ + 1:b_], "utf-8")
+        return json_loads(bytes(self.values[a_ + 1:b_]))
+
+    def populate(self, t: TNBus):
+        """
+        fills the stores of t, a TNBus being built with shared=self, with views of the network
+        """
+        # like TNBus._add, indexing the views under the models they stand for
+        g_ = _Graph(self)
+        for n in range(self.counts[0]):
+            t.areas.append(Area(g_, n))
+            t._indexes[TNBus.Area].add(t.areas[-1])
+        g_.areas = t.areas[:]
+        for n in range(self.counts[1]):
+            r = Route(g_, n)
+            t.routes.append(r)
+            t._indexes[TNBus.Route].add(r)
+            r.area.routes.append(r)
+            if type(r.news) is list:
+                t.news += r.news
+        g_.routes = t.routes[:]
+        for n in range(self.counts[2]):
+            t.stops.append(Stop(g_, n, t.location))
+            t._indexes[TNBus.Stop].add(t.stops[-1])
+            t._spatial.add(t.stops[-1])
+        g_.stops = t.stops[:]
+        t._funivie = g_.areas[self.funivie]
+
+    def close(self):
+        """
+        detaches from the segment: the views of this network can't be used anymore
+        """
+        for v_ in self._views:
+            v_.release()
+        self._views = []
+        self._shm.close()
+
+    def __del__(self):
+        # the segment can't be unmapped while views of it are alive
+        if getattr(self, "_views", None):
+            self.close()
+
+    def unlink(self):
+        # destroys the segment once every process has closed it
+        self._shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class _Graph:
+    # the views of the network attached to a single TNBus, by position in the segment
+    __slots__ = ("net", "areas", "routes", "stops")
+
+    def __init__(self, net):
+        self.net = net
+        self.areas = self.routes = self.stops = ()
+
+
+class _View:
+    __slots__ = ()
+
+    def __reduce__(self):
+        raise TypeError("views of a shared network can't be pickled")
+
+
+class Area(_View, TNBus.Area):
+    __slots__ = ("_g", "_i")
+
+    def __init__(self, g_, n):
+        self._g, self._i = g_, n
+        self.routes = []
+        self.stops = []
+        self.raw = None
+
+
+class Route(_View, TNBus.Route):
+    __slots__ = ("_g", "_i")
+
+    def __init__(self, g_, n):
+        self._g, self._i = g_, n
+        self.trips = []
+        self.trips_load = datetime.fromtimestamp(0)
+        self.raw = None
+        net = self._g.net
+        news = net.value(net.routes[self._i * len(ROUTE_FIELDS) + 7])
+        self.news = None if news is None else [TNBus.Area.New(i, self, self.area) for i in news]
+
+    @property
+    def area(self):
+        return self._g.areas[self._g.net.routes[self._i * len(ROUTE_FIELDS) + 6]]
+
+    @property
+    def stops(self):
+        net, stops = self._g.net, self._g.stops
+        return {stops[n] for n in net.route_links[net.route_offsets[self._i]:net.route_offsets[self._i + 1]]}
+
+
+class Stop(_View, TNBus.Stop):
+    __slots__ = ("_g", "_i")
+
+    def __init__(self, g_, n, location):
+        self._g, self._i = g_, n
+        self.trips = []
+        self.trips_load = datetime.fromtimestamp(0)
+        self._origin = location
+        self._distance = None
+        self.raw = None
+
+    @property
+    def location(self):
+        loc = self._g.net.locations
+        return loc[2 * self._i], loc[2 * self._i + 1]
+
+    @property
+    def routes(self):
+        net, routes = self._g.net, self._g.routes
+        return [routes[n] for n in net.stop_links[net.stop_offsets[self._i]:net.stop_offsets[self._i + 1]]]
+
+    @property
+    def areas(self):
+        return {r.area for r in self.routes}
+
+
+def _field(table, k, width):
+    # property reading the k-th of the width fields of the row of a view in table, a SharedNetwork attribute
+    def get(self):
+        net = self._g.net
+        return net.value(getattr(net, table)[self._i * width + k])
+    return property(get)
+
+
+# area and news of routes are resolved by Route itself
+for c_, table, fields, skip in (
+        (Area, "areas", AREA_FIELDS, ()), (Route, "routes", ROUTE_FIELDS, ("area", "news")),
+        (Stop, "stops", STOP_FIELDS, ())):
+    for k, f in enumerate(fields):
+        if f not in skip:
+            setattr(c_, f, _field(table, k, len(fields)))
@@ -0,0 +1,165 @@
+"""
+Versioned binary snapshots of an already built TNBus: the linked object graph and its indexes, without the api.
+
+Loading a snapshot skips fetching, route resolution and index building, so it's much faster than TNBus(preload=...).
+Snapshots are pickles: only load the ones you wrote yourself.
+
+Model objects (areas, routes, stops, trips...) are created empty and their states streamed one after the other,
+so the cyclic stop <-> route graph never makes pickle recurse deeper than a single object.
+"""
+import gc
+import io
+import mmap
+import pickle
+import struct
+import zlib
+from datetime import datetime
+
+from .tnbus import TNBus
+from .version import version
+
+MAGIC = b"TNBS"
+# bumped whenever the layout of the pickled classes changes
+FORMAT = 6
+# magic, format, created (timestamp), payload length, payload crc32, library version length
+HEADER = struct.Struct("<4sHdQIH")
+
+
+MODELS = (TNBus.Area, TNBus.Area.New, TNBus.Route, TNBus.Stop, TNBus.Trip, TNBus.TripStopTime, TNBus.Bus)
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+def _state(obj):
+    state = dict(getattr(obj, "__dict__", {}))
+    for c_ in type(obj).__mro__:
+        for s_ in getattr(c_, "__slots__", ()):
+            if s_ not in ("__dict__", "__weakref__") and hasattr(obj, s_):
+                state[s_] = getattr(obj, s_)
+    return state
+
+
+def _restore(obj, state):
+    if not hasattr(type(obj), "__slots__"):
+        obj.__dict__.update(state)
+        return
+    for k, v in state.items():
+        object.__setattr__(obj, k, v)
+
+
+class _Pickler(pickle.Pickler):
+    # model objects are written without their state the first time they're met, which memoizes them: their states
+    # are dumped afterwards one by one, and every other reference to them is a plain memo lookup
+    def __init__(self, f, t):
+        super().__init__(f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.queue = []
+        self.t = t
+
+    def persistent_id(self, obj):
+        # the TNBus itself (trips refer to it) is the one being loaded, not a copy
+        if obj is self.t:
+            return "t"
+
+    def reducer_override(self, obj):
+        if type(obj) in MODELS:
+            self.queue.append(obj)
+            return object.__new__, (type(obj),)
+        return NotImplemented
+
+
+def _dumps(t):
+    buf = io.BytesIO()
+    p_ = _Pickler(buf, t)
+    p_.dump(t.__getstate__())
+    while p_.queue:
+        obj = p_.queue.pop()
+        p_.dump((obj, _state(obj)))
+    p_.dump(None)
+    return buf.getvalue()
+
+
+class _Unpickler(pickle.Unpickler):
+    def __init__(self, f, t):
+        super().__init__(f)
+        self.t = t
+
+    def persistent_load(self, pid):
+        if pid != "t":
+            raise pickle.UnpicklingError(f"unknown persistent id {pid!r}")
+        return self.t
+
+
+def _loads(payload):
+    t = TNBus.__new__(TNBus)
+    u_ = _Unpickler(io.BytesIO(payload), t)
+    # the collector would otherwise keep rescanning the young graph while it's being built
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        t.__setstate__(u_.load())
+        while True:
+            item = u_.load()
+            if item is None:
+                return t
+            _restore(*item)
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def save(t: TNBus, path):
+    payload = _dumps(t)
+    lib = version.encode()
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, FORMAT, datetime.now().timestamp(), len(payload), zlib.crc32(payload), len(lib)))
+        f.write(lib)
+        f.write(payload)
+
+
+def info(path):
+    """
+    returns the header of a snapshot as a dict, without loading it
+    """
+    with open(path, "rb") as f:
+        return _header(f.read(HEADER.size + 0xffff))
+
+
+def _header(buf):
+    if len(buf) < HEADER.size:
+        raise SnapshotError("truncated snapshot")
+    magic, fmt, created, length, crc, lib_len = HEADER.unpack_from(buf)
+    if magic != MAGIC:
+        raise SnapshotError("not a TNBus snapshot")
+    return {
+        "format": fmt,
+        "created": datetime.fromtimestamp(created),
+        "length": length,
+        "crc32": crc,
+        "version": bytes(buf[HEADER.size:HEADER.size + lib_len]).decode(),
+        "offset": HEADER.size + lib_len
+    }
+
+
+def load(path, api=None, verify=True):
+    """
+    maps the snapshot at path and rebuilds the TNBus stored in it, attaching api to it
+    """
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        head = _header(mm)
+        if head["format"] != FORMAT:
+            raise SnapshotError(f"snapshot format {head['format']} is not supported (expected {FORMAT})")
+        with memoryview(mm) as view:
+            payload = view[head["offset"]:head["offset"] + head["length"]]
+            try:
+                if len(payload) != head["length"]:
+                    raise SnapshotError("truncated snapshot")
+                if verify and zlib.crc32(payload) != head["crc32"]:
+                    raise SnapshotError("corrupted snapshot")
+                t = _loads(payload)
+            finally:
+                payload.release()
+
+    t.api = api
+    return t
@@ -0,0 +1,113 @@
+import codecs
+import json
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+CHUNK = 64 * 1024
+# ijson's pure python backend is slower than json.raw_decode, only the compiled ones are worth it
+IJSON_BACKENDS = ("yajl2_c", "yajl2_cffi")
+WHITESPACE = " \t\n\r"
+
+
+def loads(data):
+    """
+    json.loads, through orjson when it's installed
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class _Reader:
+    # file-like view of an iterable of byte chunks, as ijson wants it
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b""
+
+    def read(self, n=-1):
+        while n < 0 or len(self.buffer) < n:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        if n < 0:
+            out, self.buffer = self.buffer, b""
+        else:
+            out, self.buffer = self.buffer[:n], self.buffer[n:]
+        return out
+
+
+def iter_array(chunks):
+    """
+    yields the elements of the top-level json array encoded (utf-8) in the byte chunks, each one as soon as it's
+    complete, so that the whole document is never held in memory.
+    uses ijson when it's installed with a compiled backend, json.JSONDecoder.raw_decode otherwise
+    """
+    if ijson is not None and ijson.backend in IJSON_BACKENDS:
+        yield from ijson.items(_Reader(chunks), "item", use_float=True)
+        return
+
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+    chunks = iter(chunks)
+    buf, pos, eof = "", 0, False
+    started = False
+
+    def more():
+        nonlocal buf, pos, eof
+        chunk = next(chunks, None)
+        if chunk is None:
+            eof = True
+            buf = buf[pos:] + text.decode(b"", final=True)
+        else:
+            buf = buf[pos:] + text.decode(chunk)
+        pos = 0
+
+    while True:
+        while pos < len(buf) and buf[pos] in WHITESPACE:
+            pos += 1
+        if pos == len(buf):
+            if eof:
+                raise json.JSONDecodeError("unterminated array", buf, pos)
+            more()
+            continue
+        c_ = buf[pos]
+        if not started:
+            if c_ != "[":
+                raise json.JSONDecodeError("expected a json array", buf, pos)
+            started = True
+            pos += 1
+            continue
+        if c_ == "]":
+            return
+        if c_ == ",":
+            pos += 1
+            continue
+        try:
+            value, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            more()
+            continue
+        # a number cut by the end of the chunk (say "2." of "2.5") would still decode: a value is complete only once
+        # the separator after it is in the buffer
+        after = end
+        while after < len(buf) and buf[after] in WHITESPACE:
+            after += 1
+        if after == len(buf) or buf[after] not in ",]":
+            if eof:
+                raise json.JSONDecodeError("expected ',' or ']'", buf, after)
+            more()
+            continue
+        yield value
+        pos = after
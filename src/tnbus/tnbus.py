@@ -1,24 +1,53 @@
 import json
+import threading
 import requests
+from hashlib import sha1
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from itertools import chain
+from operator import attrgetter
+from random import random
+from time import sleep, perf_counter
+from functools import lru_cache
 from unicodedata import normalize as u_normalize, combining as u_combining
 from datetime import datetime, time, timedelta
 from pytz import timezone
 from datetime import datetime, timedelta
 from geopy.distance import geodesic
+from .geo import SpatialIndex
+from .departures import DepartureIndex
+from .journey import JourneyIndex
+from .news import NewsIndex
+from . import metrics
+from .stream import iter_array, loads as json_loads, CHUNK
 
 
 def remove_accents(inp):
     return u"".join((c for c in u_normalize("NFKD", inp) if not u_combining(c)))
 
 
+UTC = timezone("utc")
+
+
+# trips repeat the same few timestamps over and over, and the parsed values are immutable
+@lru_cache(maxsize=4096)
 def tz_dt_fromisoformat(string):
-    tz = timezone("utc")
-    return tz.localize(datetime.fromisoformat(string.replace("Z", "")))
+    return UTC.localize(datetime.fromisoformat(string.replace("Z", "")))
 
 
+@lru_cache(maxsize=4096)
 def tz_t_fromisoformat(string):
-    tz = timezone("utc")
-    return tz.localize(datetime.combine(datetime.today(), time.fromisoformat(string.replace("Z", "")))).time()
+    return time.fromisoformat(string.replace("Z", ""))
+
+
+def tz_dt_toisoformat(dt):
+    # inverse of tz_dt_fromisoformat, for payloads re-derived from the objects
+    return f"{dt.replace(tzinfo=None).isoformat()}Z" if dt is not None else None
+
+
+def digest(record):
+    # compact fingerprint of a payload record
+    return sha1(json.dumps(record, sort_keys=True).encode()).digest()[:8]
 
 
 class By:
@@ -84,32 +113,478 @@ class Cond:
         pass
 
 
+class Index:
+    # hash index over one or more exact-match attributes of a TNBus store.
+    # str attributes are keyed on their normalized value and only answer queries whose needle is at least as long
+    # as every indexed value, since only then the substring match done by TNBus.get is an equality.
+    def __init__(self, t_, keys, position):
+        self.keys = keys
+        self.attrs = tuple(t_.SEARCH_ASSOC[k] for k in keys)
+        self.strs = [False] * len(keys)
+        self.max_len = [0] * len(keys)
+        self.buckets = {}
+        # buckets are kept in store order
+        self.position = position
+
+    def _key(self, obj):
+        key = []
+        for n_, a_ in enumerate(self.attrs):
+            v_ = obj.__getattribute__(a_)
+            if isinstance(v_, str):
+                v_ = remove_accents(v_).lower()
+                self.strs[n_] = True
+                self.max_len[n_] = max(self.max_len[n_], len(v_))
+            key.append(v_)
+        return tuple(key)
+
+    def add(self, obj):
+        bucket = self.buckets.setdefault(self._key(obj), [])
+        bucket.append(obj)
+        if len(bucket) > 1 and self.position[bucket[-2]] > self.position[obj]:
+            bucket.sort(key=self.position.__getitem__)
+
+    def remove(self, obj):
+        key = self._key(obj)
+        bucket = self.buckets[key]
+        bucket.remove(obj)
+        if not bucket:
+            del self.buckets[key]
+
+    def lookup(self, values):
+        # returns None when the index can't answer exactly and the store must be scanned instead
+        key = []
+        for n_, v_ in enumerate(values):
+            if self.strs[n_] and isinstance(v_, str):
+                v_ = remove_accents(v_).lower()
+                if len(v_) < self.max_len[n_]:
+                    return
+            key.append(v_)
+        try:
+            return self.buckets.get(tuple(key), [])
+        except TypeError:
+            # unhashable needle
+            return
+
+
+class NameIndex:
+    # trigram index over the normalized value of a name attribute, normalized once per object in both the ways
+    # TNBus.get compares names: remove_accents(x).lower() for By.NAME and remove_accents(x.lower()) for By.NAME_MATCH
+    N = 3
+
+    def __init__(self, attr):
+        self.attr = attr
+        self.norm = {}
+        self.norm_match = {}
+        self.postings = {}
+
+    def _grams(self, string):
+        if len(string) < self.N:
+            return {string}
+        return {string[i:i + self.N] for i in range(len(string) - self.N + 1)}
+
+    def add(self, obj):
+        v_ = obj.__getattribute__(self.attr)
+        if not isinstance(v_, str):
+            return
+        n_ = remove_accents(v_).lower()
+        m_ = remove_accents(v_.lower())
+        self.norm[obj] = n_
+        self.norm_match[obj] = n_ if m_ == n_ else m_
+        for g_ in self._grams(n_) | self._grams(m_):
+            self.postings.setdefault(g_, set()).add(obj)
+
+    def remove(self, obj):
+        if obj not in self.norm:
+            return
+        for g_ in self._grams(self.norm.pop(obj)) | self._grams(self.norm_match.pop(obj)):
+            self.postings[g_].discard(obj)
+            if not self.postings[g_]:
+                del self.postings[g_]
+
+    def lookup(self, b_, v_):
+        # returns the set of objects matching the name filter, or None if the store must be scanned instead
+        if not isinstance(v_, str):
+            return
+        if b_ == By.NAME_MATCH:
+            v_, norm = remove_accents(v_.lower()), self.norm_match
+        else:
+            v_, norm = remove_accents(v_).lower(), self.norm
+        if not v_:
+            return
+
+        if len(v_) >= self.N:
+            grams = sorted((self.postings.get(g_, ()) for g_ in self._grams(v_)), key=len)
+            cand = set(grams[0]).intersection(*grams[1:])
+        else:
+            # every substring shorter than a gram is contained in at least one gram of the names holding it
+            cand = set()
+            for g_, p_ in self.postings.items():
+                if v_ in g_:
+                    cand |= p_
+        return {o_ for o_ in cand if v_ in norm[o_]}
+
+
+class Indexes:
+    # all the indexes of a single TNBus store, as declared by SEARCH_INDEX
+    def __init__(self, t_):
+        self.t_ = t_
+        self.position = {}
+        self.indexes = [Index(t_, k, self.position) for k in sorted(t_.SEARCH_INDEX, key=len, reverse=True)]
+        self.names = {}
+        for b_ in (By.NAME, By.NAME_MATCH):
+            if b_ in t_.SEARCH_ASSOC:
+                for i_ in self.names.values():
+                    if i_.attr == t_.SEARCH_ASSOC[b_]:
+                        self.names[b_] = i_
+                        break
+                else:
+                    self.names[b_] = NameIndex(t_.SEARCH_ASSOC[b_])
+        self._next = 0
+        self.version = 0
+
+    def _all(self):
+        return self.indexes + list({id(i_): i_ for i_ in self.names.values()}.values())
+
+    def add(self, obj):
+        self.position[obj] = self._next
+        self._next += 1
+        self.version += 1
+        for i_ in self._all():
+            i_.add(obj)
+
+    def remove(self, obj):
+        del self.position[obj]
+        self.version += 1
+        for i_ in self._all():
+            i_.remove(obj)
+
+    def update(self, obj, apply):
+        # re-indexes obj around apply(), which changes its indexed attributes, keeping its place in the store
+        self.version += 1
+        for i_ in self._all():
+            i_.remove(obj)
+        try:
+            apply()
+        finally:
+            for i_ in self._all():
+                i_.add(obj)
+
+    def index(self, keys):
+        for i_ in self.indexes:
+            if i_.keys == keys:
+                return i_
+
+    def rebuild(self, store):
+        version = self.version
+        self.__init__(self.t_)
+        self.version = version + 1
+        for _s in store:
+            self.add(_s)
+
+    def _sorted(self, objs):
+        return sorted(objs, key=self.position.__getitem__)
+
+    def candidates(self, filters, cond_mode):
+        """
+        returns a tuple (candidates, exact): candidates is a list in store order, or None if the store must be
+        scanned; exact is True when every filter has been answered by an index and candidates needs no verification
+        """
+        if cond_mode == Cond.AND:
+            found = []
+            left = list(range(len(filters)))
+            for i_ in self.indexes:
+                use = []
+                for k in i_.keys:
+                    for n_ in left:
+                        if filters[n_][0] == k and n_ not in use:
+                            use.append(n_)
+                            break
+                if len(use) == len(i_.keys):
+                    res = i_.lookup([filters[n_][1] for n_ in use])
+                    if res is not None:
+                        found.append(res)
+                        left = [n_ for n_ in left if n_ not in use]
+            for n_ in list(left):
+                b_, v_ = filters[n_]
+                if b_ in self.names:
+                    res = self.names[b_].lookup(b_, v_)
+                    if res is not None:
+                        found.append(res)
+                        left.remove(n_)
+            if not found:
+                return None, False
+            found.sort(key=len)
+            if len(found) == 1 or not found[0]:
+                res = found[0]
+            else:
+                res = set(found[0]).intersection(*found[1:])
+            return res if isinstance(res, list) and len(found) == 1 else self._sorted(res), not left
+
+        elif cond_mode == Cond.OR:
+            out = set()
+            for b_, v_ in filters:
+                res = None
+                if b_ in self.names:
+                    res = self.names[b_].lookup(b_, v_)
+                else:
+                    for i_ in self.indexes:
+                        if i_.keys == (b_,):
+                            res = i_.lookup((v_,))
+                            break
+                if res is None:
+                    return None, False
+                out.update(res)
+            return self._sorted(out), True
+
+        return None, False
+
+
+class Query:
+    # a filter set validated and compiled once into a predicate, reusable across calls and TNBus instances.
+    # candidates are picked through the store indexes and cached until the store changes
+    def __init__(self, t_, *filters: tuple[int, any], cond_mode=None, override_unique=False):
+        self.cond_mode = Cond.AND if cond_mode is None else cond_mode
+        if self.cond_mode not in (Cond.AND, Cond.OR):
+            raise TypeError(self.cond_mode)
+        for b_, _ in filters:
+            if b_ not in t_.SEARCH_ASSOC:
+                raise TypeError(f"Type {t_} doesn't support searches by {By.string(By(), b_)}")
+
+        self.t_ = t_
+        self.filters = filters
+        self.attrs = tuple(attrgetter(t_.SEARCH_ASSOC[b_]) for b_, _ in filters)
+        self.unique = not override_unique and By.ID in (_f[0] for _f in filters)
+        self._iter = None
+        self._test = None
+        self._candidates = None
+
+    def _probe(self, first):
+        # whether each filter is a substring/membership test or an equality, as decided by the first object
+        out = []
+        for (_, v_), a_ in zip(self.filters, self.attrs):
+            try:
+                if v_ in a_(first):
+                    pass
+                out.append(True)
+            except TypeError:
+                out.append(False)
+        return out
+
+    @staticmethod
+    def _name(n_, a_, norm, normalize):
+        if norm is None:
+            return lambda o_: n_ in normalize(a_(o_))
+
+        def test(o_):
+            s_ = norm.get(o_)
+            return n_ in (s_ if s_ is not None else normalize(a_(o_)))
+        return test
+
+    def _compile(self, _iter, indexes):
+        preds = []
+        for (b_, v_), a_, i_ in zip(self.filters, self.attrs, _iter):
+            names = indexes.names.get(b_) if indexes is not None else None
+            if not i_:
+                preds.append(lambda o_, v_=v_, a_=a_: not v_ != a_(o_))
+            elif b_ == By.NAME_MATCH:
+                preds.append(self._name(remove_accents(v_.lower()), a_, names.norm_match if names else None,
+                                        lambda s_: remove_accents(s_.lower())))
+            elif isinstance(v_, str):
+                preds.append(self._name(remove_accents(v_).lower(), a_, names.norm if names else None,
+                                        lambda s_: remove_accents(s_).lower()))
+            else:
+                preds.append(lambda o_, v_=v_, a_=a_: v_ in a_(o_))
+
+        if self.cond_mode == Cond.AND:
+            return lambda o_: all(p_(o_) for p_ in preds)
+        return lambda o_: any(p_(o_) for p_ in preds)
+
+    def _plan(self, indexes):
+        c_ = self._candidates
+        if c_ is None or c_[0] is not indexes or c_[1] != indexes.version:
+            c_ = (indexes, indexes.version) + indexes.candidates(self.filters, self.cond_mode)
+            self._candidates = c_
+        return c_[2], c_[3]
+
+    def iter(self, t, limit=None, store_override=None):
+        """
+        lazily yields the matching objects of t's store (or of store_override), in store order
+        """
+        if store_override:
+            store = iter(store_override)
+            first = next(store, None)
+            if first is None:
+                return
+            store = chain((first,), store)
+            _iter = self._probe(first)
+            test = self._compile(_iter, None)
+            candidates, exact = None, False
+        else:
+            store = t.__getattribute__(self.t_.SEARCH_STORE)
+            if not store:
+                return
+            indexes = t._indexes.get(self.t_)
+            if self._iter is None:
+                self._iter = self._probe(store[0])
+            candidates, exact = self._plan(indexes) if indexes is not None else (None, False)
+            test = None
+            if not exact:
+                if self._test is None or self._test[0] is not indexes:
+                    self._test = (indexes, self._compile(self._iter, indexes))
+                test = self._test[1]
+
+        if self.unique:
+            limit = 1
+        if limit is not None and limit <= 0:
+            return
+        if metrics.sinks:
+            plan = "scan" if candidates is None else "exact" if exact else "index"
+            yield from self._measured(store if candidates is None else candidates, test, exact, limit, plan)
+            return
+        n_ = 0
+        for _s in store if candidates is None else candidates:
+            if exact or test(_s):
+                yield _s
+                n_ += 1
+                if n_ == limit:
+                    return
+
+    def _measured(self, objs, test, exact, limit, plan):
+        # the loop of iter, counting the objects scanned and matched.
+        # a match is counted before it's yielded: the generator may never be resumed after it
+        n_, scanned = 0, 0
+        try:
+            for _s in objs:
+                scanned += 1
+                if exact or test(_s):
+                    n_ += 1
+                    yield _s
+                    if n_ == limit:
+                        return
+        finally:
+            store = self.t_.__name__
+            metrics.inc("get_total", store=store, plan=plan)
+            metrics.inc("get_scanned_total", scanned, store=store, plan=plan)
+            metrics.inc("get_matches_total", n_, store=store, plan=plan)
+
+    def run(self, t, store_override=None):
+        # same results as TNBus.get: a single object (or None) for unique queries, a list otherwise
+        if self.unique:
+            return next(self.iter(t, store_override=store_override), None)
+        return list(self.iter(t, store_override=store_override))
+
+    def first(self, t, store_override=None):
+        return next(self.iter(t, 1, store_override), None)
+
+    def all(self, t, limit=None, store_override=None):
+        return list(self.iter(t, limit, store_override))
+
+
 class TNBus:
-    def __init__(self, _api, preload=None, tz=None, initial_location=(46.074149, 11.121589)):
+    QUERY_CACHE_SIZE = 1024
+    # set on the versions published by tnbus.live.Live, which readers share: their areas, routes, stops, news and
+    # location can't change anymore. Trips still can: load_trips keeps adding and updating trips (TNBus.trips, the
+    # trips of routes and stops, the trip index) and feeding the departure and journey indexes and the history, under
+    # _loading, which copies hold too. Caches (compiled queries, the news index) are filled on use as well
+    frozen = False
+    # seconds the departures of a stop are answered from the DepartureIndex before its trips are loaded again
+    DEPARTURES_MAX_AGE = 60
+    # seconds a trip is kept in TNBus.trips after it was last loaded, and between two evictions of old trips
+    TRIPS_KEEP = 6 * 3600
+    TRIPS_EVICT_EVERY = 600
+
+    def __init__(self, _api, preload=None, tz=None, initial_location=(46.074149, 11.121589), keep_raw=True,
+                 history=None, stream=False, shared=None, areas=None, lazy=False):
+        """
+        :param keep_raw: if False the source payloads are dropped once the objects are built, and TNBus.raw and
+        the raw attribute of every object are re-derived from the objects when accessed
+        :param history: a tnbus.history.History every trip loaded through load_trips is recorded in
+        :param stream: without preload, builds routes and stops while their payloads are being downloaded and parsed
+        (API.iter_routes and API.iter_stops), instead of after the whole lists are in memory. Together with
+        keep_raw=False the payloads are never held whole
+        :param shared: a tnbus.shm.SharedNetwork the static network is read from, instead of being fetched and built.
+        Its areas, routes and stops are read-only views, and refresh isn't supported
+        :param areas: ids (or Area objects) of the areas whose routes and stops are loaded, all of them if None.
+        Every area is known anyway: the others can be loaded later with load_area
+        :param lazy: the areas not loaded at construction are loaded on first use: by get of routes or stops (only the
+        areas of its By.AREA filters, or of the Route objects of By.ROUTE filters on stops, if it has some) and by the
+        proximity searches. The areas of a stop or a route can't be told from its id, name or location, so a get by
+        those (get_stop, get_route...) and every proximity search (nearest_stops, stops_within, nearby_stops) load
+        every area the first time: pass areas to a get, or load_area beforehand, to keep the others unloaded
+        """
         self.api = _api
+        self.keep_raw = keep_raw
+        self.history = history
+        self._digests = None
         self.areas = []
         self.news = []
+        # built from news on first use, dropped whenever news is rebuilt
+        self._news_index = None
         self.routes = []
         self.stops = []
         self.trips = []
         self.location = initial_location
+        self._indexes = {t_: Indexes(t_) for t_ in (self.Area, self.Route, self.Stop, self.Trip)}
+        # every trip loaded, by tripId: loading a trip again updates the same Trip object
+        self._trip_ids = {}
+        self._trips_evicted = datetime.now()
+        # held while areas are loaded, while loaded trips are built and recorded, and while the TNBus is copied
+        self._loading = threading.RLock()
+        self._spatial = SpatialIndex()
+        self._queries = {}
+        self._queries_lock = threading.Lock()
+        self.departures = DepartureIndex()
+        self.journeys = JourneyIndex()
+        self.shared = shared
+        self.lazy = lazy
+        # ids of the areas whose routes and stops are loaded, None when the whole network is
+        self._area_ids = None
+        # (routeId, type) -> stops served by that route, of an area not loaded yet
+        self._pending = {}
+
+        if shared is not None:
+            self._raw = None
+            with metrics.timer("build_seconds", phase="shared"):
+                shared.populate(self)
+            self.age = shared.age
+            return
+
+        # streamed routes and stops are downloaded while they're built: their fetch time is in their phase
+        with metrics.timer("build_seconds", phase="fetch"):
+            if preload:
+                scope = preload.get("loaded")
+            elif areas is not None or lazy:
+                scope = [getattr(a, "id", a) for a in areas or ()]
+            else:
+                scope = None
+            para = None if scope is None else [str(i) for i in scope]
+            if not preload and stream:
+                self._raw = {"areas": self.api.areas(), "routes": [], "stops": [], "trips": []}
+                self._digests = {}
+                routes = self._ingest("routes", self.api.iter_routes(para) if para != [] else ())
+                stops = self._ingest("stops", self.api.iter_stops(para) if para != [] else ())
+            else:
+                if not preload:
+                    self._raw = {
+                        "areas": self.api.areas(),
+                        "routes": self.api.routes(para) if para != [] else [],
+                        "stops": self.api.stops(para) if para != [] else [],
+                        "trips": []
+                    }
+                else:
+                    # refresh and load_areas replace its lists: the caller's dict is left alone
+                    self._raw = dict(preload)
+                routes, stops = self._raw["routes"], self._raw["stops"]
+            self._area_ids = None if scope is None else set(scope)
 
-        if not preload:
-            self.raw = {
-                "areas": self.api.areas(),
-                "routes": self.api.routes(),
-                "stops": self.api.stops(),
-                "trips": []
-            }
-        else:
-            self.raw = preload
-
-        for a in self.raw["areas"]:
-            if self.get_area(a["areaId"]) is None:
-                self.areas.append(self.Area(a))
+        with metrics.timer("build_seconds", phase="areas"):
+            for a in self.raw["areas"]:
+                if self.get_area(a["areaId"]) is None:
+                    self._add(self.Area(a))
 
-        # API.areas() doesn't return area n. 8, area of cable ways (only one actually)
-        self.areas.append(self.Area({"areaId": 8, "areaDesc": "Funivie", "type": "E"}))
+            # API.areas() doesn't return area n. 8, area of cable ways (only one actually)
+            self._add(self.Area({"areaId": 8, "areaDesc": "Funivie", "type": "E"}))
+            self._funivie = self.areas[-1]
 
         """
         all stop dicts returned by API.stops are set to area 0
@@ -117,134 +592,369 @@ class TNBus:
         So a separate call to API.routes is needed, even if API.stops returns stop info as well
         """
 
-        for r in self.raw["routes"]:
-            self.routes.append(self.Route(r, self.get_area(r["areaId"])))
-            if type(self.routes[-1].news) is list:
-                self.news += self.routes[-1].news
-
-        for s in self.raw["stops"]:
-            self.stops.append(self.Stop(s, self.location))
-            for r in s["routes"]:
-                _r = self.get(self.Route, (By.ID, r["routeId"]), (By.TYPE, r["type"]))
-                self.stops[-1].routes.append(_r)
-                _r.stops.add(self.stops[-1])
-                self.stops[-1].areas.add(_r.area)
-                if self.stops[-1].routes[-1] is None:
-                    raise
+        with metrics.timer("build_seconds", phase="routes"):
+            for r in routes:
+                self._add(self.Route(r, self.get_area(r["areaId"])))
+                if type(self.routes[-1].news) is list:
+                    self.news += self.routes[-1].news
+                if not keep_raw:
+                    # so that streamed records don't outlive their object's construction
+                    self.routes[-1].raw = None
+
+        with metrics.timer("build_seconds", phase="stops"):
+            for s in stops:
+                self._add(self.Stop(s, self.location))
+                self._link(self.stops[-1], s["routes"])
+                if not keep_raw:
+                    self.stops[-1].raw = None
 
         # self._reload_distances()
-        # self._sort_by_distance()
 
         if preload:
             self.age = datetime.fromtimestamp(self.raw["age"])
         else:
             self.age = datetime.now()
 
-    def get(self, t_, *filters: tuple[int, any], store_override=None, cond_mode=None, override_unique=False):
-        cond_mode = Cond.AND if cond_mode is None else cond_mode
-        for b_, _ in filters:
-            if b_ not in t_.SEARCH_ASSOC:
-                raise TypeError(f"Type {t_} doesn't support searches by {By.string(By(), b_)}")
+        if not keep_raw:
+            self._drop_raw()
 
-        if store_override:
-            store = store_override
+    @property
+    def raw(self):
+        if self._raw is None:
+            return {
+                "areas": [a.raw for a in self.areas if a is not self._funivie],
+                "routes": [r.raw for r in self.routes],
+                "stops": [s.raw for s in self.stops],
+                "trips": []
+            }
+        return self._raw
+
+    @raw.setter
+    def raw(self, value):
+        self._raw = value
+
+    REFRESH_KEYS = (("areas", ("areaId",)), ("routes", ("routeId", "type")), ("stops", ("stopId", "type")))
+
+    def _ingest(self, call, records):
+        # passes the streamed records through, keeping them or, without keep_raw, only their fingerprints
+        key = dict(self.REFRESH_KEYS)[call]
+        if not self.keep_raw:
+            digests = self._digests[call] = {}
+        for i in records:
+            if self.keep_raw:
+                self._raw[call].append(i)
+            else:
+                digests[tuple(i[k] for k in key)] = digest(i)
+            yield i
+
+    def _drop_raw(self):
+        # keeps only the fingerprints of the payloads, needed by refresh to tell what changed
+        if self._raw is not None:
+            digests = self._digests or {}
+            # streamed payloads were fingerprinted as they arrived
+            self._digests = {
+                call: digests[call] if call in digests else
+                {tuple(i[k] for k in key): digest(i) for i in self._raw[call]} for call, key in self.REFRESH_KEYS
+            }
+            self._raw = None
+        for o_ in chain(self.areas, self.routes, self.stops, self.news):
+            o_.raw = None
+
+    def _add(self, obj):
+        self.__getattribute__(obj.SEARCH_STORE).append(obj)
+        self._indexes[type(obj)].add(obj)
+        if isinstance(obj, self.Stop):
+            self._spatial.add(obj)
+        elif isinstance(obj, self.Trip):
+            self._trip_ids[obj.id] = obj
+            obj.route.trips.append(obj)
+        elif self._pending and isinstance(obj, self.Route):
+            for _s in self._pending.pop((obj.id, obj.type), ()):
+                _s.routes.append(obj)
+                obj.stops.add(_s)
+                _s.areas.add(obj.area)
+
+    def _remove(self, obj):
+        self.__getattribute__(obj.SEARCH_STORE).remove(obj)
+        self._indexes[type(obj)].remove(obj)
+        if isinstance(obj, self.Stop):
+            self._spatial.remove(obj)
+        elif isinstance(obj, self.Trip):
+            del self._trip_ids[obj.id]
+            obj.route.trips.remove(obj)
+
+    def _update(self, obj, *args):
+        # updates obj in place from a new payload, keeping its indexes valid
+        if isinstance(obj, self.Stop):
+            self._spatial.remove(obj)
+            try:
+                self._indexes[type(obj)].update(obj, lambda: obj.update(*args))
+            finally:
+                self._spatial.add(obj)
         else:
-            store = self.__getattribute__(t_.SEARCH_STORE)
+            self._indexes[type(obj)].update(obj, lambda: obj.update(*args))
+
+    def _link(self, stop, routes):
+        # links stop with the routes serving it, routes being the "routes" list of its payload.
+        # the routes of areas not loaded yet are linked when they are, see _add
+        for _r in stop.routes:
+            if _r is not None:
+                _r.stops.discard(stop)
+        for p_ in self._pending.values():
+            p_.discard(stop)
+        stop.routes = []
+        stop.areas = set()
+        for r in routes:
+            _r = self._find(self.Route, (By.ID, r["routeId"]), (By.TYPE, r["type"]))
+            if _r is None and self._area_ids is not None:
+                self._pending.setdefault((r["routeId"], r["type"]), set()).add(stop)
+                continue
+            stop.routes.append(_r)
+            _r.stops.add(stop)
+            stop.areas.add(_r.area)
+            if stop.routes[-1] is None:
+                raise
+
+    def _writable(self):
+        if self.frozen:
+            raise TypeError("a published TNBus is read-only: change a copy of it, see tnbus.live")
+
+    def _fetch_changed(self, call):
+        # the payload of a static endpoint, or None if the api can tell it didn't change since the last refresh
+        if call == "areas":
+            return self.api.query_changed(call) if hasattr(self.api, "query_changed") else self.api.areas()
+        if self._area_ids is not None and not self._area_ids:
+            return []
+        ids = None if self._area_ids is None else sorted(self._area_ids)
+        if hasattr(self.api, "query_changed"):
+            return self.api.query_changed(call, {"areas": ids and ",".join(map(str, ids))})
+        return self.api.__getattribute__(call)(ids and [str(i) for i in ids])
+
+    def refresh(self):
+        """
+        re-pulls areas, routes and stops and applies only what changed to the objects already built, in place:
+        existing objects keep their identity and every index stays valid.
+        returns, for each endpoint, a tuple with the number of (added, removed, changed) records
+        """
+        return self._apply_changes(self._fetch_changes())
+
+    def _fetch_changes(self):
+        # the payload of every static endpoint, None for the ones that didn't change
+        if self.shared is not None:
+            raise TypeError("the network of a shared TNBus is read-only: publish a refreshed one instead")
+        return {call: self._fetch_changed(call) for call, _ in self.REFRESH_KEYS}
+
+    def _apply_changes(self, payloads):
+        self._writable()
+        out = {}
+        for call, key in self.REFRESH_KEYS:
+            data = payloads[call]
+            if data is None:
+                out[call] = (0, 0, 0)
+                continue
+            new = {tuple(i[k] for k in key): i for i in data}
+            if self._raw is not None:
+                old = {tuple(i[k] for k in key): i for i in self._raw[call]}
+                changed = [new[k] for k in new if k in old and new[k] != old[k]]
+                self._raw[call] = data
+            else:
+                old = self._digests[call]
+                digests = {k: digest(i) for k, i in new.items()}
+                changed = [new[k] for k in new if k in old and digests[k] != old[k]]
+                self._digests[call] = digests
+            added = [new[k] for k in new if k not in old]
+            removed = [dict(zip(key, k)) for k in old if k not in new]
+            self.__getattribute__(f"_refresh_{call}")(added, removed, changed)
+            out[call] = (len(added), len(removed), len(changed))
 
-        out = []
-        if store:
-            _iter = []
-            for b_, v_ in filters:
-                try:
-                    # supports for generators
-                    for _s in store:
-                        if v_ in _s.__getattribute__(t_.SEARCH_ASSOC[b_]):
-                            pass
-                        _iter.append(True)
-                        break
-                except TypeError:
-                    _iter.append(False)
-
-            for _s in store:
-                if cond_mode == Cond.AND:
-                    add_ = True
-                elif cond_mode == Cond.OR:
-                    add_ = False
-                else:
-                    raise TypeError(cond_mode)
-                for (b_, v_), i_ in zip(filters, _iter):
-                    s_target = _s.__getattribute__(t_.SEARCH_ASSOC[b_])
-                    if i_:
-                        if b_ == By.NAME_MATCH:
-                            if remove_accents(v_.lower()) not in \
-                                    remove_accents(s_target.lower()):
-                                if cond_mode == Cond.AND:
-                                    add_ = False
-                            else:
-                                if cond_mode == Cond.OR:
-                                    add_ = True
-                        else:
-                            if isinstance(v_, str):
-                                v_ = remove_accents(v_).lower()
-                                s_target = remove_accents(s_target).lower()
-                            if v_ not in s_target:
-                                if cond_mode == Cond.AND:
-                                    add_ = False
-                            else:
-                                if cond_mode == Cond.OR:
-                                    add_ = True
-                    else:
-                        if v_ != s_target:
-                            if cond_mode == Cond.AND:
-                                add_ = False
-                        else:
-                            if cond_mode == Cond.OR:
-                                add_ = True
-
-                    if (cond_mode == Cond.OR and add_ is True) or (cond_mode == Cond.AND and add_ is False):
-                        break
+        self.news = []
+        for r in self.routes:
+            if type(r.news) is list:
+                self.news += r.news
+        self._news_index = None
+        self.age = datetime.now()
+        if not self.keep_raw:
+            self._drop_raw()
+        return out
 
-                if add_:
-                    out.append(_s)
-                    if not override_unique and By.ID in (_f[0] for _f in filters):
-                        break
+    def _refresh_areas(self, added, removed, changed):
+        for a in removed:
+            self._remove(self.get_area(a["areaId"]))
+        for a in changed:
+            self._update(self.get_area(a["areaId"]), a)
+        for a in added:
+            self._add(self.Area(a))
+
+    def _refresh_routes(self, added, removed, changed):
+        for r in removed:
+            _r = self._find(self.Route, (By.ID, r["routeId"]), (By.TYPE, r["type"]))
+            self._remove(_r)
+            _r.area.routes.remove(_r)
+            for _s in _r.stops:
+                _s.routes.remove(_r)
+                _s.areas = {i.area for i in _s.routes if i is not None}
+        for r in changed:
+            _r = self._find(self.Route, (By.ID, r["routeId"]), (By.TYPE, r["type"]))
+            self._update(_r, r, self.get_area(r["areaId"]))
+            for _s in _r.stops:
+                _s.areas = {i.area for i in _s.routes if i is not None}
+        for r in added:
+            self._add(self.Route(r, self.get_area(r["areaId"])))
+
+    def _refresh_stops(self, added, removed, changed):
+        for s in removed:
+            _s = self._find(self.Stop, (By.ID_NUM, s["stopId"]), (By.TYPE, s["type"]))[0]
+            self._link(_s, [])
+            self._remove(_s)
+        for s in changed:
+            _s = self._find(self.Stop, (By.ID_NUM, s["stopId"]), (By.TYPE, s["type"]))[0]
+            self._update(_s, s)
+            self._link(_s, s["routes"])
+        for s in added:
+            self._add(self.Stop(s, self.location))
+            self._link(self.stops[-1], s["routes"])
 
-        if not override_unique and By.ID in (_f[0] for _f in filters):
-            if len(out) == 1:
-                return out[0]
-            elif len(out) == 0:
-                return
+    def get(self, t_, *filters: tuple[int, any], store_override=None, cond_mode=None, override_unique=False):
+        if self.lazy and not self.frozen and self._area_ids is not None and store_override is None and \
+                t_ in (self.Route, self.Stop):
+            self.load_areas(self._scope(t_, filters, cond_mode))
+        return self.query(t_, *filters, cond_mode=cond_mode, override_unique=override_unique).run(self, store_override)
+
+    def _scope(self, t_, filters, cond_mode):
+        # the areas the results of a get of routes or stops can be in, None if they can be in any: By.AREA filters
+        # and, for stops, By.ROUTE filters on a Route object. Others (say an id or a name) can match any area
+        areas = []
+        for b_, v_ in filters:
+            if b_ == By.AREA and isinstance(v_, self.Area):
+                areas.append({v_})
+            elif b_ == By.ROUTE and t_ is self.Stop and isinstance(v_, self.Route):
+                areas.append({v_.area})
             else:
-                raise Exception(out)
-
-        return out
+                areas.append(None)
+        if cond_mode == Cond.OR:
+            # every alternative must be scoped
+            return None if not areas or None in areas else set().union(*areas)
+        areas = [a_ for a_ in areas if a_ is not None]
+        # any scoped filter does, the smallest is enough
+        return min(areas, key=len) if areas else None
+
+    def _find(self, t_, *filters: tuple[int, any]):
+        # get among what's loaded, for the lookups of the library itself
+        return self.query(t_, *filters).run(self)
+
+    @property
+    def loaded_areas(self):
+        # the areas whose routes and stops are loaded
+        if self._area_ids is None:
+            return list(self.areas)
+        return [a for a in self.areas if a.id in self._area_ids]
+
+    def load_areas(self, areas=None):
+        """
+        fetches and links the routes and stops of areas (Area objects or ids, every area if None) not loaded yet.
+        Stops already loaded with other areas are linked to the new routes instead of being duplicated
+        """
+        if self._area_ids is None:
+            return
+        self._writable()
+        # trips loaded meanwhile may load areas too
+        with self._loading:
+            self._load_areas(areas)
+
+    def _load_areas(self, areas):
+        ids = [a.id for a in self.areas] if areas is None else [getattr(a, "id", a) for a in areas]
+        ids = [i for i in dict.fromkeys(ids) if i not in self._area_ids]
+        if not ids:
+            return
+        with metrics.timer("build_seconds", phase="area"):
+            para = [str(i) for i in ids]
+            routes, stops = self.api.routes(para), self.api.stops(para)
+            self._area_ids.update(ids)
+            new, known = [], []
+            for s in stops:
+                (known if self._find(self.Stop, (By.ID_NUM, s["stopId"]), (By.TYPE, s["type"])) else new).append(s)
+            n_ = len(self.routes)
+            self._refresh_routes(routes, [], [])
+            self._refresh_stops(new, [], known)
+            for call, records in (("routes", routes), ("stops", new)):
+                if self._raw is not None:
+                    # not in place: the list may be the api's (say a cached response) or the caller's preload
+                    self._raw[call] = self._raw[call] + records
+                else:
+                    key = dict(self.REFRESH_KEYS)[call]
+                    self._digests[call].update((tuple(i[k] for k in key), digest(i)) for i in records)
+        for _r in self.routes[n_:]:
+            if type(_r.news) is list:
+                self.news += _r.news
+        self._news_index = None
+        if not self.keep_raw:
+            for o_ in chain(self.routes, self.stops, self.news):
+                o_.raw = None
+
+    def load_area(self, area):
+        return self.load_areas((area,))
+
+    def query(self, t_, *filters: tuple[int, any], cond_mode=None, override_unique=False):
+        # compiled queries are cached by their filters, so repeated searches don't get re-planned
+        key = (t_, filters, cond_mode, override_unique)
+        try:
+            q_ = self._queries.get(key)
+        except TypeError:
+            # unhashable filter values
+            return Query(t_, *filters, cond_mode=cond_mode, override_unique=override_unique)
+        if metrics.sinks:
+            metrics.inc("query_cache_total", result="miss" if q_ is None else "hit")
+        if q_ is None:
+            q_ = Query(t_, *filters, cond_mode=cond_mode, override_unique=override_unique)
+            # published versions are queried from many threads at once
+            with self._queries_lock:
+                while len(self._queries) >= self.QUERY_CACHE_SIZE:
+                    del self._queries[next(iter(self._queries))]
+                self._queries[key] = q_
+        return q_
 
     def _reload_distances(self):
-        # n = datetime.now()
-        # print(f"start distances reloading {n}")
-        for _i in self.stops:
-            _i.reload_distance(self.location)
-        # print(f"end distances reloading {datetime.now()} ({(datetime.now()-n).total_seconds()})")
-
-    def _sort_by_distance(self):
-        # n = datetime.now()
-        # print(f"start distances sorting {n}")
-        self.stops.sort(key=lambda l: l.distance)
-        # print(f"end distances sorting {datetime.now()} ({(datetime.now()-n).total_seconds()})")
+        with metrics.timer("distances_seconds", op="reload"):
+            for _i in self.stops:
+                _i.reload_distance(self.location)
+
+    def nearby_stops(self, location, num=10, radius=None):
+        """
+        returns a list of (stop, km) pairs, nearest first: the num nearest stops to location, or the ones within
+        radius kilometers if radius is given (at most num of them, unless num is None).
+        Doesn't touch TNBus.location or Stop.distance, so it's safe to call concurrently from many threads.
+        On a lazy TNBus it loads every area first: stops can't be located before they're loaded
+        """
+        if self.lazy and not self.frozen:
+            self.load_areas()
+        if radius is not None:
+            out = self._spatial.within(location, radius)
+            return out if num is None else out[:num]
+        return self._spatial.nearest(location, num)
 
     def nearest_stops(self, num=10, location=None):
-        if location:
+        # a frozen TNBus searches around location without moving to it
+        if location and not self.frozen:
             self.update_location(location)
-        for _s, _ in zip(self.stops, range(num)):
+        for _s, _ in self.nearby_stops(location or self.location, num):
             yield _s
 
     def nearest_stop(self):
-        return self.stops[0]
+        return self.nearby_stops(self.location, 1)[0][0]
+
+    def stops_within(self, radius, location=None):
+        # stops within radius kilometers, nearest first
+        if location and not self.frozen:
+            self.update_location(location)
+        for _s, _ in self.nearby_stops(location or self.location, None, radius):
+            yield _s
 
     def update_location(self, location: tuple[float, float]):
+        # kept for compatibility: sets the location used by nearest_stops and Stop.distance.
+        # distances are computed lazily, stops are looked up through the spatial index
+        self._writable()
         self.location = location
         self._reload_distances()
-        self._sort_by_distance()
 
     def get_stop(self, value, by=By.ID):
         return self.get(self.Stop, (by, value))
@@ -255,20 +965,193 @@ class TNBus:
     def get_area(self, value, by=By.ID):
         return self.get(self.Area, (by, value))
 
+    @property
+    def news_index(self):
+        if self._news_index is None:
+            self._news_index = NewsIndex(self.news)
+        return self._news_index
+
+    def get_news(self, route=None, stop=None, area=None):
+        """
+        the news of route, stop and area when given (objects or their ids, id_numeric for stops), in the order of news.
+        A route id matches the routes of every type with that id, a Route only itself
+        """
+        return self.news_index.news(self._news_route(route), getattr(stop, "id_numeric", stop),
+                                    getattr(area, "id", area))
+
+    @staticmethod
+    def _news_route(route):
+        # the key of route in the news index
+        return (route.id, route.type) if isinstance(route, TNBus.Route) else route
+
+    def active_news(self, at=None, route=None, stop=None, area=None):
+        """
+        like get_news, only the news active at at (an aware datetime, now by default). Looked up in the interval
+        trees of the news index instead of checking the window of every news
+        """
+        at = at or datetime.now(UTC)
+        return self.news_index.active(at.timestamp(), self._news_route(route), getattr(stop, "id_numeric", stop),
+                                      getattr(area, "id", area))
+
     def load_trips(self, search, since, limit):
         if not isinstance(search, (TNBus.Stop, TNBus.Route)):
             raise TypeError(search)
+        return self._store_trips(self.api.trips_new(search, since, limit), search)
+
+    def _store_trips(self, data, search):
+        # builds and records a trips_new response at once, so that copies never see half of it
+        with self._loading:
+            return self.record_trips(self.build_trips(data), search)
+
+    def record_trips(self, trips, search):
+        # links the loaded trips to the stop or route they were loaded for, and feeds them to the departure and
+        # journey indexes and, if any, to the history
+        with self._loading:
+            return self._record_trips(trips, search)
+
+    def _record_trips(self, trips, search):
+        now = datetime.now()
+        if isinstance(search, (TNBus.Stop, TNBus.Route)):
+            known = set(search.trips)
+            search.trips += [i for i in trips if i not in known]
+            search.trips_load = now
+        self._evict_trips(now)
+        self.departures.add(trips, search)
+        self.journeys.add(trips)
+        if self.history is not None:
+            self.history.record(trips, search if isinstance(search, TNBus.Stop) else None)
+        return trips
+
+    def build_trips(self, data):
+        # builds the Trip objects out of a trips_new response, updating in place the ones already known
+        with self._loading:
+            return self._build_trips(data)
+
+    def _build_trips(self, data):
         routes_ = {}
         out = []
-        for i in self.api.trips_new(search, since, limit):
+        for i in data:
             if i["routeId"] in routes_:
                 r = routes_[i["routeId"]]
             else:
-                r = self.get(TNBus.Route, (By.ID, i["routeId"]))
+                r = self._find(TNBus.Route, (By.ID, i["routeId"]))
+                if r is None and self._area_ids is not None:
+                    # a route of an area that isn't loaded: out of scope, unless areas are loaded lazily (a published
+                    # version can't load them anymore)
+                    if not self.lazy or self.frozen:
+                        continue
+                    self.load_areas()
+                    r = self._find(TNBus.Route, (By.ID, i["routeId"]))
+                    if r is None:
+                        continue
                 routes_[r.id] = r
-            out.append(TNBus.Trip(self, i, r))
+            trip = self._trip_ids.get(i["tripId"])
+            if trip is None:
+                trip = TNBus.Trip(self, i, r)
+                self._add(trip)
+            elif trip.route is not r:
+                # shouldn't happen, but the route is indexed
+                trip.route.trips.remove(trip)
+                self._update(trip, self, i, r)
+                r.trips.append(trip)
+            else:
+                trip.update(self, i, r)
+            out.append(trip)
+        return out
+
+    def _evict_trips(self, now):
+        # drops the trips not loaded in the last TRIPS_KEEP seconds
+        if (now - self._trips_evicted).total_seconds() < self.TRIPS_EVICT_EVERY:
+            return
+        self._trips_evicted = now
+        old = {i for i in self.trips if (now - i.seen).total_seconds() > self.TRIPS_KEEP}
+        if not old:
+            return
+        for i in old:
+            del self._trip_ids[i.id]
+            i.route.trips.remove(i)
+        self.trips = [i for i in self.trips if i not in old]
+        self._indexes[self.Trip].rebuild(self.trips)
+        for _s in self.stops:
+            if _s.trips:
+                _s.trips = [i for i in _s.trips if i not in old]
+
+    def _stop_at(self, id_num, type_):
+        # resolves the (stopId, type) pairs referenced by trips through the index instead of a scan
+        res = self._indexes[self.Stop].index((By.ID_NUM, By.TYPE)).lookup((id_num, type_))
+        if res is None:
+            res = self._find(TNBus.Stop, (By.ID_NUM, id_num), (By.TYPE, type_))
+        if not res and self._area_ids is not None:
+            # a stop of an area that isn't loaded: None, unless areas are loaded lazily (and the TNBus isn't frozen)
+            if self.lazy and not self.frozen:
+                self.load_areas()
+                res = self._find(TNBus.Stop, (By.ID_NUM, id_num), (By.TYPE, type_))
+            if not res:
+                return
+        if len(res) > 1:
+            raise TypeError(res)
+        return res[0]
+
+    def next_departures(self, stop, after=None, n=1, route=None, max_age=None):
+        """
+        the first n departures from stop at or after after (an aware datetime, now by default), optionally only of
+        route, as (expected datetime, trip) pairs. Answered from the departure index while the trips of stop were
+        loaded less than max_age seconds ago (DEPARTURES_MAX_AGE by default), the trips of stop are loaded otherwise
+        """
+        max_age = self.DEPARTURES_MAX_AGE if max_age is None else max_age
+        if not self.departures.fresh(stop, max_age):
+            # the first caller loads the trips, the ones waiting for it find them fresh
+            with self._loading:
+                if not self.departures.fresh(stop, max_age):
+                    self.load_trips(stop, after, max(n, 3))
+        return self.departures.next_departures(stop, after, n, route)
+
+    def _routes_of(self, keys):
+        # (route id, route type) keys of the journey index -> Route objects of this TNBus, None for the ones not loaded
+        out = {}
+        for k in keys:
+            if k not in out:
+                out[k] = self._find(TNBus.Route, (By.ID, k[0]), (By.TYPE, k[1]))
         return out
 
+    def direct_routes(self, a, b):
+        """
+        the routes going from stop a to stop b without changing, as (route, stops travelled) pairs, fewest first.
+        Answered from the stop patterns of the trips loaded so far, see JourneyIndex
+        """
+        res = self.journeys.direct(DepartureIndex.key(a), DepartureIndex.key(b))
+        routes = self._routes_of(r_ for r_, _ in res)
+        return [(routes[r_], hops) for r_, hops in res if routes[r_] is not None]
+
+    def transfer_routes(self, a, b, n=10):
+        """
+        the first n ways of going from stop a to stop b changing route once, as
+        (first route, transfer stop, second route, stops travelled), fewest stops first
+        """
+        res = self.journeys.one_transfer(DepartureIndex.key(a), DepartureIndex.key(b), n)
+        routes = self._routes_of(i for r1, _, r2, _ in res for i in (r1, r2))
+        out = []
+        for r1, key, r2, hops in res:
+            s_ = self._stop_at(*key)
+            if routes[r1] is not None and routes[r2] is not None and s_ is not None:
+                out.append((routes[r1], s_, routes[r2], hops))
+        return out
+
+    def journey(self, a, b, after=None, transfer=0):
+        """
+        the earliest arriving journey from stop a to stop b leaving at or after after (a datetime, now by default)
+        on the trips loaded so far, changing trip in at least transfer seconds. Returns its legs as
+        (trip, from stop, departure datetime, to stop, arrival datetime), or None if b can't be reached
+        """
+        after = after.timestamp() if after is not None else self.departures.clock()
+        res = JourneyIndex.earliest_arrival(self.departures.connections(), DepartureIndex.key(a),
+                                            DepartureIndex.key(b), after, transfer)
+        if res is None:
+            return
+        return [(self.departures.trip(trip_id), self._stop_at(*from_), datetime.fromtimestamp(dep, UTC),
+                 self._stop_at(*to), datetime.fromtimestamp(arr, UTC))
+                for trip_id, from_, dep, to, arr in res]
+
     def load_best_trip(self, search, since):
         res = self.load_trips(search=search, since=since, limit=1)
         best = None
@@ -281,8 +1164,30 @@ class TNBus:
         return best
 
     def dump(self, f_hand):
-        self.raw["age"] = self.age.timestamp()
-        json.dump(self.raw, f_hand)
+        raw = self.raw
+        raw["age"] = self.age.timestamp()
+        if self._area_ids is not None:
+            raw["loaded"] = sorted(self._area_ids)
+        json.dump(raw, f_hand)
+
+    def __getstate__(self):
+        # the api session, the history recorder and the compiled queries can't be pickled, see tnbus.snapshot
+        if self.shared is not None:
+            raise TypeError("a TNBus attached to a shared network can't be pickled")
+        state = self.__dict__.copy()
+        state["api"] = None
+        state["history"] = None
+        state["_queries"] = {}
+        state["_news_index"] = None
+        del state["_loading"], state["_queries_lock"]
+        # copies of a published version are writable
+        state.pop("frozen", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._loading = threading.RLock()
+        self._queries_lock = threading.Lock()
 
     class Area:
         SEARCH_ASSOC = {
@@ -294,15 +1199,31 @@ class TNBus:
             By.TYPE: "type"
         }
         SEARCH_STORE = "areas"
+        SEARCH_INDEX = ((By.ID,), (By.TYPE,))
+
+        __slots__ = ("id", "desc", "type", "routes", "stops", "_raw")
 
         def __init__(self, data):
+            self.routes = []
+            self.stops = []
+            self.update(data)
+
+        def update(self, data):
             self.id = data["areaId"]
             self.desc = data["areaDesc"]
             self.type = data["type"]
-            self.routes = []
-            self.stops = []
             self.raw = data
 
+        @property
+        def raw(self):
+            if self._raw is None:
+                return {"areaId": self.id, "areaDesc": self.desc, "type": self.type}
+            return self._raw
+
+        @raw.setter
+        def raw(self, value):
+            self._raw = value
+
         def __str__(self):
             return f"Area(id={self.id},desc=\"{self.desc}\",type={self.type})"
 
@@ -310,6 +1231,9 @@ class TNBus:
             return self.__str__()
 
         class New:
+            __slots__ = ("route", "area", "id_feed", "agency_id", "service_type", "start_date", "end_date", "header",
+                         "details", "stop_id", "url", "routes", "start", "end", "_raw")
+
             def __init__(self, data, route, area):
                 self.route = route
                 self.area = area
@@ -323,8 +1247,37 @@ class TNBus:
                 self.stop_id = data["stopId"]
                 self.url = data["url"]
                 self.routes = None
+                # the window the news is active in, parsed once (None for an open or unreadable bound)
+                self.start = self._parse(self.start_date)
+                self.end = self._parse(self.end_date)
                 self.raw = data
 
+            @staticmethod
+            def _parse(value):
+                try:
+                    return tz_dt_fromisoformat(value)
+                except (AttributeError, TypeError, ValueError):
+                    return
+
+            def active(self, at=None):
+                # whether the news is active at at (an aware datetime, now by default)
+                at = at or datetime.now(UTC)
+                return (self.start is None or self.start <= at) and (self.end is None or at < self.end)
+
+            @property
+            def raw(self):
+                if self._raw is None:
+                    return {
+                        "idFeed": self.id_feed, "agencyId": self.agency_id, "serviceType": self.service_type,
+                        "startDate": self.start_date, "endDate": self.end_date, "header": self.header,
+                        "details": self.details, "stopId": self.stop_id, "url": self.url
+                    }
+                return self._raw
+
+            @raw.setter
+            def raw(self, value):
+                self._raw = value
+
     class Route:
         SEARCH_ASSOC = {
             By.ID: "id",
@@ -337,29 +1290,63 @@ class TNBus:
             By.TRIP: "trips"
         }
         SEARCH_STORE = "routes"
+        SEARCH_INDEX = ((By.ID,), (By.TYPE,), (By.AREA,), (By.ID, By.TYPE))
         SEARCH_TRIPS_UPDATED = "trips_load"
 
         TRAIN = 2
         BUS = 3
         CABLEWAY = 5
 
+        __slots__ = ("area", "stops", "id", "news", "color", "long_name", "short_name", "type", "urban", "trips",
+                     "trips_load", "_raw")
+
         def __init__(self, data, area):
-            self.area = area
-            self.area.routes.append(self)
+            self.area = None
             self.stops = set()
+            self.news = None
+            self.trips = []
+            self.trips_load = datetime.fromtimestamp(0)
+            self.update(data, area)
+
+        def update(self, data, area):
+            if area is not self.area:
+                if self.area is not None:
+                    self.area.routes.remove(self)
+                self.area = area
+                self.area.routes.append(self)
             self.id = data["routeId"]
-            self.news = [TNBus.Area.New(i, self, area) for i in data["news"]] if data["news"] is not None else None
+            if data["news"] is not None:
+                # unchanged news keep their identity
+                old = self.news or []
+                self.news = [next((n for n in old if n.raw == i), None) or TNBus.Area.New(i, self, area)
+                             for i in data["news"]]
+                for i in self.news:
+                    i.area = area
+            else:
+                self.news = None
             self.color = data["routeColor"]
             self.long_name = data["routeLongName"]
             self.short_name = data["routeShortName"]
             self.type = data["type"]
             self.urban = True if data["routeType"] == "U" else False
 
-            self.trips = []
-            self.trips_load = datetime.fromtimestamp(0)
-
             self.raw = data
 
+        @property
+        def raw(self):
+            if self._raw is None:
+                return {
+                    "routeId": self.id, "areaId": self.area.id,
+                    "news": [i.raw for i in self.news] if self.news is not None else None,
+                    "routeColor": self.color, "routeLongName": self.long_name, "routeShortName": self.short_name,
+                    "type": self.type, "routeType": "U" if self.urban else "E"
+                }
+            return self._raw
+
+        @raw.setter
+        def raw(self, value):
+            self._raw = value
+
         def load_trips(self, t, since=datetime.now(), limit=1):
             return t.load_trips(self, since, limit)
 
@@ -381,11 +1368,23 @@ class TNBus:
             By.TRIP: "trips"
         }
         SEARCH_STORE = "stops"
+        SEARCH_INDEX = ((By.ID,), (By.ID_NUM,), (By.TYPE,), (By.ID_NUM, By.TYPE), (By.ID, By.TYPE))
         SEARCH_TRIPS_UPDATED = "trips_load"
 
+        __slots__ = ("routes", "areas", "id", "desc", "id_numeric", "level", "name", "street", "town", "type",
+                     "wheelchair_boarding", "location", "trips", "trips_load", "_origin", "_distance", "_raw")
+
         def __init__(self, data, location):
             self.routes = []
             self.areas = set()
+            # trips loaded for this stop, see TNBus.record_trips
+            self.trips = []
+            self.trips_load = datetime.fromtimestamp(0)
+            self._origin = location
+            self._distance = None
+            self.update(data)
+
+        def update(self, data):
             self.id = data["stopCode"]
             self.desc = data["stopDesc"]
             # id_numeric is UNRELIABLE!
@@ -398,19 +1397,44 @@ class TNBus:
             self.wheelchair_boarding = data["wheelchairBoarding"]
 
             self.location = (data["stopLat"], data["stopLon"])
-            self.distance = geodesic(self.location, location).kilometers
 
             self.raw = data
 
+        @property
+        def raw(self):
+            if self._raw is None:
+                return {
+                    "stopCode": self.id, "stopDesc": self.desc, "stopId": self.id_numeric, "stopLevel": self.level,
+                    "stopName": self.name, "street": self.street, "town": self.town, "type": self.type,
+                    "wheelchairBoarding": self.wheelchair_boarding, "stopLat": self.location[0],
+                    "stopLon": self.location[1], "routes": [{"routeId": r.id, "type": r.type} for r in self.routes]
+                }
+            return self._raw
+
+        @raw.setter
+        def raw(self, value):
+            self._raw = value
+
+        @property
+        def distance(self):
+            # the cached distance is kept together with the origin it was computed from, so that concurrent
+            # reload_distance calls can't leave a distance paired with the wrong location
+            origin, cached = self._origin, self._distance
+            if cached is None or cached[0] != origin:
+                cached = (origin, geodesic(self.location, origin).kilometers)
+                self._distance = cached
+            return cached[1]
+
         def reload_distance(self, location):
-            self.distance = geodesic(self.location, location).kilometers
+            self._origin = location
 
         def get_trip_stop(self, trip):
             if not isinstance(trip, TNBus.Trip):
                 raise TypeError(trip)
 
+            # compares the references instead of resolving the stop of every stop time
             for i_ in trip.times:
-                if i_.stop == self:
+                if i_.stop_id == self.id_numeric and i_.type == self.type and i_.stop == self:
                     return i_
 
         def load_trips(self, t, since=datetime.now(), limit=1):
@@ -423,18 +1447,37 @@ class TNBus:
             return self.__str__()
 
     class TripStopTime:
+        __slots__ = ("arrival", "departureTime", "stop_id", "sequence", "trip", "type", "_stop", "_raw")
+
         def __init__(self, t, data, trip):
             self.arrival = tz_t_fromisoformat(data["arrivalTime"])
             self.departureTime = tz_t_fromisoformat(data["departureTime"])
             self.stop_id = data["stopId"]
+            self.sequence = data["stopSequence"]
             self.trip = trip
             self.type = data["type"]
-            stop_res = t.get(TNBus.Stop, (By.ID_NUM, self.stop_id), (By.TYPE, self.type))
-            if len(stop_res) > 1:
-                raise TypeError(stop_res)
-            self.stop = stop_res[0]
+            # resolved on first access
+            self._stop = None
 
-            self.raw = data
+            self.raw = data if t.keep_raw else None
+
+        @property
+        def stop(self):
+            if self._stop is None:
+                self._stop = self.trip.t._stop_at(self.stop_id, self.type)
+            return self._stop
+
+        @property
+        def raw(self):
+            if self._raw is None:
+                return {"arrivalTime": self.arrival.isoformat(), "departureTime": self.departureTime.isoformat(),
+                        "stopId": self.stop_id, "stopSequence": self.sequence, "tripId": self.trip.id,
+                        "type": self.type}
+            return self._raw
+
+        @raw.setter
+        def raw(self, value):
+            self._raw = value
 
         def __str__(self):
             return f"TripStopTime(arrival={self.arrival}, stop={self.stop})"
@@ -444,7 +1487,7 @@ class TNBus:
 
     class Trip:
         SEARCH_ASSOC = {
-            By.ROUTE: "routes",
+            By.ROUTE: "route",
             By.STOP: "stops",
             # search trip by id is very limiting!
             By.ID: "id",
@@ -454,23 +1497,45 @@ class TNBus:
             By.MIN_DATE: "",
             By.STATE: ""
         }
+        SEARCH_STORE = "trips"
+        SEARCH_INDEX = ((By.ID,), (By.ROUTE,))
 
         NOT_DEPARTED = 0
         DEPARTED = 1
         ARRIVED = 2
 
+        __slots__ = ("id", "cable_way", "best", "delay", "direction", "signal", "last_sync", "last_sequence_detection",
+                     "bus", "actual_arrive_time", "scheduled_arrive_time", "route", "t", "_stop_times", "_times",
+                     "last", "next", "totale_corse_in_lista", "start", "state", "trip_headsign", "type",
+                     "wheelchair_accessible", "seen", "_raw")
+
         def __init__(self, t, data, route):
             if not isinstance(route, TNBus.Route):
                 raise TypeError(f"\"route\" argument must be of type TNBus.Route, {type(route).__str__} given.")
             self.id = data["tripId"]
             self.cable_way = data["cableway"]
+            self.direction = data["directionId"]
+            self.route = route
+            self.t = t
+            # TripStopTime objects are only built when times is first accessed
+            self._stop_times = data["stopTimes"]
+            self._times = None
+            self.start = tz_t_fromisoformat(self._stop_times[0]["departureTime"])
+            self.trip_headsign = data["tripHeadsign"]
+            self.type = data["type"]
+            self.wheelchair_accessible = data["wheelchairAccessible"]
+            self.bus = None
+            self._observe(t, data)
+
+        def _observe(self, t, data):
+            # the fields that change from a poll to the next, or depend on the stop the trip was loaded for
             self.best = data["corsaPiuVicinaADataRiferimento"]
             self.delay = data["delay"]
-            self.direction = data["directionId"]
             self.signal = data["indiceCorsaInLista"]
             self.last_sync = tz_dt_fromisoformat(data["lastEventRecivedAt"][:-1]) if data["lastEventRecivedAt"] else None
             self.last_sequence_detection = data["lastSequenceDetection"]
-            self.bus = TNBus.Bus(data["matricolaBus"])
+            if self.bus is None or self.bus.id != data["matricolaBus"]:
+                self.bus = TNBus.Bus(data["matricolaBus"])
             try:
                 self.actual_arrive_time = tz_dt_fromisoformat(data["oraArrivoEffettivaAFermataSelezionata"])
             except TypeError:
@@ -479,17 +1544,18 @@ class TNBus:
                 self.scheduled_arrive_time = tz_dt_fromisoformat(data["oraArrivoProgrammataAFermataSelezionata"])
             except TypeError:
                 self.scheduled_arrive_time = None
-            self.route = route
-            self.times = [TNBus.TripStopTime(t, i, self) for i in data["stopTimes"]]
             self.last = None
             self.next = None
-            for i in self.times:
-                if i.stop_id == data["stopLast"]:
-                    self.last = i.stop
-                if i.stop_id == data["stopNext"]:
-                    self.next = i.stop
+            for i in data["stopTimes"]:
+                if i["stopId"] == data["stopLast"]:
+                    self.last = (i["stopId"], i["type"])
+                if i["stopId"] == data["stopNext"]:
+                    self.next = (i["stopId"], i["type"])
+            if self.last is not None:
+                self.last = t._stop_at(*self.last)
+            if self.next is not None:
+                self.next = t._stop_at(*self.next)
             self.totale_corse_in_lista = data["totaleCorseInLista"]
-            self.start = self.times[0].departureTime
 
             # TODO: finish compiling this case
             if data["tripFlag"] == "TRIP_FLAG__MID":
@@ -498,10 +1564,69 @@ class TNBus:
                 self.state = self.ARRIVED
             else:
                 self.state = self.NOT_DEPARTED
-            self.trip_headsign = data["tripHeadsign"]
-            self.type = data["type"]
-            self.wheelchair_accessible = data["wheelchairAccessible"]
-            self.raw = data
+            self.seen = datetime.now()
+            self.raw = data if t.keep_raw else None
+
+        def _same_times(self, stop_times):
+            if self._times is None:
+                return self._stop_times == stop_times
+            return len(stop_times) == len(self._times) and all(
+                o_.stop_id == n_["stopId"] and o_.type == n_["type"] and o_.sequence == n_["stopSequence"] and
+                o_.arrival == tz_t_fromisoformat(n_["arrivalTime"]) and
+                o_.departureTime == tz_t_fromisoformat(n_["departureTime"])
+                for o_, n_ in zip(self._times, stop_times)
+            )
+
+        def update(self, t, data, route):
+            # merges a new observation of the same trip, keeping the stop times (and their resolved stops) if the
+            # schedule didn't change
+            self.route = route
+            if not self._same_times(data["stopTimes"]):
+                self._stop_times = data["stopTimes"]
+                self._times = None
+                self.start = tz_t_fromisoformat(self._stop_times[0]["departureTime"])
+            self._observe(t, data)
+
+        @property
+        def stops(self):
+            return [i.stop for i in self.times]
+
+        @property
+        def times(self):
+            if self._times is None:
+                self._times = [TNBus.TripStopTime(self.t, i, self) for i in self._stop_times]
+                self._stop_times = None
+            return self._times
+
+        def stop_times(self):
+            # (stop id_numeric, stop type, departure time) of every stop, without building times if it isn't yet
+            if self._times is not None:
+                return [(i.stop_id, i.type, i.departureTime) for i in self._times]
+            return [(i["stopId"], i["type"], tz_t_fromisoformat(i["departureTime"])) for i in self._stop_times]
+
+        @property
+        def raw(self):
+            if self._raw is None:
+                return {
+                    "tripId": self.id, "cableway": self.cable_way, "corsaPiuVicinaADataRiferimento": self.best,
+                    "delay": self.delay, "directionId": self.direction, "indiceCorsaInLista": self.signal,
+                    "lastEventRecivedAt": tz_dt_toisoformat(self.last_sync),
+                    "lastSequenceDetection": self.last_sequence_detection, "matricolaBus": self.bus.id,
+                    "oraArrivoEffettivaAFermataSelezionata": tz_dt_toisoformat(self.actual_arrive_time),
+                    "oraArrivoProgrammataAFermataSelezionata": tz_dt_toisoformat(self.scheduled_arrive_time),
+                    "routeId": self.route.id, "stopTimes": [i.raw for i in self.times],
+                    "stopLast": self.last.id_numeric if self.last else None,
+                    "stopNext": self.next.id_numeric if self.next else None,
+                    "totaleCorseInLista": self.totale_corse_in_lista,
+                    "tripFlag": {self.DEPARTED: "TRIP_FLAG__MID", self.ARRIVED: ""}.get(self.state),
+                    "tripHeadsign": self.trip_headsign, "type": self.type,
+                    "wheelchairAccessible": self.wheelchair_accessible
+                }
+            return self._raw
+
+        @raw.setter
+        def raw(self, value):
+            self._raw = value
 
         def __str__(self):
             return f"Trip(id={self.id}, route={self.route}, start={self.start})"
@@ -510,42 +1635,197 @@ class TNBus:
             return str(self)
 
     class Bus:
+        __slots__ = ("id",)
+
         def __init__(self, _id):
             self.id = _id
 
 
 class API:
     URL = "https://app-tpl.tndigit.it/gtlservice"
+    # statuses worth retrying, everything else is returned as it is
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+    # seconds a retry waits at most, whatever Retry-After asks for
+    MAX_WAIT = 30
 
-    def __init__(self, key, preload=None):
+    def __init__(self, key, preload=None, url=None, pool_size=10, timeout=(3.05, 15), retries=3, backoff=.5,
+                 cache=None):
+        """
+        :param url: base url of the service, defaults to API.URL
+        :param pool_size: number of keep-alive connections kept in the pool
+        :param timeout: (connect, read) timeout in seconds, as accepted by requests
+        :param retries: number of retries on connection errors, timeouts and RETRY_STATUS responses
+        :param backoff: base of the exponential backoff between retries, in seconds (jittered)
+        :param cache: an optional tnbus.cache.ResponseCache shared by the json endpoints
+        """
         self.auth = {"Authorization": f"Basic {key}"}
-
-    def query(self, call, para=None):
+        self.url = url or self.URL
+        self.cache = cache
+        self._validators = {}
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+        self.session = requests.Session()
+        self.session.headers.update(self.auth)
+        self.session.headers["Accept-Encoding"] = "gzip, deflate"
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def _delay(self, attempt, headers=None):
+        # the Retry-After of headers, in seconds or as a date, or else the jittered exponential backoff: between 0 and
+        # MAX_WAIT seconds either way. Shared by tnbus.aio.AsyncAPI
+        delay = None
+        value = headers.get("Retry-After") if headers is not None else None
+        if value is not None:
+            try:
+                delay = float(value)
+            except ValueError:
+                try:
+                    at = parsedate_to_datetime(value)
+                    delay = (at if at.tzinfo else UTC.localize(at)).timestamp() - datetime.now(UTC).timestamp()
+                except (AttributeError, TypeError, ValueError):
+                    pass
+        if delay is None or delay != delay:
+            delay = self.backoff * 2 ** attempt * (.5 + random())
+        return min(max(delay, 0.), self.MAX_WAIT)
+
+    def _wait(self, attempt, res=None):
+        sleep(self._delay(attempt, None if res is None else res.headers))
+
+    def request(self, call, para=None, headers=None, stream=False):
+        # GET call through the pooled session, retrying with jittered exponential backoff.
+        # with stream the body is left to be read (and the response closed) by the caller
         if para is None:
             para = {}
-        return requests.get(f"{self.URL}/{call}",
-                            params=para,
-                            headers=self.auth
-                            ).text
+        endpoint = call.split("/")[0]
+        for attempt in range(self.retries + 1):
+            start = perf_counter() if metrics.sinks else None
+            try:
+                res = self.session.get(f"{self.url}/{call}", params=para, headers=headers, timeout=self.timeout,
+                                       stream=stream)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if metrics.sinks:
+                    metrics.inc("api_errors_total", endpoint=endpoint, kind=type(e).__name__)
+                if attempt == self.retries:
+                    raise
+                if metrics.sinks:
+                    metrics.inc("api_retries_total", endpoint=endpoint)
+                self._wait(attempt)
+                continue
+            if start is not None and metrics.sinks:
+                self._measure(endpoint, res.status_code, start, None if stream else len(res.content))
+            if res.status_code not in self.RETRY_STATUS or attempt == self.retries:
+                return res
+            res.close()
+            if metrics.sinks:
+                metrics.inc("api_retries_total", endpoint=endpoint)
+            self._wait(attempt, res)
+
+    @staticmethod
+    def _measure(endpoint, status, start, size):
+        # a streamed body isn't downloaded yet (size None): its latency is the time to the headers
+        metrics.inc("api_requests_total", endpoint=endpoint, status=status)
+        metrics.observe("api_request_seconds", perf_counter() - start, endpoint=endpoint)
+        if status >= 400:
+            metrics.inc("api_errors_total", endpoint=endpoint, kind=f"http_{status}")
+        if size is not None:
+            metrics.observe("api_response_bytes", size, endpoint=endpoint)
+
+    @staticmethod
+    def _decode(call, content):
+        if not metrics.sinks:
+            return json_loads(content)
+        with metrics.timer("json_decode_seconds", endpoint=call.split("/")[0]):
+            return json_loads(content)
+
+    def query(self, call, para=None):
+        return self.request(call, para).text
+
+    def query_json(self, call, para=None):
+        # json is decoded straight from the (already decompressed) response bytes
+        if self.cache is not None:
+            return self.cache.get_or_fetch(call, para, lambda: self._decode(call, self.request(call, para).content))
+        return self._decode(call, self.request(call, para).content)
+
+    def iter_json(self, call, para=None):
+        """
+        yields the elements of the json array returned by call while it's being downloaded, see tnbus.stream.
+        responses served through the cache are complete already
+        """
+        if self.cache is not None:
+            yield from self.query_json(call, para)
+            return
+        res = self.request(call, para, stream=True)
+        try:
+            yield from iter_array(res.iter_content(CHUNK))
+        finally:
+            res.close()
+
+    def query_changed(self, call, para=None):
+        """
+        like query_json, bypassing the cache, but returns None when the response didn't change since the last
+        query_changed of the same call: either the server answered 304 to a conditional request, or the payload
+        has the same content hash
+        """
+        key = (call, tuple(sorted((para or {}).items())))
+        etag, modified, digest = self._validators.get(key, (None, None, None))
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if modified:
+            headers["If-Modified-Since"] = modified
+        res = self.request(call, para, headers)
+        if res.status_code == 304:
+            return
+        new_digest = sha1(res.content).digest()
+        self._validators[key] = (res.headers.get("ETag"), res.headers.get("Last-Modified"), new_digest)
+        if new_digest == digest:
+            return
+        return self._decode(call, res.content)
 
     def routes(self, areas=None):
         if areas is not None:
             areas = ",".join(areas)
-        return json.loads(self.query("routes", {"areas": areas}))
+        return self.query_json("routes", {"areas": areas})
 
     def stops(self, areas=None):
         if areas is not None:
             areas = ",".join(areas)
-        return json.loads(self.query("stops", {"areas": areas}))
+        return self.query_json("stops", {"areas": areas})
+
+    def iter_routes(self, areas=None):
+        if areas is not None:
+            areas = ",".join(areas)
+        return self.iter_json("routes", {"areas": areas})
+
+    def iter_stops(self, areas=None):
+        if areas is not None:
+            areas = ",".join(areas)
+        return self.iter_json("stops", {"areas": areas})
 
     def areas(self):
-        return json.loads(self.query("areas"))
+        return self.query_json("areas")
 
     def trip(self, t, trip_id: str, ro=None):
-        res = json.loads(self.query(f"trips/{trip_id}"))
+        res = self.query_json(f"trips/{trip_id}")
         return TNBus.Trip(t, res, ro)
 
     def trips_new(self, search: (TNBus.Stop, TNBus.Route), time=None, limit=30):
+        return self.query_json("trips_new", self.trips_new_args(search, time, limit))
+
+    @staticmethod
+    def trips_new_args(search: (TNBus.Stop, TNBus.Route), time=None, limit=30):
         args = {
             "limit": limit,
             "type": search.type,
@@ -557,7 +1837,7 @@ class API:
             args["routeId"] = search.id
         else:
             raise TypeError(f"{search} is of type {type(search)}")
-        return json.loads(self.query("trips_new", args))
+        return args
 
 
 if __name__ == "__main__":
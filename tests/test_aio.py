@@ -0,0 +1,66 @@
+import asyncio
+
+import pytest
+
+from network import network, FixtureAPI
+from tnbus.aio import AsyncTNBus
+
+
+class AsyncFixtureAPI:
+    # FixtureAPI with the coroutine interface of AsyncAPI, counting the routes and stops calls
+    def __init__(self, net):
+        self.fixture = FixtureAPI(net)
+        self.calls = []
+
+    async def areas(self):
+        return self.fixture.areas()
+
+    async def routes(self, areas=None):
+        self.calls.append(("routes", areas))
+        return self.fixture.routes(areas)
+
+    async def stops(self, areas=None):
+        self.calls.append(("stops", areas))
+        return self.fixture.stops(areas)
+
+    async def trips_new(self, search, time=None, limit=30):
+        return self.fixture.trips_new(search, time, limit)
+
+
+def test_create_honours_areas():
+    async def main():
+        api = AsyncFixtureAPI(network(300, 30))
+        t = await AsyncTNBus.create(api, areas=[1])
+        assert api.calls == [("routes", ["1"]), ("stops", ["1"])]
+        assert {r.area.id for r in t.routes} == {1}
+        await t.load_area(2)
+        assert {r.area.id for r in t.routes} == {1, 2}
+
+    asyncio.run(main())
+
+
+def test_create_lazy():
+    async def main():
+        api = AsyncFixtureAPI(network(300, 30))
+        t = await AsyncTNBus.create(api, lazy=True)
+        assert api.calls == [] and t.routes == []
+        # a lazy load on the loop would block it
+        with pytest.raises(RuntimeError):
+            t.get_stop(1)
+        await asyncio.get_running_loop().run_in_executor(None, t.get_stop, 1)
+        assert t.routes and t.stops
+
+    asyncio.run(main())
+
+
+def test_load_trips_lazy():
+    async def main():
+        api = AsyncFixtureAPI(network(300, 30))
+        t = await AsyncTNBus.create(api, areas=[1], lazy=True)
+        stops = t.stops[:5]
+        # the trips call at routes of the other areas, which are loaded through the loop
+        res = await t.load_trips_many(stops, limit=30)
+        assert all(res) and len(t.loaded_areas) > 1
+        assert await t.next_departures(stops[0], n=3) is not None
+
+    asyncio.run(main())
@@ -0,0 +1,117 @@
+import asyncio
+import json
+import threading
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from tnbus import API
+
+
+class StandIn(ThreadingHTTPServer):
+    # answers with the (status, headers) queued for it, 200 and a json list when the queue is empty; records the
+    # client port of every request, which tells the connections apart
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), Handler)
+        self.queue = []
+        self.ports = []
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.ports.append(self.client_address[1])
+            status, headers = self.server.queue.pop(0) if self.server.queue else (200, {})
+        body = json.dumps([{"areaId": 1}]).encode() if status == 200 else b"{}"
+        self.send_response(status)
+        for k, v_ in headers.items():
+            self.send_header(k, v_)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_):
+        pass
+
+
+@pytest.fixture
+def server():
+    out = StandIn()
+    yield out
+    out.shutdown()
+    out.server_close()
+
+
+def test_retries_429_and_503(server):
+    api = API("k", url=server.url, backoff=.01)
+    server.queue = [(503, {}), (429, {"Retry-After": "0"}), (503, {})]
+    assert api.areas() == [{"areaId": 1}]
+    assert len(server.ports) == 4
+
+
+def test_gives_up_after_retries(server):
+    api = API("k", url=server.url, retries=2, backoff=.01)
+    server.queue = [(503, {})] * 5
+    assert api.request("areas").status_code == 503
+    assert len(server.ports) == 3
+
+
+def test_retry_after_is_bounded(server):
+    api = API("k", url=server.url, backoff=.01)
+    api.MAX_WAIT = .2
+    # an hour, a date in the past and a negative value
+    server.queue = [(429, {"Retry-After": "3600"}), (503, {"Retry-After": formatdate(time.time() - 60, usegmt=True)}),
+                    (503, {"Retry-After": "-5"})]
+    start = time.perf_counter()
+    assert api.areas() == [{"areaId": 1}]
+    assert time.perf_counter() - start < 1
+    assert api._delay(0, {"Retry-After": "3600"}) == .2
+    assert api._delay(0, {"Retry-After": formatdate(time.time() + 3600, usegmt=True)}) == .2
+    assert api._delay(0, {"Retry-After": formatdate(time.time() - 60, usegmt=True)}) == 0
+    assert api._delay(0, {"Retry-After": "-5"}) == 0
+    assert 0 < api._delay(0, {"Retry-After": "soon"}) <= .2
+
+
+def test_connections_are_pooled(server):
+    api = API("k", url=server.url, pool_size=4)
+    for _ in range(20):
+        api.areas()
+    assert len(set(server.ports)) == 1
+    threads = [threading.Thread(target=lambda: [api.areas() for _ in range(10)]) for _ in range(8)]
+    for t_ in threads:
+        t_.start()
+    for t_ in threads:
+        t_.join()
+    # requests reuse the pool: at most pool_size connections are kept, and most requests find one
+    assert len(server.ports) == 100
+    assert len(set(server.ports)) < 40
+
+
+def test_async_retries_and_pooling(server):
+    aio = pytest.importorskip("tnbus.aio")
+    pytest.importorskip("aiohttp")
+
+    async def main():
+        async with aio.AsyncAPI("k", url=server.url, pool_size=4, backoff=.01) as api:
+            api.MAX_WAIT = .2
+            server.queue = [(429, {"Retry-After": "3600"}), (503, {})]
+            start = time.perf_counter()
+            assert await api.areas() == [{"areaId": 1}]
+            assert time.perf_counter() - start < 1
+            await asyncio.gather(*(api.areas() for _ in range(40)))
+        assert len(set(server.ports[3:])) <= 4
+
+    asyncio.run(main())
@@ -0,0 +1,60 @@
+import copy
+import io
+import json
+
+from network import network, FixtureAPI
+from tnbus import TNBus, By
+
+
+class CachingAPI(FixtureAPI):
+    # hands out the same lists for the same call, like ResponseCache does
+    def __init__(self, net):
+        super().__init__(net)
+        self.cache = {}
+
+    def routes(self, areas=None):
+        return self.cache.setdefault(("routes", tuple(areas or ())), super().routes(areas))
+
+    def stops(self, areas=None):
+        return self.cache.setdefault(("stops", tuple(areas or ())), super().stops(areas))
+
+
+def sizes(lists):
+    return {k: len(v_) for k, v_ in lists.items()}
+
+
+def test_load_areas_leaves_api_responses_alone():
+    api = CachingAPI(network(300, 30))
+    t = TNBus(api, areas=[1])
+    before = sizes(api.cache)
+    t.load_area(2)
+    assert {k: v_ for k, v_ in sizes(api.cache).items() if k in before} == before
+    assert {r.area.id for r in t.routes} == {1, 2}
+    assert len(t.raw["routes"]) == len(api.routes(["1"])) + len(api.routes(["2"]))
+
+
+def test_load_areas_leaves_preload_alone():
+    net = network(300, 30)
+    f = io.StringIO()
+    TNBus(FixtureAPI(copy.deepcopy(net)), areas=[1]).dump(f)
+    preload = json.loads(f.getvalue())
+    before = sizes({k: preload[k] for k in ("routes", "stops")})
+    t = TNBus(FixtureAPI(net), preload=preload)
+    t.load_area(2)
+    assert sizes({k: preload[k] for k in ("routes", "stops")}) == before
+    assert len(t.raw["routes"]) > before["routes"]
+
+
+def test_lazy_get_scope():
+    t = TNBus(FixtureAPI(network(300, 30)), areas=[], lazy=True)
+    assert t.loaded_areas == []
+    area = t.get_area(2)
+    t.get(TNBus.Route, (By.AREA, area))
+    assert [a.id for a in t.loaded_areas] == [2]
+    # stops of a route are in its area
+    route = t.get(TNBus.Route, (By.AREA, area))[0]
+    assert t.get(TNBus.Stop, (By.ROUTE, route), (By.NAME_MATCH, "a"))
+    assert [a.id for a in t.loaded_areas] == [2]
+    # an id could be anywhere
+    t.get_stop("nope")
+    assert len(t.loaded_areas) == len(t.areas)
@@ -0,0 +1,45 @@
+from datetime import datetime, time, timezone
+from types import SimpleNamespace
+
+from tnbus.departures import DepartureIndex
+
+T0 = datetime(2023, 1, 10, 7, tzinfo=timezone.utc)
+
+
+def trip(trip_id, stops):
+    # a trip calling at stops, (stop id_numeric, "HH:MM") pairs, the first one being its selected stop
+    times = [(s_, "U", time.fromisoformat(t_)) for s_, t_ in stops]
+    return SimpleNamespace(id=trip_id, route=SimpleNamespace(id=400), scheduled_arrive_time=T0,
+                           actual_arrive_time=None, delay=0, start=times[0][2], stop_times=lambda: times)
+
+
+def test_evict_looping_trip():
+    d = DepartureIndex(grace=0, clock=lambda: T0.timestamp())
+    # a circular trip calls at stop 1 twice, and those are its last departures once stop 2 is evicted
+    d.add([trip("loop", [(2, "07:00"), (1, "07:05"), (1, "07:20")]),
+           trip("other", [(1, "07:10"), (3, "07:40")]),
+           trip("late", [(3, "07:30")])], at=T0.timestamp())
+    assert len(d) == 6
+
+    at = T0.timestamp() + 25 * 60
+    d.evict(at)
+    assert len(d) == 2
+    # evicting again, and indexing more trips, keep working
+    d.evict(at + 60)
+    d.add([trip("next", [(1, "07:50"), (2, "08:00")])], at=at + 120)
+    stop = SimpleNamespace(id_numeric=1, type="U")
+    assert [i.id for _, i in d.next_departures(stop, datetime.fromtimestamp(at, timezone.utc), n=5)] == ["next"]
+    assert [i.id for _, i in d.next_departures(SimpleNamespace(id_numeric=3, type="U"),
+                                                datetime.fromtimestamp(at, timezone.utc), n=5)] == ["late", "other"]
+
+
+def test_routes_sharing_an_id():
+    d = DepartureIndex(grace=0, clock=lambda: T0.timestamp())
+    urban, extra = trip("u", [(1, "07:10")]), trip("e", [(1, "07:20")])
+    extra.route = SimpleNamespace(id=400, type=2)
+    urban.route.type = 3
+    d.add([urban, extra], at=T0.timestamp())
+    stop = SimpleNamespace(id_numeric=1, type="U")
+    assert [i.id for _, i in d.next_departures(stop, T0, n=5, route=400)] == ["u", "e"]
+    assert [i.id for _, i in d.next_departures(stop, T0, n=5, route=extra.route)] == ["e"]
+    assert [i.id for _, i in d.next_departures(stop, T0, n=5, route=SimpleNamespace(id=400, type=3))] == ["u"]
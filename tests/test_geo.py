@@ -0,0 +1,53 @@
+import random
+
+from geopy.distance import geodesic
+
+from network import network, FixtureAPI
+from tnbus import TNBus
+from tnbus.geo import SpatialIndex
+
+
+def brute(objs, location):
+    # every (obj, km) pair sorted by geodesic distance, ties in insertion order
+    return sorted(((o_, geodesic(o_.location, location).kilometers) for o_ in objs),
+                  key=lambda i_: i_[1])
+
+
+def locations(rnd, n):
+    # around and beyond the fixture network
+    return [(46.07 + rnd.uniform(-.4, .4), 11.12 + rnd.uniform(-.4, .4)) for _ in range(n)]
+
+
+def test_nearest_and_within_match_a_geodesic_sort():
+    t = TNBus(FixtureAPI(network(300, 30)))
+    index = SpatialIndex()
+    for s_ in t.stops:
+        index.add(s_)
+    rnd = random.Random(1)
+    for location in locations(rnd, 40):
+        expected = brute(t.stops, location)
+        num = rnd.choice([1, 5, 30, 400])
+        assert index.nearest(location, num) == expected[:num]
+        radius = rnd.choice([.5, 2, 8, 30])
+        assert index.within(location, radius) == [i_ for i_ in expected if i_[1] <= radius]
+
+
+def test_remove_and_add_again():
+    t = TNBus(FixtureAPI(network(300, 30)))
+    index = SpatialIndex()
+    for s_ in t.stops:
+        index.add(s_)
+    rnd = random.Random(2)
+    # removing and adding the same objects over and over, like refresh does, keeps the index the same size
+    for _ in range(5):
+        for s_ in rnd.sample(t.stops, 100):
+            index.remove(s_)
+            index.add(s_)
+    assert len(index) == len(index.position) == len(t.stops)
+    removed = set(rnd.sample(t.stops, 150))
+    for s_ in removed:
+        index.remove(s_)
+    left = sorted((s_ for s_ in t.stops if s_ not in removed), key=index.position.__getitem__)
+    for location in locations(rnd, 15):
+        assert index.nearest(location, 20) == brute(left, location)[:20]
+        assert index.within(location, 3) == [i_ for i_ in brute(left, location) if i_[1] <= 3]
@@ -0,0 +1,54 @@
+import threading
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from tnbus.history import History
+
+T0 = datetime(2023, 1, 10, 7, tzinfo=timezone.utc)
+
+
+def trip(trip_id, delay, route=400):
+    return SimpleNamespace(id=trip_id, route=SimpleNamespace(id=route), scheduled_arrive_time=T0,
+                           actual_arrive_time=None, delay=delay, last_sequence_detection=3, state=1)
+
+
+def test_rows_while_recording():
+    h = History(segment_size=10 ** 9)
+    stop = threading.Event()
+    errors = []
+
+    def record():
+        n = 0
+        while not stop.is_set() and n < 20000:
+            try:
+                h.record([trip(f"t{n % 50}", n % 7)], observed=T0.timestamp() + n)
+            except Exception as e:
+                errors.append(e)
+                return
+            n += 1
+
+    thread = threading.Thread(target=record)
+    thread.start()
+    try:
+        while thread.is_alive():
+            rows = h.rows(since=T0.timestamp())
+            assert len({len(c_) for c_ in rows.values()}) == 1
+    finally:
+        stop.set()
+        thread.join()
+    assert not errors
+    assert len(h.rows()["observed"]) == len(h)
+
+
+def test_delays_count_trips_once():
+    h = History()
+    day = T0 + timedelta(hours=1)
+    # one trip polled many times, its delay growing, and another polled once
+    for n in range(10):
+        h.record([trip("a", n)], observed=T0.timestamp() + 60 * n)
+    h.record([trip("b", 2)], observed=T0.timestamp())
+    res = h.delays(route=400, day=day)
+    assert res["count"] == 2
+    assert res["mean"] == (9 + 2) / 2
+    # rows keep every observation
+    assert len(h) == 11
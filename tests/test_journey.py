@@ -0,0 +1,86 @@
+import pickle
+from types import SimpleNamespace
+
+from network import network, FixtureAPI
+from tnbus import TNBus, By
+from tnbus.journey import JourneyIndex
+
+
+def trip(trip_id, stops, route=400, type_=3):
+    # a trip of route calling at stops, stop id_numerics
+    return SimpleNamespace(id=trip_id, route=SimpleNamespace(id=route, type=type_),
+                           stop_times=lambda: [(s_, "U", None) for s_ in stops])
+
+
+def key(stop):
+    return stop, "U"
+
+
+def test_trip_with_new_stop_times_moves_pattern():
+    j = JourneyIndex()
+    j.add([trip("a", [1, 2, 3]), trip("b", [1, 2, 3])], at=0)
+    # a detour: a no longer calls at 2, b still follows the first pattern
+    j.add([trip("a", [1, 4, 3])], at=10)
+    assert sorted(j.patterns(400)) == [[key(1), key(2), key(3)], [key(1), key(4), key(3)]]
+    j.add([trip("b", [1, 4, 3])], at=20)
+    assert j.patterns(400) == [[key(1), key(4), key(3)]]
+    assert j.direct(key(1), key(2)) == []
+    assert j.direct(key(4), key(3)) == [((400, 3), 1)]
+
+
+def test_evict_trips_not_loaded_again():
+    j = JourneyIndex(keep=100)
+    j.add([trip("a", [1, 2, 3]), trip("b", [3, 5], route=401)], at=0)
+    j.add([trip("b", [3, 5], route=401)], at=90)
+    j.evict(150)
+    assert len(j) == 1
+    assert j.direct(key(1), key(3)) == []
+    assert j.direct(key(3), key(5)) == [((401, 3), 1)]
+    j.add([trip("c", [5, 6], route=402)], at=160)
+    assert j.one_transfer(key(3), key(6)) == [((401, 3), key(5), (402, 3), 2)]
+    j.evict(1000)
+    assert len(j) == 0 and j.direct(key(3), key(5)) == []
+    assert len(pickle.loads(pickle.dumps(j))) == 0
+
+
+def test_routes_sharing_an_id():
+    # an urban and an extraurban route with the same id, going different ways
+    j = JourneyIndex()
+    j.add([trip("u", [1, 2, 3], type_=3), trip("e", [3, 2, 1], type_=2)], at=0)
+    assert len(j) == 2
+    assert j.direct(key(1), key(3)) == [((400, 3), 2)]
+    assert j.direct(key(3), key(1)) == [((400, 2), 2)]
+    assert j.patterns(SimpleNamespace(id=400, type=2)) == [[key(3), key(2), key(1)]]
+    assert len(j.patterns(400)) == 2
+
+
+def test_earliest_arrival():
+    connections = [(10, 20, key(1), key(2), "a"), (25, 30, key(2), key(3), "b"), (40, 50, key(1), key(3), "c")]
+    assert JourneyIndex.earliest_arrival(connections, key(1), key(3), 0) == [
+        ("a", key(1), 10, key(2), 20), ("b", key(2), 25, key(3), 30)]
+    assert JourneyIndex.earliest_arrival(connections, key(1), key(3), 10) == [
+        ("a", key(1), 10, key(2), 20), ("b", key(2), 25, key(3), 30)]
+    assert JourneyIndex.earliest_arrival(connections, key(1), key(3), 11) == [("c", key(1), 40, key(3), 50)]
+
+
+def test_direct_routes_resolve_id_and_type():
+    net = network(300, 30)
+    a_, b_ = next(r for r in net["routes"] if r["type"] == 3), next(r for r in net["routes"] if r["type"] == 2)
+    # b_ takes the id of a_, in the stops it serves as well
+    for s_ in net["stops"]:
+        for r_ in s_["routes"]:
+            if r_ == {"routeId": b_["routeId"], "type": 2}:
+                r_["routeId"] = a_["routeId"]
+    b_["routeId"] = a_["routeId"]
+    t = TNBus(FixtureAPI(net))
+    a, b = (t.get(TNBus.Route, (By.ID, a_["routeId"]), (By.TYPE, type_)) for type_ in (3, 2))
+    assert a is not b
+    s1, s2, s3 = t.stops[:3]
+    t.journeys.add([
+        SimpleNamespace(id="a", route=a, stop_times=lambda: [(s1.id_numeric, s1.type, None),
+                                                             (s2.id_numeric, s2.type, None)]),
+        SimpleNamespace(id="b", route=b, stop_times=lambda: [(s2.id_numeric, s2.type, None),
+                                                             (s3.id_numeric, s3.type, None)])])
+    assert t.direct_routes(s1, s2) == [(a, 1)]
+    assert t.direct_routes(s2, s3) == [(b, 1)]
+    assert t.transfer_routes(s1, s3) == [(a, s2, b, 2)]
@@ -0,0 +1,63 @@
+import itertools
+import threading
+from datetime import datetime
+
+from network import network, trips, FixtureAPI
+from tnbus import TNBus
+from tnbus.live import Live
+
+
+class GrowingAPI(FixtureAPI):
+    # new trips on every call, so that loading keeps adding entries to the trip dicts
+    def __init__(self, net):
+        super().__init__(net)
+        self.calls = itertools.count()
+
+    def trips_new(self, search, time=None, limit=30):
+        n = next(self.calls)
+        out = trips(self.net, search.id_numeric, limit, seed=n)
+        for i_ in out:
+            i_["tripId"] = f"{n}-{i_['tripId']}"
+        return out
+
+
+def test_copy_while_loading_trips():
+    live = Live(TNBus(GrowingAPI(network(300, 30))))
+    stops = live.current.stops[:20]
+    done = threading.Event()
+    errors = []
+
+    def load():
+        try:
+            while not done.is_set():
+                for s_ in stops:
+                    live.current.load_trips(s_, datetime.now(), 30)
+        except Exception as e:
+            errors.append(e)
+
+    readers = [threading.Thread(target=load) for _ in range(4)]
+    for r_ in readers:
+        r_.start()
+    try:
+        for _ in range(20):
+            live.update(lambda t: None)
+    finally:
+        done.set()
+        for r_ in readers:
+            r_.join()
+    assert not errors
+    assert live.version == 21
+    assert live.current.trips
+
+
+def test_load_trips_on_lazy_published_version():
+    live = Live(TNBus(FixtureAPI(network(300, 30)), areas=[1], lazy=True))
+    t = live.current
+    stops = t.stops[:10]
+    # the trips call at routes and stops of the other areas too: a published version leaves those out
+    loaded = [i for s_ in stops for i in t.load_trips(s_, datetime.now(), 30)]
+    assert loaded
+    assert {i.route.area.id for i in loaded} == {1}
+    assert t.loaded_areas == [t.get_area(1)]
+    new = live.update(lambda t_: t_.load_area(2))
+    assert {i.route.area.id for s_ in new.stops[:10] for i in new.load_trips(s_, datetime.now(), 30)} <= {1, 2}
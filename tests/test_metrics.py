@@ -0,0 +1,30 @@
+from tnbus import metrics
+
+
+def test_prometheus_large_values():
+    m = metrics.Metrics(buckets={"size_bytes": (1024, 16777216)})
+    m.inc("requests_total", 1234567, {"endpoint": "stops"})
+    m.inc("requests_total", 1, {"endpoint": "stops"})
+    m.inc("seconds_total", .5, {})
+    m.observe("render_seconds", 1234.56789, {})
+    m.observe("size_bytes", 20000000, {})
+    out = m.prometheus().splitlines()
+    assert 'tnbus_requests_total{endpoint="stops"} 1234568' in out
+    assert "tnbus_seconds_total 0.5" in out
+    assert "tnbus_render_seconds_sum 1234.56789" in out
+    assert 'tnbus_size_bytes_bucket{le="16777216"} 0' in out
+    assert "tnbus_size_bytes_sum 20000000" in out
+
+
+def test_timer_needs_sinks():
+    m = metrics.Metrics()
+    with metrics.timer("idle_seconds"):
+        pass
+    metrics.attach(m)
+    try:
+        with metrics.timer("busy_seconds", op="x"):
+            pass
+    finally:
+        metrics.detach(m)
+    assert m.histogram("idle_seconds") == (0, 0.)
+    assert m.histogram("busy_seconds", op="x")[0] == 1
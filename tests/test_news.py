@@ -0,0 +1,26 @@
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from tnbus.news import NewsIndex
+
+T0 = datetime(2023, 1, 10, 7, tzinfo=timezone.utc)
+
+
+def new(route, type_, stop=None):
+    return SimpleNamespace(route=SimpleNamespace(id=route, type=type_), stop_id=stop, area=SimpleNamespace(id=1),
+                           start=T0, end=None)
+
+
+def test_routes_keyed_by_id_and_type():
+    # an urban and an extraurban route with the same id
+    urban, extra, other = new(400, "U"), new(400, "E", stop=7), new(401, "U")
+    index = NewsIndex([urban, extra, other])
+    assert index.news(route=(400, "U")) == [urban]
+    assert index.news(route=(400, "E")) == [extra]
+    assert index.news(route=400) == [urban, extra]
+    assert index.news(route=(400, "E"), stop=7) == [extra]
+    assert index.news(route=(400, "U"), stop=7) == []
+    at = T0.timestamp()
+    assert index.active(at, route=(400, "U")) == [urban]
+    assert index.active(at, route=400) == [urban, extra]
+    assert index.active(at - 1, route=400) == []
@@ -0,0 +1,145 @@
+import copy
+import random
+import threading
+
+from network import network, FixtureAPI
+from tnbus import TNBus, By, Cond
+from tnbus.live import Live
+from tnbus.tnbus import remove_accents
+
+
+def scan(t, t_, filters, cond_mode=Cond.AND, override_unique=False):
+    # TNBus.get as a linear scan of the store, the way it worked before the indexes
+    out = []
+    store = getattr(t, t_.SEARCH_STORE)
+    for o_ in store:
+        matches = []
+        for b_, v_ in filters:
+            target = getattr(o_, t_.SEARCH_ASSOC[b_])
+            try:
+                v_ in target
+            except TypeError:
+                matches.append(v_ == target)
+                continue
+            if b_ == By.NAME_MATCH:
+                matches.append(remove_accents(v_.lower()) in remove_accents(target.lower()))
+            elif isinstance(v_, str):
+                matches.append(remove_accents(v_).lower() in remove_accents(target).lower())
+            else:
+                matches.append(v_ in target)
+        if all(matches) if cond_mode == Cond.AND else any(matches):
+            out.append(o_)
+    if not override_unique and By.ID in (f_[0] for f_ in filters):
+        return out[0] if out else None
+    return out
+
+
+def net_():
+    net = network(300, 30)
+    # accents and case, which By.NAME and By.NAME_MATCH normalize differently
+    net["stops"][4]["stopName"] = "Salè Città"
+    net["stops"][5]["stopName"] = "SALE citta"
+    net["stops"][6]["stopName"] = "Ōra Çles"
+    return net
+
+
+def needles(rnd, t):
+    # stop filters: whole values and parts of them, the way they're asked for
+    s_ = rnd.choice(t.stops)
+    name = rnd.choice([s_.name, "Salè Città", "città", "CITTA", "ōra", "ORA"])
+    k = rnd.randrange(len(name))
+    route = rnd.choice(t.routes)
+    return [
+        (By.ID, s_.id), (By.ID, s_.id[:rnd.randint(1, len(s_.id))]), (By.ID, s_.id.upper()),
+        (By.ID_NUM, s_.id_numeric), (By.ID_NUM, rnd.randint(0, 400)),
+        (By.NAME, name[k:k + rnd.randint(1, 8)]), (By.NAME_MATCH, name[k:k + rnd.randint(1, 8)]),
+        (By.TYPE, rnd.choice(["U", "E"])), (By.ROUTE, route), (By.AREA, rnd.choice(t.areas)),
+    ]
+
+
+def check(t, rnd, n):
+    for _ in range(n):
+        filters = tuple(rnd.sample(needles(rnd, t), rnd.randint(1, 3)))
+        cond_mode = rnd.choice([Cond.AND, Cond.OR])
+        override_unique = rnd.random() < .5
+        assert t.get(TNBus.Stop, *filters, cond_mode=cond_mode, override_unique=override_unique) == \
+            scan(t, TNBus.Stop, filters, cond_mode, override_unique), (filters, cond_mode, override_unique)
+
+
+def test_stop_queries_match_a_scan():
+    check(TNBus(FixtureAPI(net_())), random.Random(1), 1000)
+
+
+def test_substring_ids_and_names():
+    t = TNBus(FixtureAPI(net_()))
+    s_ = t.stops[0]
+    # a part of a string id matches, like it always did
+    assert t.get_stop(s_.id[:3]) is scan(t, TNBus.Stop, ((By.ID, s_.id[:3]),))
+    assert t.get(TNBus.Stop, (By.ID, s_.id[:3]), override_unique=True) == \
+        [i for i in t.stops if s_.id[:3] in i.id]
+    # names match ignoring accents and case
+    for b_ in (By.NAME, By.NAME_MATCH):
+        for v_ in ("citta", "Città", "SALÈ", "ōra", "ÇLES", "ra ç"):
+            res = t.get(TNBus.Stop, (b_, v_))
+            assert res == scan(t, TNBus.Stop, ((b_, v_),)), (b_, v_)
+        assert {t.stops[4], t.stops[5]} <= set(t.get(TNBus.Stop, (b_, "citta")))
+
+
+def test_route_queries_match_a_scan():
+    t = TNBus(FixtureAPI(net_()))
+    rnd = random.Random(2)
+    for _ in range(500):
+        r_ = rnd.choice(t.routes)
+        k = rnd.randrange(len(r_.short_name))
+        filters = tuple(rnd.sample([
+            (By.ID, r_.id), (By.ID, rnd.randint(390, 440)), (By.TYPE, rnd.choice([2, 3, 5])),
+            (By.AREA, rnd.choice(t.areas)), (By.NAME, r_.short_name[k:]), (By.STOP, rnd.choice(t.stops)),
+        ], rnd.randint(1, 3)))
+        cond_mode = rnd.choice([Cond.AND, Cond.OR])
+        assert t.get(TNBus.Route, *filters, cond_mode=cond_mode, override_unique=True) == \
+            scan(t, TNBus.Route, filters, cond_mode, True), (filters, cond_mode)
+
+
+def test_cached_queries_follow_changes():
+    net = net_()
+    api = FixtureAPI(copy.deepcopy(net))
+    t = TNBus(api)
+    rnd = random.Random(3)
+    check(t, rnd, 300)
+    # asked before the change as well, so that the query and its candidates are cached
+    assert t.get(TNBus.Stop, (By.NAME, "nuova")) == []
+    assert t.get(TNBus.Stop, (By.ID_NUM, 999)) == []
+    # a stop renamed, one removed and one added: the compiled queries and their candidates must notice
+    api.net = copy.deepcopy(api.net)
+    stops = api.net["stops"]
+    stops[0]["stopName"] = "Città Nuova"
+    removed = stops.pop(1)
+    stops.append(dict(removed, stopId=999, stopCode="29999x", stopName="Salè Nuova"))
+    t.refresh()
+    assert t.get(TNBus.Stop, (By.NAME, "nuova")) == scan(t, TNBus.Stop, ((By.NAME, "nuova"),))
+    assert len(t.get(TNBus.Stop, (By.NAME, "nuova"))) == 2
+    assert t.get_stop(removed["stopCode"]) is None
+    assert t.get(TNBus.Stop, (By.ID_NUM, 999)) == scan(t, TNBus.Stop, ((By.ID_NUM, 999),))
+    check(t, rnd, 300)
+
+
+def test_query_cache_shared_by_threads():
+    t = Live(TNBus(FixtureAPI(net_()))).current
+    # a small cache, so that the threads keep evicting each other's queries
+    t.QUERY_CACHE_SIZE = 4
+    errors = []
+
+    def ask(k):
+        try:
+            for n in range(2000):
+                t.get(TNBus.Stop, (By.ID_NUM, (k * 2000 + n) % 400))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=ask, args=(k,)) for k in range(8)]
+    for t_ in threads:
+        t_.start()
+    for t_ in threads:
+        t_.join()
+    assert not errors
+    assert len(t._queries) <= 4
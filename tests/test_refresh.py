@@ -0,0 +1,84 @@
+import copy
+from datetime import datetime, timezone
+
+import pytest
+
+from network import network, FixtureAPI
+from tnbus import TNBus, By
+
+AT = datetime(2023, 1, 10, 12, tzinfo=timezone.utc)
+
+
+def new(feed, stop=None):
+    return {"idFeed": feed, "agencyId": "12", "serviceType": "BUS", "startDate": "2023-01-10T00:00:00Z",
+            "endDate": "2023-01-11T00:00:00Z", "header": f"news {feed}", "details": "", "stopId": stop, "url": ""}
+
+
+def change(net):
+    # stops renamed, moved, unlinked, removed and added; routes removed, renamed, moved to another area and given
+    # news; an area renamed
+    stops, routes = net["stops"], net["routes"]
+    stops[10]["stopName"] = "Nuova Fermata Povo"
+    stops[11]["stopLat"] += .05
+    stops[12]["routes"] = stops[12]["routes"][:1]
+    del stops[20]
+    stops.append(dict(copy.deepcopy(stops[30]), stopId=999, stopCode="29999x", stopName="Nuova Salè"))
+    dead = routes.pop(5)
+    for s_ in stops:
+        s_["routes"] = [r_ for r_ in s_["routes"] if r_["routeId"] != dead["routeId"]] or \
+            [{"routeId": routes[0]["routeId"], "type": routes[0]["type"]}]
+    routes[7]["routeShortName"] = "99Z"
+    routes[8]["areaId"] = 1 if routes[8]["areaId"] != 1 else 2
+    routes[9]["news"] = [new(9001, stop=3), new(9002)]
+    routes[10]["news"] = None
+    net["areas"][2]["areaDesc"] = "Rinominata"
+
+
+def summary(t):
+    return {
+        "stops": sorted((s.id, s.id_numeric, s.name, s.location, tuple(sorted((r.id, r.type) for r in s.routes)),
+                         tuple(sorted(a.id for a in s.areas))) for s in t.stops),
+        "routes": sorted((r.id, r.type, r.short_name, r.area.id, tuple(sorted(s.id for s in r.stops)),
+                          tuple(n_.id_feed for n_ in r.news or ())) for r in t.routes),
+        "areas": sorted((a.id, a.desc, tuple(sorted(r.id for r in a.routes))) for a in t.areas),
+        "news": sorted((n_.id_feed, n_.route.id, n_.stop_id) for n_ in t.news),
+    }
+
+
+@pytest.mark.parametrize("keep_raw", [True, False])
+def test_refresh_matches_a_fresh_build(keep_raw):
+    net = network(300, 30)
+    api = FixtureAPI(copy.deepcopy(net))
+    t = TNBus(api, keep_raw=keep_raw)
+    kept = t.get(TNBus.Stop, (By.ID_NUM, 1))[0]
+    # asked before the refresh, so that cached queries and the news index must follow it
+    assert t.get(TNBus.Stop, (By.NAME_MATCH, "nuova")) == []
+    assert t.active_news(AT)
+
+    api.net = copy.deepcopy(net)
+    change(api.net)
+    added, removed, changed = t.refresh()["stops"]
+    assert (added, removed) == (1, 1) and changed > 0
+    fresh = TNBus(FixtureAPI(copy.deepcopy(api.net)))
+    assert summary(t) == summary(fresh)
+    # objects keep their identity
+    assert t.get(TNBus.Stop, (By.ID_NUM, 1))[0] is kept
+    # indexes: by id, by name, by position
+    assert all(t.get_stop(s.id) is s for s in t.stops)
+    for q_ in ("povo", "nuova", "sale", "99z"):
+        assert [s.id for s in t.get(TNBus.Stop, (By.NAME_MATCH, q_))] == \
+            [s.id for s in t.stops if q_ in s.name.lower().replace("è", "e")]
+        assert sorted(r.id for r in t.get(TNBus.Route, (By.NAME, q_))) == \
+            sorted(r.id for r in fresh.get(TNBus.Route, (By.NAME, q_)))
+    assert [s.id for s, _ in t.nearby_stops((46.0, 11.1), 20)] == \
+        [s.id for s, _ in fresh.nearby_stops((46.0, 11.1), 20)]
+    # news
+    route = t.get(TNBus.Route, (By.ID, api.net["routes"][9]["routeId"]), (By.TYPE, api.net["routes"][9]["type"]))
+    assert [n_.id_feed for n_ in t.active_news(AT)] == [n_.id_feed for n_ in fresh.active_news(AT)]
+    assert sorted(n_.id_feed for n_ in t.get_news(route=route)) == [9001, 9002]
+    assert [n_.id_feed for n_ in t.get_news(stop=3)] == [n_.id_feed for n_ in fresh.get_news(stop=3)]
+    assert 9001 in [n_.id_feed for n_ in t.get_news(stop=3)]
+    if keep_raw:
+        assert t.raw["stops"] == api.net["stops"]
+    # nothing changed since
+    assert t.refresh() == {call: (0, 0, 0) for call in ("areas", "routes", "stops")}
@@ -0,0 +1,155 @@
+import gzip
+import http.client
+import json
+import threading
+import time
+from datetime import datetime, timezone
+
+import pytest
+
+from network import network, trips, FixtureAPI
+from tnbus import TNBus
+from tnbus.departures import DepartureIndex
+from tnbus.live import Live
+from tnbus import server
+
+
+class SlowAPI(FixtureAPI):
+    # counts the trips calls, slow enough that concurrent clients overlap them
+    def __init__(self, net):
+        super().__init__(net)
+        self.calls = 0
+
+    def trips_new(self, search, time_=None, limit=30):
+        self.calls += 1
+        time.sleep(.05)
+        return trips(self.net, search.id_numeric, limit, 20, seed=self.calls)
+
+
+def clock():
+    # before the first departure of the fixture trips; a function, as copies of a Live version are pickled
+    return datetime(2023, 1, 10, 6, tzinfo=timezone.utc).timestamp()
+
+
+@pytest.fixture
+def live():
+    out = Live(TNBus(SlowAPI(network(300, 30))))
+    out.current.departures = DepartureIndex(clock=clock)
+    srv = server.serve(out, 0, "127.0.0.1")
+    out.port = srv.server_address[1]
+    yield out
+    srv.shutdown()
+    srv.server_close()
+
+
+def get(live, path, headers=None):
+    c = http.client.HTTPConnection("127.0.0.1", live.port, timeout=30)
+    try:
+        c.request("GET", path, headers=headers or {})
+        r = c.getresponse()
+        return r.status, dict(r.getheaders()), r.read()
+    finally:
+        c.close()
+
+
+def clients(n, target):
+    threads = [threading.Thread(target=target, args=(k,)) for k in range(n)]
+    for t_ in threads:
+        t_.start()
+    for t_ in threads:
+        t_.join()
+
+
+def test_concurrent_clients_share_one_upstream_call(live):
+    stop = live.current.stops[10].id
+    res = []
+    # every client asks for a different page, so that the responses aren't shared: the trips are
+    clients(100, lambda k: res.append(get(live, f"/stops/{stop}/departures?n={k + 1}")))
+    assert [r[0] for r in res] == [200] * 100
+    assert live.current.api.calls == 1
+
+
+def test_update_while_serving(live):
+    stops = [s.id for s in live.current.stops[:25]]
+    res = []
+    done = threading.Event()
+
+    def publish():
+        while not done.is_set():
+            live.update(lambda t: None)
+
+    p_ = threading.Thread(target=publish)
+    p_.start()
+    try:
+        clients(100, lambda k: res.append(get(live, f"/stops/{stops[k % 25]}/departures?n={k // 25 + 1}")))
+    finally:
+        done.set()
+        p_.join()
+    assert [r[0] for r in res] == [200] * 100
+    assert live.version > 1
+
+
+def test_etag_and_gzip(live):
+    status, headers, body = get(live, "/stops?q=a&n=50", {"Accept-Encoding": "gzip"})
+    assert status == 200 and headers["Content-Encoding"] == "gzip"
+    assert json.loads(gzip.decompress(body))
+    status, _, body = get(live, "/stops?q=a&n=50", {"If-None-Match": headers["ETag"]})
+    assert status == 304 and body == b""
+
+
+def test_routes_by_id(live):
+    route = live.current.routes[0]
+    status, _, body = get(live, f"/routes/{route.id}")
+    assert status == 200
+    assert [(r["id"], r["type"]) for r in json.loads(body)] == [
+        (r.id, r.type) for r in live.current.routes if r.id == route.id]
+    assert get(live, "/routes/999999")[0] == 404
+
+
+def test_stops_by_exact_id(live):
+    stop = live.current.stops[0]
+    status, _, body = get(live, f"/stops/{stop.id}")
+    assert status == 200 and json.loads(body)["id"] == stop.id
+    # a prefix of an id is no stop, and no trips are loaded for it
+    assert get(live, f"/stops/{stop.id[:2]}")[0] == 404
+    assert get(live, f"/stops/{stop.id[:2]}/departures")[0] == 404
+    assert live.current.api.calls == 0
+
+
+class AreasAPI(SlowAPI):
+    # records the areas of every stops call too
+    def __init__(self, net):
+        super().__init__(net)
+        self.areas_loaded = []
+
+    def stops(self, areas=None):
+        self.areas_loaded += areas or ["all"]
+        time.sleep(.05)
+        return super().stops(areas)
+
+    def trips_new(self, search, time_=None, limit=30):
+        self.calls += 1
+        return trips(self.net, search.id_numeric, limit, 20, seed=self.calls)
+
+
+def test_lazy_source_loads_every_area_once():
+    t = TNBus(AreasAPI(network(300, 30)), areas=[1], lazy=True)
+    srv = server.serve(t, 0, "127.0.0.1")
+    t.port = srv.server_address[1]
+    res = []
+
+    def ask(k):
+        # trips of routes in other areas load areas outside of the server, name searches load them in it
+        if k % 2:
+            t.load_trips(t.stops[k], datetime.now(), 30)
+        else:
+            res.append(get(t, f"/stops?q={'abcdefghij'[k // 2]}"))
+
+    try:
+        clients(20, ask)
+    finally:
+        srv.shutdown()
+        srv.server_close()
+    assert [r[0] for r in res] == [200] * 10
+    assert sorted(t.api.areas_loaded) == sorted(set(t.api.areas_loaded))
+    assert len({(s.id_numeric, s.type) for s in t.stops}) == len(t.stops)